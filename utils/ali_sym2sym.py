@@ -2,7 +2,8 @@
 
 import os
 import sys
-import codecs
+from mlf import read_symbol_map, iter_ali_corpus, write_ali
+from fileio import open_file
 
 def main():
 
@@ -10,7 +11,8 @@ def main():
     print("Usage: ./ali_int2sym.py <ali_file_in> <ali_file_out> <phones.txt>")
     print(" Converts ali file from one symbol set to another defined by the "
             "mapping in phones.txt. The phones.txt file from a kaldi data/lang "
-            "would work well for the mapping for instance.")
+            "would work well for the mapping for instance. The ali files can "
+            "be - for stdin/stdout, and gzip or zstd compressed.")
     sys.exit(1)
 
   ALI = sys.argv[1]
@@ -18,20 +20,13 @@ def main():
   PHONES = sys.argv[3] 
 
 
-  with codecs.open(PHONES,"r","utf-8") as fp:
-    phones_map = {}
-    for l in fp:
-      l_vals = l.strip().split(" ")
-      phones_map[l_vals[1]] = l_vals[0].split("_")[0]
-
-  with codecs.open(ALI,"r","utf-8") as fp:
-    with codecs.open(ALI_OUT,"w","utf-8") as fo:
-      for l in fp:
-        l_vals = l.strip().split(" ")
-        fo.write("%s " % l_vals[0])
-        for v in l_vals[1:-1]:
-          fo.write("%s " % phones_map[v])
-        fo.write("%s\n" % phones_map[l_vals[-1]])
+  phones_map = read_symbol_map(PHONES,new_sym=lambda phone: phone.split("_")[0])
+
+  # The mapping is compiled once per block of lines and applied to whole
+  # segments, see mlf.parse_ali_block
+  with open_file(ALI_OUT,"w") as fo:
+    for corpus in iter_ali_corpus(ALI,sym2phone=phones_map):
+      write_ali(fo,corpus,strip=True)
 
 if __name__ == "__main__":
   main()
@@ -0,0 +1,19 @@
+#!/usr/bin/python
+
+import sys
+from mlf import bin2mlf
+
+def main():
+  if len(sys.argv[1:]) < 2:
+    print("Usage: ./bin2mlf.py <rspecifier_mlfb> <wspecifier_mlf> [<ext>]")
+    print(" Converts a binary mlf sidecar written by mlf2bin.py back to an mlf "
+            "file. Utterance names get the extension ext (default ALI).")
+    sys.exit(1)
+
+  mlfb = sys.argv[1]
+  mlf = sys.argv[2]
+  ext = sys.argv[3] if len(sys.argv[1:]) > 2 else "ALI"
+  bin2mlf(mlfb,mlf,ext=ext)
+
+if __name__ == "__main__":
+  main()
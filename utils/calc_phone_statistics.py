@@ -2,7 +2,8 @@
 import os 
 import sys
 import codecs
-import pdb
+import numpy as np
+from mlf import mlf2corpus
 
 def main():
   if len(sys.argv[1:]) < 2:
@@ -14,30 +15,18 @@ def main():
   MLF = sys.argv[1]
   FREQ = sys.argv[2]
   DUR = sys.argv[3]
-  files = mlf2python(MLF)
+  files = mlf2corpus(MLF)
   
   # Compute Frequencies and durations for each symbol
-  pdb.set_trace()
-  durations = {}
-  frequencies = {}
-  for f in files.keys():
-    for seg in files[f]:
-      # When key is present
-      try:
-        durations[seg[2]].append(seg[1] - seg[0])
-        frequencies[seg[2]] += 1
-
-      # When key is not present
-      except:
-        durations[seg[2]] = [seg[1] - seg[0]]
-        frequencies[seg[2]] = 1
-
+  num_symbols = len(files.symbols)
+  counts = np.bincount(files.labels, minlength=num_symbols)
+  total_durations = np.bincount(files.labels, weights=files.ends - files.starts, minlength=num_symbols)
   
-  num_tokens = sum([frequencies[f] for f in frequencies.keys()])
-  frequencies = [(f,frequencies[f]/float(num_tokens)) for f in frequencies.keys()]
+  num_tokens = counts.sum()
+  frequencies = [(f,counts[i]/float(num_tokens)) for i,f in enumerate(files.symbols) if counts[i] > 0]
   frequencies.sort(key=lambda x:x[1])
   
-  avg_durations = [(d,sum(durations[d])/float( len(durations[d])) ) for d in durations.keys()]
+  avg_durations = [(d,total_durations[i]/float(counts[i])) for i,d in enumerate(files.symbols) if counts[i] > 0]
   avg_durations.sort(key=lambda x:x[1])
    
   with codecs.open(FREQ,"w","utf-8") as fp:
@@ -48,22 +37,6 @@ def main():
     for d in avg_durations:
       fp.write("%s %.4f\n" % (d[0],d[1]))
 
-def mlf2python(filename):
-  files = {}
-  with open(filename,"r") as fp:
-    lines = []
-    for line in fp:
-      if(not line.strip() == "#!MLF!#" and not line.strip() == "."):
-        if (line.strip().startswith('"')):
-          utterance = line.strip().split(".")[0].split("/")[1]
-        else:
-          [start, stop, label] = line.strip().split(" ")
-          lines.append([int(float(start)/100000.0), int(float(stop)/100000.0), label]) 
-      elif(line.strip() == "."):
-        files[utterance] = lines
-        lines = []
-  return files
-
 if __name__ == "__main__":
   main()
 
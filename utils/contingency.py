@@ -0,0 +1,242 @@
+import numpy as np
+
+# Contingency table of a clustering against reference labels, the counts
+# n(k,l) of the items of cluster k with label l. It is built once from the
+# integer label and cluster maps and every metric of scoring_plus.py is
+# derived from it. Only the nonzero cells are stored, as the arrays
+#
+#   clusters, labels, counts
+#
+# sorted by (cluster, label), so that a table of thousands of clusters and
+# millions of items stays small. Tables that know the names of their labels
+# and clusters can be merged, e.g. those of shards of a test set, and saved
+# as arrays.
+
+# Tables with more cells than this are counted by sorting the cell indices
+# instead of with a dense np.bincount
+DENSE_LIMIT = 1 << 24
+
+EPS = np.finfo(float).eps
+
+# Arrays of a table, see to_arrays
+FIELDS = ('clusters', 'labels', 'counts', 'label_symbols', 'cluster_symbols')
+
+
+def entropy(p, size):
+    '''
+        Usage: entropy(p, size)
+
+        Returns the entropy in bits of a distribution of size cells whose
+        nonzero cells are p, with eps added to every cell (zero cells
+        included) as scoring_plus.py always did to avoid log(0).
+    '''
+    p = p + EPS
+    return -(p*np.log2(p)).sum() - (size - len(p))*EPS*np.log2(EPS)
+
+
+def union_symbols(a, b):
+    '''
+        Usage: union_symbols(a, b)
+
+        Returns (symbols, a_ids, b_ids): the symbols of a followed by those
+        of b not in a, and the index in symbols of every symbol of a and b.
+    '''
+    ids = {}
+    a_ids = np.array([ids.setdefault(s, len(ids)) for s in a], dtype=np.int64)
+    b_ids = np.array([ids.setdefault(s, len(ids)) for s in b], dtype=np.int64)
+    symbols = [None] * len(ids)
+    for s, i in ids.items():
+        symbols[i] = s
+    return symbols, a_ids, b_ids
+
+
+class ContingencyTable(object):
+    def __init__(self, clusters, labels, counts, num_clusters, num_labels,
+                 label_symbols=None, cluster_symbols=None):
+        '''
+            Constructor from the nonzero cells (clusters, labels, counts),
+            sorted by cluster then label, of a num_clusters x num_labels
+            table. Use from_maps() to count the cells of label and cluster
+            maps. label_symbols and cluster_symbols, the names of the
+            labels and clusters, are needed to merge tables.
+        '''
+        self.clusters = clusters
+        self.labels = labels
+        self.counts = counts
+        self.num_clusters = num_clusters
+        self.num_labels = num_labels
+        self.label_symbols = label_symbols
+        self.cluster_symbols = cluster_symbols
+
+    @classmethod
+    def from_cells(cls, cells, counts, num_clusters, num_labels, sparse=None,
+                   label_symbols=None, cluster_symbols=None):
+        '''
+            Builds the table of the flat cell indices cluster*num_labels +
+            label, each one counted counts times (once if counts is None).
+            The cells are counted with np.bincount, or by sorting them if
+            sparse is True, which is the default for tables larger than
+            DENSE_LIMIT cells.
+        '''
+        cells = np.asarray(cells, dtype=np.int64)
+        size = num_clusters*num_labels
+        if sparse is None:
+            sparse = size > DENSE_LIMIT
+        if not sparse:
+            table = np.bincount(cells, weights=counts, minlength=size)
+            cells = np.flatnonzero(table)
+            counts = table[cells]
+        else:
+            order = np.argsort(cells, kind="mergesort")
+            cells = cells[order]
+            first = np.flatnonzero(np.concatenate(([True], cells[1:] != cells[:-1])))
+            if counts is None:
+                counts = np.diff(np.concatenate((first, [len(cells)])))
+            else:
+                counts = np.add.reduceat(np.asarray(counts)[order], first) if len(first) else np.zeros(0)
+            cells = cells[first]
+        return cls(cells // num_labels, cells % num_labels, np.asarray(counts).astype(np.int64),
+                   num_clusters, num_labels, label_symbols, cluster_symbols)
+
+    @classmethod
+    def from_maps(cls, label_map, cluster_map, num_labels=None, num_clusters=None, sparse=None,
+                  label_symbols=None, cluster_symbols=None):
+        '''
+            Builds the table of the integer maps label_map and cluster_map,
+            the label and cluster of every item (see
+            scoring_plus.map_partitions). The labels and clusters are
+            0 ... max by default, or those of the symbol lists.
+        '''
+        if num_labels is None and label_symbols is not None:
+            num_labels = len(label_symbols)
+        if num_clusters is None and cluster_symbols is not None:
+            num_clusters = len(cluster_symbols)
+        label_map = np.asarray(label_map, dtype=np.int64)
+        cluster_map = np.asarray(cluster_map, dtype=np.int64)
+        if num_labels is None:
+            num_labels = int(label_map.max()) + 1 if len(label_map) else 0
+        if num_clusters is None:
+            num_clusters = int(cluster_map.max()) + 1 if len(cluster_map) else 0
+        return cls.from_cells(cluster_map*num_labels + label_map, None, num_clusters, num_labels, sparse=sparse,
+                              label_symbols=label_symbols, cluster_symbols=cluster_symbols)
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix=""):
+        '''
+            Rebuilds a table saved by to_arrays, e.g. read back with np.load.
+        '''
+        clusters, labels, counts, label_symbols, cluster_symbols = [arrays[prefix + f] for f in FIELDS]
+        return cls(clusters, labels, counts, len(cluster_symbols), len(label_symbols),
+                   label_symbols.tolist(), cluster_symbols.tolist())
+
+    def to_arrays(self, prefix=""):
+        '''
+            Returns the dictionary of the arrays of the table, named
+            prefix + field, which can be passed to np.savez. The table must
+            have symbols.
+        '''
+        if self.label_symbols is None or self.cluster_symbols is None:
+            raise ValueError("Only tables with label and cluster symbols can be saved")
+        arrays = [self.clusters, self.labels, self.counts,
+                  np.array(self.label_symbols, dtype=str), np.array(self.cluster_symbols, dtype=str)]
+        return {prefix + f: a for f, a in zip(FIELDS, arrays)}
+
+    def merge(self, other):
+        '''
+            Returns the table of the items of both tables, their labels and
+            clusters matched by symbol.
+        '''
+        symbols = (self.label_symbols, self.cluster_symbols, other.label_symbols, other.cluster_symbols)
+        if any(s is None for s in symbols):
+            raise ValueError("Only tables with label and cluster symbols can be merged")
+        label_symbols, a_labels, b_labels = union_symbols(self.label_symbols, other.label_symbols)
+        cluster_symbols, a_clusters, b_clusters = union_symbols(self.cluster_symbols, other.cluster_symbols)
+        num_labels = len(label_symbols)
+        cells = np.concatenate((a_clusters[self.clusters]*num_labels + a_labels[self.labels],
+                                b_clusters[other.clusters]*num_labels + b_labels[other.labels]))
+        counts = np.concatenate((self.counts, other.counts))
+        return ContingencyTable.from_cells(cells, counts, len(cluster_symbols), num_labels, sparse=True,
+                                           label_symbols=label_symbols, cluster_symbols=cluster_symbols)
+
+    def total(self):
+        return int(self.counts.sum())
+
+    def cluster_counts(self):
+        return np.bincount(self.clusters, weights=self.counts, minlength=self.num_clusters)
+
+    def label_counts(self):
+        return np.bincount(self.labels, weights=self.counts, minlength=self.num_labels)
+
+    def dense(self):
+        '''
+            Returns the num_clusters x num_labels array of counts.
+        '''
+        table = np.zeros((self.num_clusters, self.num_labels), dtype=np.int64)
+        table[self.clusters, self.labels] = self.counts
+        return table
+
+    def information_metrics(self):
+        '''
+            Returns [Perplexity, Information, NMI_1, NMI_2, H_l, H_k], see
+            scoring_plus.calculate_information_metrics.
+        '''
+        n = float(self.total())
+        p_k = self.cluster_counts() / n
+        p_l = self.label_counts() / n
+        p_lk = self.counts / n
+
+        # Compute entropies
+        H_k = entropy(p_k, self.num_clusters)
+        H_l = entropy(p_l, self.num_labels)
+        H_lk = entropy(p_lk, self.num_clusters*self.num_labels)
+        H_l_given_k = H_lk - H_k
+        Information = H_l - H_l_given_k
+        Perplexity = 2**H_l_given_k
+        NMI_1 = 2*Information / (H_l + H_k)
+        NMI_2 = Information / H_l
+        return [Perplexity, Information, NMI_1, NMI_2, H_l, H_k]
+
+    def bcubed(self):
+        '''
+            Returns [F, precision, recall] of B-cubed: the precision of an
+            item is the fraction of its cluster that has its label, n(k,l) /
+            n(k), and its recall the fraction of its label that is in its
+            cluster, n(k,l) / n(l). Both are averaged over the items, which
+            only takes the nonzero cells.
+        '''
+        n = float(self.total())
+        squares = self.counts.astype(float)**2
+        precision = (squares / self.cluster_counts()[self.clusters]).sum() / n
+        recall = (squares / self.label_counts()[self.labels]).sum() / n
+        return [2*precision*recall / (precision + recall), precision, recall]
+
+    def n_best(self, N=1):
+        '''
+            Returns {cluster: labels}, the N most frequent labels of every
+            cluster in increasing order of count, as
+            p_l_given_k[k].argsort()[-N:] with a stable sort: equal counts
+            are ordered by label, and clusters with fewer than N labels are
+            completed with the last labels they never see.
+        '''
+        order = np.lexsort((self.labels, self.counts, self.clusters))
+        labels = self.labels[order]
+        bounds = np.searchsorted(self.clusters[order], np.arange(self.num_clusters + 1))
+        N = min(N, self.num_labels)
+        clust2lbl = {}
+        for k in range(self.num_clusters):
+            row = labels[bounds[k]:bounds[k+1]]
+            if len(row) < N:
+                unseen = np.ones(self.num_labels, dtype=bool)
+                unseen[row] = False
+                row = np.concatenate((np.flatnonzero(unseen)[len(row) - N:], row))
+            clust2lbl[k] = row[len(row) - N:]
+        return clust2lbl
+
+    def accuracy(self, clust2lbl):
+        '''
+            Returns the fraction of the items whose label is one of the
+            labels clust2lbl (see n_best) of their cluster.
+        '''
+        cells = np.array([k*self.num_labels + l for k, lbls in clust2lbl.items() for l in lbls], dtype=np.int64)
+        hits = np.isin(self.clusters*self.num_labels + self.labels, cells)
+        return self.counts[hits].sum() / float(self.total())
@@ -0,0 +1,171 @@
+import io
+import os
+import sys
+import gzip
+import subprocess
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+# Common file access of the mlf and ali tools. Any path can be "-" for
+# stdin or stdout, inputs compressed with gzip or zstd are read
+# transparently, and outputs are compressed according to their extension
+# (.gz, .zst). zstd streams use the zstandard package when it is installed
+# and the zstd command otherwise.
+
+# Size of the buffer of every file opened by open_file
+BUFFER_SIZE = 1 << 20
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+GZIP_EXTS = (".gz",)
+ZSTD_EXTS = (".zst",".zstd")
+
+class PipeStream(io.BufferedIOBase):
+  '''
+    Binary stream over the stdout (reading) or stdin (writing) pipe of a
+    zstd process. Closing the stream waits for the process, and raises
+    IOError if it failed.
+  '''
+  def __init__(self,pipe,proc,name,reading):
+    # The pipes of python 2 are file objects, without peek or read1
+    self.file = pipe
+    if not isinstance(pipe,io.IOBase):
+      pipe = io.open(pipe.fileno(),"rb" if reading else "wb",buffering=BUFFER_SIZE,closefd=False)
+    self.pipe = pipe
+    self.proc = proc
+    self.name = name
+    self.reading = reading
+
+  def readable(self):
+    return self.reading
+
+  def writable(self):
+    return not self.reading
+
+  def read(self,n=-1):
+    return self.pipe.read(n)
+
+  def read1(self,n=-1):
+    return self.pipe.read1(n) if hasattr(self.pipe,"read1") else self.pipe.read(n)
+
+  def peek(self,n=0):
+    return self.pipe.peek(n)
+
+  def readinto(self,b):
+    data = self.pipe.read(len(b))
+    b[:len(data)] = data
+    return len(data)
+
+  def write(self,b):
+    return self.pipe.write(b)
+
+  def flush(self):
+    if not self.pipe.closed:
+      self.pipe.flush()
+
+  def close(self):
+    if self.closed:
+      return
+    self.pipe.close()
+    self.file.close()
+    code = self.proc.wait()
+    super(PipeStream,self).close()
+    # A reader closed before the end stops zstd with SIGPIPE
+    if code != 0 and not (self.reading and code == -13):
+      raise IOError("zstd failed on %s with exit code %d" % (self.name,code))
+
+def is_stdio(path):
+  return path == "-"
+
+def compression(path):
+  '''
+    Usage: compression(path)
+
+    Returns "gzip", "zstd" or None, the compression of the existing file
+    path (from its first bytes), or that its extension asks for.
+  '''
+  if not is_stdio(path) and os.path.isfile(path):
+    with open(path,"rb") as fp:
+      return _sniff(fp.read(4))
+  if path.endswith(GZIP_EXTS):
+    return "gzip"
+  if path.endswith(ZSTD_EXTS):
+    return "zstd"
+  return None
+
+def is_plain(path):
+  '''
+    Usage: is_plain(path)
+
+    True if path is an uncompressed file on disk, which can be seeked and
+    indexed (see mlf.load_index).
+  '''
+  return not is_stdio(path) and compression(path) is None
+
+def _sniff(head):
+  if head.startswith(GZIP_MAGIC):
+    return "gzip"
+  if head.startswith(ZSTD_MAGIC):
+    return "zstd"
+  return None
+
+def _stdio(mode):
+  stream = sys.stdin if "r" in mode else sys.stdout
+  if "w" in mode:
+    stream.flush()
+  return io.open(stream.fileno(),"rb" if "r" in mode else "wb",buffering=BUFFER_SIZE,closefd=False)
+
+def _open_read(path):
+  raw = _stdio("r") if is_stdio(path) else io.open(path,"rb",buffering=BUFFER_SIZE)
+  kind = _sniff(raw.peek(4)[:4])
+  if kind == "gzip":
+    if is_stdio(path):
+      return gzip.GzipFile(fileobj=raw,mode="rb")
+    raw.close()
+    return gzip.GzipFile(path,mode="rb")
+  if kind == "zstd":
+    if zstandard is not None:
+      return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw,closefd=True),BUFFER_SIZE)
+    if is_stdio(path):
+      raise IOError("zstd compressed stdin needs the zstandard package")
+    raw.close()
+    proc = subprocess.Popen(["zstd","-dcq",path],stdout=subprocess.PIPE,bufsize=BUFFER_SIZE)
+    return PipeStream(proc.stdout,proc,path,True)
+  return raw
+
+def _open_write(path):
+  if is_stdio(path):
+    return _stdio("w")
+  if path.endswith(GZIP_EXTS):
+    return io.BufferedWriter(gzip.GzipFile(path,mode="wb"),BUFFER_SIZE)
+  if path.endswith(ZSTD_EXTS):
+    if zstandard is not None:
+      fp = io.open(path,"wb")
+      return io.BufferedWriter(zstandard.ZstdCompressor().stream_writer(fp,closefd=True),BUFFER_SIZE)
+    with open(path,"wb") as fp:
+      proc = subprocess.Popen(["zstd","-cq"],stdin=subprocess.PIPE,stdout=fp,bufsize=BUFFER_SIZE)
+    return PipeStream(proc.stdin,proc,path,False)
+  return io.open(path,"wb",buffering=BUFFER_SIZE)
+
+def open_file(path,mode="r"):
+  '''
+    Usage: open_file(path,mode="r")
+
+    Opens path for reading ("r", "rb") or writing ("w", "wb"). path can be
+    "-" for stdin or stdout. Inputs compressed with gzip or zstd are
+    decompressed, whatever their name, and outputs named *.gz or *.zst are
+    compressed. Text modes read and write utf-8; on python 2 they read
+    and write the native str, the bytes of the file, unchanged.
+
+    Closing a file opened on stdin or stdout leaves the standard stream
+    open.
+  '''
+  if mode not in ("r","rb","w","wb"):
+    raise ValueError("Unsupported mode %s" % mode)
+  fp = _open_read(path) if "r" in mode else _open_write(path)
+  if "b" in mode or bytes is str:
+    return fp
+  return io.TextIOWrapper(fp,encoding="utf-8")
@@ -0,0 +1,197 @@
+import os
+import numpy as np
+from fileio import open_file, is_stdio
+
+# Reader of kaldi int32 vector archives (ali-to-phones, copy-int-vector,
+# ...) in the binary format, so that alignments need no ark,t:- round trip.
+# A binary archive is a sequence of records
+#
+#   utt_id " " "\0B" "\4" int32 num_frames ("\4" int32 value) * num_frames
+#
+# with little endian integers, each one preceded by its size. A record of a
+# text archive is "utt_id v1 v2 ...\n" instead; both kinds are read. A scp
+# file lists "utt_id ark_path:byte_offset" for random access, the offset
+# pointing at the "\0B" of the record.
+
+ARK_BLOCK_SIZE = 1 << 24
+BINARY_MARK = b"\0B"
+INT32_RECORD = np.dtype([("size","i1"),("value","<i4")])
+
+def parse_rspecifier(rspec):
+  '''
+    Usage: parse_rspecifier(rspec)
+
+    Splits a kaldi rspecifier "ark:path", "scp:path" (with options, as in
+    "ark,t:-") into (kind, path). A plain path gives (None, path).
+  '''
+  if ":" in rspec:
+    opts, path = rspec.split(":",1)
+    kind = opts.split(",")[0]
+    if kind in ("ark","scp"):
+      return kind, path
+  return None, rspec
+
+def is_binary_ark(fp):
+  '''
+    Usage: is_binary_ark(fp)
+
+    True if the binary stream fp, which must support peek, starts with a
+    binary archive record. Nothing is consumed.
+  '''
+  head = fp.peek(4096)
+  space = head.find(b" ")
+  return space > 0 and head[space + 1:space + 3] == BINARY_MARK
+
+class ArkReader(object):
+  '''
+    Reads the records of an int32 vector archive from the binary stream fp.
+    Iterating yields (utt_id, vector) in the order of the archive, vector
+    being an int32 array. The stream is read in blocks of block_size
+    bytes.
+  '''
+  def __init__(self,fp,block_size=ARK_BLOCK_SIZE):
+    self.fp = fp
+    self.block_size = block_size
+    self.data = b""
+    self.pos = 0
+
+  def _fill(self,n):
+    # Makes n bytes available from pos, False at the end of the stream
+    while len(self.data) - self.pos < n:
+      block = self.fp.read(max(self.block_size,n - len(self.data) + self.pos))
+      if not block:
+        return False
+      self.data = self.data[self.pos:] + block
+      self.pos = 0
+    return True
+
+  def _take(self,n):
+    if not self._fill(n):
+      raise IOError("Unexpected end of archive")
+    s = self.data[self.pos:self.pos + n]
+    self.pos += n
+    return s
+
+  def read_key(self):
+    '''
+      Returns the utterance id of the next record, None at the end.
+    '''
+    while True:
+      # Text records end with a newline before the next key
+      while self._fill(1) and self.data[self.pos:self.pos + 1].isspace():
+        self.pos += 1
+      space = self.data.find(b" ",self.pos)
+      if space >= 0:
+        key = self.data[self.pos:space]
+        self.pos = space + 1
+        # Keep the native str of python 2
+        return key if bytes is str else key.decode("utf-8")
+      if not self._fill(len(self.data) - self.pos + 1):
+        if self.pos < len(self.data):
+          raise IOError("Unexpected end of archive")
+        return None
+
+  def read_vector(self):
+    '''
+      Returns the int32 vector of the record at the current position.
+    '''
+    if self._fill(2) and self.data[self.pos:self.pos + 2] == BINARY_MARK:
+      head = np.frombuffer(self._take(7)[2:],dtype=INT32_RECORD)[0]
+      if head["size"] != 4:
+        raise IOError("Archive does not hold int32 vectors")
+      values = np.frombuffer(self._take(5 * int(head["value"])),dtype=INT32_RECORD)
+      if not (values["size"] == 4).all():
+        raise IOError("Archive does not hold int32 vectors")
+      return values["value"].astype(np.int32)
+
+    # Text record, up to the end of the line
+    while self.data.find(b"\n",self.pos) < 0 and self._fill(len(self.data) - self.pos + 1):
+      pass
+    end = self.data.find(b"\n",self.pos)
+    end = len(self.data) if end < 0 else end
+    line = self.data[self.pos:end]
+    self.pos = end + 1
+    return np.array(line.split(),dtype=np.int32)
+
+  def __iter__(self):
+    while True:
+      key = self.read_key()
+      if key is None:
+        return
+      yield key, self.read_vector()
+
+def read_scp(scp):
+  '''
+    Usage: read_scp(scp)
+
+    Returns the entries [(utt_id, ark_path, byte_offset), ...] of the scp
+    file, in its order.
+  '''
+  entries = []
+  with open_file(scp) as fp:
+    for line in fp:
+      if not line.strip():
+        continue
+      utt, location = line.strip().split(None,1)
+      path, offset = location.rsplit(":",1)
+      entries.append((utt,path,int(offset)))
+  return entries
+
+def iter_scp(scp,keys=None):
+  '''
+    Usage: iter_scp(scp,keys=None)
+
+    Yields (utt_id, vector) for the entries of the scp file, or only for
+    those of the utterances keys, in the order of the scp file. Every
+    record is read by seeking to its offset, each archive being opened
+    once.
+  '''
+  entries = read_scp(scp)
+  if keys is not None:
+    keys = set(keys)
+    entries = [e for e in entries if e[0] in keys]
+  arks = {}
+  try:
+    for utt,path,offset in entries:
+      if path not in arks:
+        arks[path] = open(path,"rb")
+      arks[path].seek(offset)
+      yield utt, ArkReader(arks[path],block_size=0).read_vector()
+  finally:
+    for fp in arks.values():
+      fp.close()
+
+def iter_vectors(rspec,keys=None):
+  '''
+    Usage: iter_vectors(rspec,keys=None)
+
+    Yields (utt_id, vector) for the int32 vectors of the rspecifier rspec:
+    "scp:path" (optionally only the utterances keys, see iter_scp),
+    "ark:path" or a path of a binary or text archive ("-" for stdin).
+  '''
+  kind, path = parse_rspecifier(rspec)
+  if kind == "scp":
+    for v in iter_scp(path,keys=keys):
+      yield v
+    return
+  keys = None if keys is None else set(keys)
+  with open_file(path,"rb") as fp:
+    for utt,vector in ArkReader(fp):
+      if keys is None or utt in keys:
+        yield utt, vector
+
+def is_ark(rspec):
+  '''
+    Usage: is_ark(rspec)
+
+    True if rspec is an "ark:" or "scp:" rspecifier, or a file on disk that
+    starts with a binary archive record. stdin is only read as an archive
+    when given as "ark:-".
+  '''
+  kind, path = parse_rspecifier(rspec)
+  if kind is not None:
+    return True
+  if is_stdio(path) or not os.path.isfile(path):
+    return False
+  with open_file(path,"rb") as fp:
+    return is_binary_ark(fp)
@@ -1,6 +1,18 @@
+import os
 import sys
+import errno
+import struct
+import multiprocessing
 import numpy as np
-import codecs
+from contextlib import closing
+from itertools import chain
+from fileio import open_file, is_plain
+from kaldi_ark import ArkReader, parse_rspecifier, is_binary_ark, is_ark, iter_vectors
+
+try:
+  from collections.abc import Mapping, Sequence
+except ImportError:
+  from collections import Mapping, Sequence
 
 # The following conversions are all possible
 # _________________________________
@@ -12,33 +24,78 @@ import codecs
 # |_______|_______|_______|________
 # |python | true  | true  | N/A
 # |_______|_______|_______|________
+#
+# Files are opened with fileio.open_file, so every path can be "-" for
+# stdin or stdout, and gzip or zstd compressed. The index, chunk and
+# sidecar functions seek in the file and need plain files on disk.
 
 def ali2dict(path_to_ali,utt_id=True):
   
   ali_dict = {}
+  if utt_id and is_ark(path_to_ali):
+    return dict(iter_ali(path_to_ali))
   if(utt_id):
-    with open(path_to_ali) as fp:
+    with open_file(path_to_ali) as fp:
       for l in fp:
         l_vals = l.strip().split(" ")
         ali_dict[l_vals[0]] = " ".join(l_vals[1:])
   else:
-    with open(path_to_ali) as fp:
+    with open_file(path_to_ali) as fp:
       int_val = 0
       for l in fp:
         ali_dict[int_val] = l.strip()
         int_val += 1
   return ali_dict
 
+def iter_ali(path_to_ali):
+  '''
+    Usage: iter_ali(path_to_ali)
+
+    Generator version of ali2dict. Yields (utt_id, "sym sym ...") one line of
+    the alignments file at a time, in file order, without keeping the file in
+    memory. Kaldi int32 vector archives (see kaldi_ark.is_ark) are read
+    directly.
+  '''
+  if is_ark(path_to_ali):
+    # Ids are formatted by lookup in a table of their strings
+    table = np.zeros(0,dtype=object)
+    for utt,vector in iter_vectors(path_to_ali):
+      if len(vector) > 0 and vector.min() < 0:
+        yield utt, " ".join(map(str,vector.tolist()))
+        continue
+      if len(vector) > 0 and vector.max() >= len(table):
+        table = np.array([str(i) for i in range(2 * int(vector.max()) + 1)],dtype=object)
+      yield utt, " ".join(table[vector].tolist())
+    return
+
+  with open_file(path_to_ali) as fp:
+    for l in fp:
+      l_vals = l.strip().split(" ")
+      yield l_vals[0], " ".join(l_vals[1:])
+
 def python2frames(python_mlf_format):
+  '''
+    Usage: python2frames(python_mlf_format)
+
+    Returns the list of the labels of all frames, each segment repeated
+    end - start times, utterance after utterance in the order of keys().
+    This makes one list entry per frame; SegmentCorpus.frame_array gives
+    the same frames as an int32 array, and should be used for large
+    corpora.
+  '''
+  if isinstance(python_mlf_format,SegmentCorpus):
+    symbols = np.empty(len(python_mlf_format.symbols),dtype=object)
+    symbols[:] = python_mlf_format.symbols
+    return symbols[python_mlf_format.frame_array()[0]].tolist()
+
   utterances_ref = python_mlf_format.keys()
   label_map = []
-  cluster_map = []
   for utt in utterances_ref:
     for seg in python_mlf_format[utt]:
       seg_len = seg[1] - seg[0]
       label_map += [seg[2]]*seg_len
   return label_map
-    
+
 def mlf_concat(lbls_dir,keys_file,output,EXT=".lab"):
   '''
     Usage: mlf_concat(labels_directory, keys, output_mlf_file)
@@ -52,24 +109,258 @@ def mlf_concat(lbls_dir,keys_file,output,EXT=".lab"):
       EXT -- extention to add to keys. Keys are normally utterance ids. Default is .lab
   '''
   
-  with open(keys_file,"r") as fp:
+  with open_file(keys_file) as fp:
     keys = [l.strip() + EXT for l in fp]
 
-  with open(output,"w") as fp:
+  with open_file(output,"w") as fp:
     fp.write("#!MLF!#\n")
     for l in keys:
       fp.write('"*/%s"\n' % l)
-      with open(lbls_dir + "/" + l,"r") as fk:
+      with open_file(lbls_dir + "/" + l) as fk:
         for k in fk:
           fp.write("%s\n" % k.strip())
         fp.write(".\n")
 
+# Alignments are read in blocks of whole lines of about this many bytes
+ALI_BLOCK_SIZE = 1 << 24
+
+# Number of utterances expanded to frames at a time by write_ali
+WRITE_BATCH = 1000
+
+def batch_runs(toks,offsets):
+  '''
+    Usage: batch_runs(toks,offsets)
+
+    Run-length encodes all utterances of the concatenated array toks at once,
+    the i-th utterance being toks[offsets[i]:offsets[i+1]]. Runs never cross
+    an utterance boundary.
+
+    Returns the arrays first, last with the start and end (exclusive) index
+    in toks of every run, and the (num_utts + 1) offsets of the runs of each
+    utterance, the runs of the i-th utterance being those in
+    run_offsets[i]:run_offsets[i+1].
+  '''
+  n = len(toks)
+  offsets = np.asarray(offsets,dtype=np.int64)
+  change = np.ones(n,dtype=bool)
+  if n > 0:
+    change[1:] = toks[1:] != toks[:-1]
+    change[offsets[:-1][offsets[:-1] < n]] = True
+  first = np.flatnonzero(change)
+  last = np.append(first[1:],n).astype(first.dtype)
+  return first, last, np.searchsorted(first,offsets)
+
+def token_keys(buf,starts,ends):
+  '''
+    Usage: token_keys(buf,starts,ends)
+
+    Returns an array with one key per token buf[starts[i]:ends[i]] of the
+    uint8 array buf, such that equal tokens have equal keys: the bytes of the
+    token zero padded to a uint64 when no token is longer than 8 bytes, and
+    to a fixed width byte string otherwise. view("S%d" % keys.itemsize) gives
+    back the tokens.
+  '''
+  lengths = ends - starts
+  width = int(lengths.max()) if len(lengths) > 0 else 0
+  mat = np.zeros((len(starts),max(width,8)),dtype=np.uint8)
+  for j in range(width):
+    mat[:,j] = np.where(lengths > j,buf[np.minimum(starts + j,len(buf) - 1)],0)
+  if width <= 8:
+    return mat.view(np.uint64).ravel()
+  return mat.view("S%d" % width).ravel()
+
+def parse_ali_block(block,sym2phone=None):
+  '''
+    Usage: parse_ali_block(block,sym2phone=None)
+
+    Segments a block of whole lines of an alignments file (bytes), returning
+    them as parse_mlf_lines does: (utt_ids, counts, frames, labels, symbols).
+    The block is split into tokens and run-length encoded with array
+    operations, so that no python object is made per frame.
+
+    Inputs:
+      block -- lines of the alignments file
+      sym2phone -- optional mapping applied to every symbol before the
+                   segments are formed
+  '''
+  buf = np.frombuffer(block,dtype=np.uint8)
+  sep = buf <= 32
+  starts = np.flatnonzero(~sep & np.append(True,sep[:-1]))
+  ends = np.flatnonzero(~sep & np.append(sep[1:],True)) + 1
+  if len(starts) == 0:
+    return [], [], np.zeros((0,2),dtype=np.int32), np.zeros(0,dtype=np.int32), []
+
+  # The first token of every line is the utterance id
+  line = np.searchsorted(np.flatnonzero(buf == 10),starts)
+  is_utt = np.append(True,line[1:] != line[:-1])
+  utt_pos = np.flatnonzero(is_utt)
+  utt_ids = [_decode(block[s:e]) for s,e in zip(starts[utt_pos].tolist(),ends[utt_pos].tolist())]
+  offsets = np.concatenate(([0],np.cumsum(np.diff(np.append(utt_pos,len(starts))) - 1)))
+
+  keys = token_keys(buf,starts[~is_utt],ends[~is_utt])
+  decode = lambda syms: [_decode(s) for s in syms.view("S%d" % syms.itemsize).tolist()]
+  return (utt_ids,) + segment_frames(keys,offsets,decode,sym2phone=sym2phone)
+
+def segment_frames(keys,offsets,decode,sym2phone=None):
+  '''
+    Usage: segment_frames(keys,offsets,decode,sym2phone=None)
+
+    Segments the frames of a block of utterances, given as the array keys
+    with one key per frame, the frames of the i-th utterance being
+    keys[offsets[i]:offsets[i+1]]. decode turns an array of distinct keys
+    into the list of their symbols. Returns (counts, frames, labels,
+    symbols) as in parse_mlf_lines.
+  '''
+  first, last, run_offsets = batch_runs(keys,offsets)
+  syms, labels = np.unique(keys[first],return_inverse=True)
+  symbols = decode(syms)
+  if sym2phone is not None:
+    table, symbols = compile_symbol_map(sym2phone,symbols)
+    labels = table.take(labels)
+    # Symbols mapped to the same phone join into one segment
+    merged, merged_last, run_offsets = batch_runs(labels,run_offsets)
+    first, last, labels = first[merged], last[merged_last - 1], labels[merged]
+
+  counts = np.diff(run_offsets)
+  utt_start = np.repeat(np.asarray(offsets)[:-1],counts)
+  frames = np.column_stack((first - utt_start,last - utt_start)).astype(np.int32).reshape(-1,2)
+  return counts.tolist(), frames, labels.astype(np.int32), symbols
+
+def parse_vectors(vectors,sym2phone=None):
+  '''
+    Usage: parse_vectors(vectors,sym2phone=None)
+
+    Segments the integer alignments [(utt_id, int32 array), ...], e.g. read
+    from a kaldi archive (see kaldi_ark.iter_vectors), returning them as
+    parse_mlf_lines does. Symbols are the integers as strings, as in the
+    text alignments.
+  '''
+  utt_ids = [utt for utt,_ in vectors]
+  lengths = [len(v) for _,v in vectors]
+  keys = np.concatenate([v for _,v in vectors]) if vectors else np.zeros(0,dtype=np.int32)
+  offsets = np.concatenate(([0],np.cumsum(lengths))).astype(np.int64)
+  decode = lambda syms: ["%d" % s for s in syms.tolist()]
+  return (utt_ids,) + segment_frames(keys,offsets,decode,sym2phone=sym2phone)
+
+def iter_vector_blocks(vectors,block_frames=ALI_BLOCK_SIZE // 4):
+  '''
+    Usage: iter_vector_blocks(vectors,block_frames=ALI_BLOCK_SIZE // 4)
+
+    Groups the (utt_id, vector) pairs of the iterator vectors into lists of
+    about block_frames frames.
+  '''
+  block, num_frames = [], 0
+  for v in vectors:
+    block.append(v)
+    num_frames += len(v[1])
+    if num_frames >= block_frames:
+      yield block
+      block, num_frames = [], 0
+  if block:
+    yield block
+
+def iter_ali_parts(ali,sym2phone=None):
+  '''
+    Usage: iter_ali_parts(ali,sym2phone=None)
+
+    Reads the alignments ali once and yields the segments of each block of
+    utterances, as parse_mlf_lines returns them, in file order. ali is a
+    text alignments file, a binary kaldi int32 vector archive, or a kaldi
+    rspecifier "ark:..." or "scp:..." (see kaldi_ark); archives are read
+    directly, without conversion to text.
+  '''
+  kind, path = parse_rspecifier(ali)
+  if kind == "scp":
+    for block in iter_vector_blocks(iter_vectors(ali)):
+      yield parse_vectors(block,sym2phone=sym2phone)
+    return
+
+  with open_file(path,"rb") as fp:
+    if is_binary_ark(fp):
+      for block in iter_vector_blocks(ArkReader(fp)):
+        yield parse_vectors(block,sym2phone=sym2phone)
+    else:
+      for block in read_blocks(fp):
+        yield parse_ali_block(block,sym2phone=sym2phone)
+
+def iter_ali_blocks(ali,block_size=ALI_BLOCK_SIZE):
+  '''
+    Usage: iter_ali_blocks(ali,block_size=ALI_BLOCK_SIZE)
+
+    Yields the alignments file in blocks (bytes) of whole lines of about
+    block_size bytes.
+  '''
+  with open_file(ali,"rb") as fp:
+    for block in read_blocks(fp,block_size=block_size):
+      yield block
+
+def read_blocks(fp,block_size=ALI_BLOCK_SIZE):
+  '''
+    Usage: read_blocks(fp,block_size=ALI_BLOCK_SIZE)
+
+    Yields the binary stream fp in blocks of whole lines, see
+    iter_ali_blocks.
+  '''
+  rest = b""
+  while True:
+    block = fp.read(block_size)
+    if not block:
+      break
+    block = rest + block
+    cut = block.rfind(b"\n") + 1
+    rest = block[cut:]
+    if cut > 0:
+      yield block[:cut]
+  if rest:
+    yield rest
+
+def iter_ali_corpus(ali,sym2phone=None):
+  '''
+    Usage: iter_ali_corpus(ali,sym2phone=None)
+
+    Reads the alignments once and yields a SegmentCorpus of each block of
+    utterances (see iter_ali_parts), in file order. A repeated utterance
+    appears in utt_ids as often as in the file.
+  '''
+  for utt_ids,counts,frames,labels,symbols in iter_ali_parts(ali,sym2phone=sym2phone):
+    offsets = np.concatenate(([0],np.cumsum(counts))).astype(np.int64)
+    yield SegmentCorpus(utt_ids,offsets,frames[:,0].copy(),frames[:,1].copy(),labels,symbols)
+
+def iter_ali2python(ali,sym2phone=None):
+  '''
+    Usage: iter_ali2python(ali,sym2phone=None)
+
+    Generator version of ali2python. Reads the alignments file once, one
+    block of lines at a time, and yields (utt, [(start, end, sym), ...]) for
+    each utterance in file order, so memory does not grow with the size of
+    the file.
+
+    Inputs:
+      ali -- path to alignments file, or kaldi archive (see iter_ali_parts)
+      sym2phone -- optional mapping applied to every symbol before the
+                   segments are formed
+  '''
+  for corpus in iter_ali_corpus(ali,sym2phone=sym2phone):
+    offsets = corpus.offsets.tolist()
+    for i,utt in enumerate(corpus.utt_ids):
+      yield utt, list(SegmentList(corpus,offsets[i],offsets[i+1]))
+
+def ali2corpus(ali,sym2phone=None):
+  '''
+    Usage: ali2corpus(ali,sym2phone=None)
+
+    Reads the alignments file into a SegmentCorpus, the columnar version of
+    ali2python.
+  '''
+  parts = list(iter_ali_parts(ali,sym2phone=sym2phone))
+  return merge_mlf_parts(parts or [parse_ali_block(b"")])
+
 def ali2python(ali):
   '''
     Usage: ali2python(ali)
 
     Inputs:
-      ali -- path to alignments file
+      ali -- path to alignments file, or kaldi archive (see iter_ali_parts)
 
     Outputs:
       files -- python object representing alignments files.
@@ -78,43 +369,31 @@ def ali2python(ali):
                utt2: [(start, end, sym), (start, end, sym), ...],
                ... }
   '''
-  with codecs.open(ali,"r","utf-8") as fp:
-    phone2tok = {}
-    tok = 0
-    for line in fp:
-      line_vals = line.strip().split(" ")
-      for lv in line_vals[1:]:
-        try:
-          if(phone2tok[lv]):
-            continue 
-        except:
-          phone2tok[lv] = tok
-          tok += 1
-  
-  sym2phone = {sym:sym for sym in phone2tok.keys()}
-  tok2phone = {phone2tok[p]:p for p in phone2tok.keys()}
-        
-  # Convert utterances to nicer data structure we can work with
-  utterances = {}
-  with codecs.open(ali,"r","utf-8") as fp:
-    for line in fp:
-      line_vals = line.strip().split(" ")
-      utterances[line_vals[0]] = [phone2tok[sym2phone[i]] for i in line_vals[1:]]
+  return dict(iter_ali2python(ali))
 
-  # Write MLF output
-  files = {}
-  num_utts = len(utterances.keys())
-  for utt_i,utt in enumerate(sorted(utterances.keys())):
-    files[utt] = []
-    first = np.nonzero(np.hstack((True,(np.diff(utterances[utt]) != 0),True)))[0]
-    seg_len = np.diff(first)
-    first = first[0:-1]
-    last = first + seg_len
-    
-    for i in range(len(first)):
-      files[utt].append((first[i], last[i], tok2phone[utterances[utt][first[i]]]))
-  
-  return files
+def write_mlf(fp,corpus,ext="ALI"):
+  '''
+    Usage: write_mlf(fp,corpus,ext="ALI")
+
+    Writes every utterance of the SegmentCorpus corpus, in the order of
+    corpus.utt_ids, to the open file fp as mlf records (without the
+    "#!MLF!#" header). The segment lines of all utterances are formatted
+    together from the arrays of the corpus, and each record is written with
+    a single call.
+  '''
+  if len(corpus.utt_ids) == 0:
+    return
+  max_frame = max(int(corpus.ends.max()),int(corpus.starts.max())) if len(corpus.ends) > 0 else 0
+  times = np.array(["%d" % (t * 100000) for t in range(max_frame + 1)],dtype=object)
+  symbols = np.empty(len(corpus.symbols),dtype=object)
+  symbols[:] = corpus.symbols
+  lines = [" ".join(seg) for seg in zip(times[corpus.starts].tolist(),times[corpus.ends].tolist(),
+                                        symbols[corpus.labels].tolist())]
+  offsets = np.asarray(corpus.offsets).tolist()
+  for i,utt in enumerate(corpus.utt_ids):
+    begin, end = offsets[i], offsets[i+1]
+    body = "\n".join(lines[begin:end]) + "\n" if end > begin else ""
+    fp.write("\"*/%s.%s\"\n%s.\n" % (utt,ext,body))
 
 def python2mlf(files,mlf,ext="ALI"):
   '''
@@ -126,9 +405,15 @@ def python2mlf(files,mlf,ext="ALI"):
       files -- python structure (see ali2python)
       mlf -- output mlf file
       ext -- extension added to each utt_id (default = "ALI")
+
+    A SegmentCorpus is written in bulk with write_mlf.
   '''
-  with codecs.open(mlf,"w","utf-8") as fp:
+  with open_file(mlf,"w") as fp:
     fp.write("#!MLF!#\n")
+    if isinstance(files,SegmentCorpus):
+      order = sorted(range(len(files.utt_ids)),key=files.utt_ids.__getitem__)
+      write_mlf(fp,files.take(order),ext=ext)
+      return
     for utt in sorted(files.keys()): 
       fp.write('"*/%s.%s"\n' % (utt,ext))
       for seg in files[utt]:
@@ -137,22 +422,123 @@ def python2mlf(files,mlf,ext="ALI"):
 
 def python2ali(files,ali):
   '''
-    Usage: python2ali(files,mlf,ext="ALI")
+    Usage: python2ali(files,ali)
 
     Converts python structure storing utterance information to an alignment file.
 
     Inputs:
-      files -- python structure (see ali2python)
+      files -- python structure (see ali2python) or SegmentCorpus
       ali -- output ali file
   '''
+  corpus = files if isinstance(files,SegmentCorpus) else python2corpus(files)
+  order = sorted(range(len(corpus.utt_ids)),key=corpus.utt_ids.__getitem__)
+  with open_file(ali,"w") as fp:
+    write_ali(fp,corpus.take(order))
 
-  with codecs.open(ali,"w","utf-8") as fp:
-    for utt in sorted(files.keys()):
-      fp.write("%s " % utt)
-      for seg in files[utt]:
-        seg_len = seg[1] - seg[0]
-        fp.write("%s " % (" ".join([seg[2]]*seg_len)))
-      fp.write("\n")
+def write_ali(fp,corpus,strip=False):
+  '''
+    Usage: write_ali(fp,corpus,strip=False)
+
+    Writes every utterance of the SegmentCorpus corpus, in the order of
+    corpus.utt_ids, to the open file fp as a line of the alignments file
+
+    utt_id sym sym sym ...
+
+    with every label repeated for each frame of its segment. Every label is
+    followed by a space, as python2ali writes them, unless strip is set.
+    Segments are expanded by string repetition, one python object per
+    segment, and the lines are written WRITE_BATCH utterances at a time.
+  '''
+  symbols = [sym + " " for sym in corpus.symbols]
+  offsets = np.asarray(corpus.offsets).tolist()
+  for b in range(0,len(corpus.utt_ids),WRITE_BATCH):
+    e = min(b + WRITE_BATCH,len(corpus.utt_ids))
+    seg = slice(offsets[b],offsets[e])
+    lengths = (np.asarray(corpus.ends[seg],dtype=np.int64) - corpus.starts[seg]).tolist()
+    # An empty segment still writes its separator, as python2ali always did
+    segs = [symbols[l] * n if n > 0 else " " for l,n in zip(corpus.labels[seg].tolist(),lengths)]
+    lines = []
+    for i in range(b,e):
+      line = "%s %s" % (corpus.utt_ids[i],"".join(segs[offsets[i] - offsets[b]:offsets[i+1] - offsets[b]]))
+      lines.append(line.rstrip(" ") if strip else line)
+    fp.write("\n".join(lines) + "\n")
+
+def base_phone(phone):
+  '''
+    Usage: base_phone(phone)
+
+    Strips the kaldi word position suffix (_B, _E, _I, _S) from phone.
+  '''
+  return phone if len(phone.split("_")) == 1 else "_".join(phone.split("_")[0:-1])
+
+def read_symbol_map(path,new_sym=None):
+  '''
+    Usage: read_symbol_map(path,new_sym=None)
+
+    Reads a mapping file formatted as
+
+    new_sym1 old_sym1
+    new_sym2 old_sym2
+    ...
+
+    (a kaldi phones.txt maps integers to phones this way) and returns the
+    dict {old_sym: new_sym}. If given, new_sym is applied to every new
+    symbol, e.g. base_phone.
+  '''
+  sym_map = {}
+  with open_file(path) as fp:
+    for l in fp:
+      line_vals = l.strip().split(" ")
+      sym_map[line_vals[1]] = line_vals[0] if new_sym is None else new_sym(line_vals[0])
+  return sym_map
+
+def compile_symbol_map(sym_map,symbols):
+  '''
+    Usage: compile_symbol_map(sym_map,symbols)
+
+    Compiles the mapping sym_map {old_sym: new_sym} against the symbol table
+    symbols of a SegmentCorpus. Returns (table, new_symbols), where the
+    integer label l becomes table[l], an index into new_symbols (in order of
+    first appearance). Raises KeyError for a symbol missing from sym_map.
+  '''
+  new_ids = {}
+  table = np.array([new_ids.setdefault(sym_map[sym],len(new_ids)) for sym in symbols],dtype=np.int32)
+  new_symbols = [None] * len(new_ids)
+  for sym,i in new_ids.items():
+    new_symbols[i] = sym
+  return table, new_symbols
+
+def merge_segments(corpus):
+  '''
+    Usage: merge_segments(corpus)
+
+    Returns a new SegmentCorpus where adjacent segments of an utterance with
+    the same label, the second one starting where the first one ends, are
+    joined into one.
+  '''
+  starts = np.asarray(corpus.starts,dtype=np.int64)
+  ends = np.asarray(corpus.ends,dtype=np.int64)
+  # Segments separated by a gap get different keys even with equal labels
+  gaps = np.concatenate(([0],np.cumsum(starts[1:] != ends[:-1])))
+  keys = gaps * max(len(corpus.symbols),1) + corpus.labels
+  first, last, offsets = batch_runs(keys,corpus.offsets)
+  return SegmentCorpus(corpus.utt_ids,offsets.astype(np.int64),corpus.starts[first],
+                       corpus.ends[last - 1],corpus.labels[first],corpus.symbols)
+
+def remap_corpus(corpus,sym_map,merge=True):
+  '''
+    Usage: remap_corpus(corpus,sym_map,merge=True)
+
+    Returns a new SegmentCorpus with the labels of corpus mapped through
+    sym_map {old_sym: new_sym}. The mapping is compiled to an integer table
+    and applied to all segments with a single take. With merge, segments
+    that a many-to-1 mapping leaves next to each other with the same label
+    are joined (see merge_segments).
+  '''
+  table, symbols = compile_symbol_map(sym_map,corpus.symbols)
+  remapped = SegmentCorpus(corpus.utt_ids,corpus.offsets,corpus.starts,corpus.ends,
+                           table.take(corpus.labels),symbols)
+  return merge_segments(remapped) if merge else remapped
 
 def change_phones(files,phones):
   '''
@@ -169,17 +555,23 @@ def change_phones(files,phones):
     So that the mapping is 1-to-1 or many-to-1, but never 1-many.
 
     Inputs:
-      files -- python structure containing mlf-like data for all utterances
+      files -- python structure containing mlf-like data for all utterances,
+               or SegmentCorpus
       phones -- path to file defining new mapping
 
-    Function operates on the first input argument.
+    Function operates on the first input argument. The labels of a
+    SegmentCorpus are remapped in place with one take (see remap_corpus,
+    which also merges the segments).
   ''' 
   # Get phone mapping
-  with codecs.open(phones,"r","utf-8") as fp:
-    old2new = {}
-    for l in fp:
-      line_vals = l.strip().split(" ")
-      old2new[line_vals[1]] = line_vals[0]
+  old2new = read_symbol_map(phones)
+
+  if isinstance(files,SegmentCorpus):
+    table, symbols = compile_symbol_map(old2new,files.symbols)
+    files.labels = table.take(files.labels)
+    files.symbols = symbols
+    files.symbol_ids = {sym:i for i,sym in enumerate(symbols)}
+    return
 
   for utt in files.keys():
     segs = []
@@ -213,66 +605,31 @@ def ali2mlf(ali,mlf,phones=None,ext="ALI"):
     0 2100000 a4
 
     Input:
-      ali -- rspecifier kaldi type ali file described above
+      ali -- rspecifier kaldi type ali file described above, or a
+             binary kaldi archive, "ark:..." or "scp:..." (see
+             iter_ali_parts)
       mlf -- wspecifer mlf output file
       phones -- path to mapping from symbol set to integers used in ali
       ext -- extension to use for utterance name (default = "ALI")
              we only use this to be consisent in how we make the mlf files
              for compatibility with other scripts.
-      
+
+    The ali file is read once, one block of lines at a time, and every block
+    is written as soon as it is segmented (see parse_ali_block and
+    write_mlf), so the mlf follows the order of the ali file (kaldi writes
+    them sorted).
   '''
   # Getting mapping from integers to context independent phones
+  sym2phone = None
   if phones:
-    with codecs.open(phones,"r","utf-8") as fp:
-      sym2phone = {}
-      for line in fp:
-        [phone,phone_int] = line.strip().split(" ")
-        if len(phone.split("_")) == 1:
-          sym2phone[phone_int] = phone
-        else:
-          sym2phone[phone_int] = "_".join(phone.split("_")[0:-1]) 
+    sym2phone = read_symbol_map(phones,new_sym=base_phone)
 
-    phone2tok = {int2phone[p]:i for i,p in enumerate(int2phone.keys())}
-    tok2phone = {phone2tok[p]:p for p in phone2tok.keys()}
-  else:
-    with codecs.open(ali,"r","utf-8") as fp:
-      phone2tok = {}
-      tok = 0
-      for line in fp:
-        line_vals = line.strip().split(" ")
-        for lv in line_vals[1:]:
-          try:
-            if(phone2tok[lv]):
-              continue 
-          except:
-            phone2tok[lv] = tok
-            tok += 1
-    
-    sym2phone = {sym:sym for sym in phone2tok.keys()}
-    tok2phone = {phone2tok[p]:p for p in phone2tok.keys()}
-        
-  # Convert utterances to nicer data structure we can work with
-  utterances = {}
-  with codecs.open(ali,"r","utf-8") as fp:
-    for line in fp:
-      line_vals = line.strip().split(" ")
-      utterances[line_vals[0]] = [phone2tok[sym2phone[i]] for i in line_vals[1:]]
-
-  # Write MLF output
-  with open(mlf,"w") as fp:
+  # Write MLF output one block of utterances at a time, in the order of the
+  # ali file
+  with open_file(mlf,"w") as fp:
     fp.write("#!MLF!#\n")
-    num_utts = len(utterances.keys())
-    for utt_i,utt in enumerate(sorted(utterances.keys())):
-      fp.write("\"*/%s.%s\"\n" % (utt,ext))
-      first = np.nonzero(np.hstack((True,(np.diff(utterances[utt]) != 0),True)))[0]
-      seg_len = np.diff(first)
-      first = first[0:-1]
-      last = first + seg_len
-
-      for i in range(len(first)):
-        fp.write(str(first[i]*100000) + " " + str(last[i]*100000) + " " + str(tok2phone[utterances[utt][first[i]]]) + "\n")
-
-      fp.write(".\n")
+    for corpus in iter_ali_corpus(ali,sym2phone=sym2phone):
+      write_mlf(fp,corpus,ext=ext)
 
 def mlf2ali(mlf,ali):
   '''
@@ -286,8 +643,8 @@ def mlf2ali(mlf,ali):
     Input: mlf - rspecifer mlf file
            ali - wspecifer ali file
   '''
-  with open(mlf,"r") as fp:
-    with open(ali,"w") as fo:
+  with open_file(mlf) as fp:
+    with open_file(ali,"w") as fo:
       utt = []
       for l in fp:
         line = l.strip()
@@ -302,10 +659,11 @@ def mlf2ali(mlf,ali):
           else:
             utt.append(line.split(" ")[2]) 
 
-def mlf2python(filename):
+def mlf2python(filename,jobs=1):
   '''
-    Usage: mlf2python(filename)
+    Usage: mlf2python(filename,jobs=1)
       filename -- mlf file
+      jobs -- number of processes parsing the file in parallel
 
     Converts the mlf file into a dictionary. Each key is utterance id. The value
     corresponding to each key is a list of segments. Each segment has 3 values.
@@ -314,10 +672,15 @@ def mlf2python(filename):
   
     output:
       files = {utt1 : [ [0 11 'SIL'], [12 15 'H'], [16 25 'A'], [26 30 'H'], [31 41 'A'] ], utt2 : ...}
+
+    The binary sidecar of the file (see mlf2bin) is read instead when it is
+    newer than the file.
   '''
+  if jobs > 1 or is_fresh(sidecar(filename),filename):
+    return {utt:list(segs) for utt,segs in mlf2corpus(filename,jobs=jobs).items()}
 
   files = {}
-  with open(filename,"r") as fp:
+  with open_file(filename) as fp:
     lines = []
     for line in fp:
       if(not line.strip() == "#!MLF!#" and not line.strip() == "."):
@@ -331,6 +694,773 @@ def mlf2python(filename):
         lines = []
   return files
 
+class SegmentList(Sequence):
+  '''
+    Read only view of the segments of one utterance of a SegmentCorpus. It
+    behaves as the list [(start, end, label), ...] of mlf2python. Iterating
+    reads the arrays of the corpus directly; the first indexing builds the
+    list of the utterance, which is kept as long as the view.
+  '''
+  def __init__(self,corpus,begin,end):
+    self.corpus = corpus
+    self.begin = begin
+    self.end = end
+    self.items = None
+
+  def __getitem__(self,i):
+    if self.items is None:
+      self.items = list(self)
+    return self.items[i]
+
+  def __iter__(self):
+    c, seg = self.corpus, slice(self.begin,self.end)
+    symbols = c.symbols
+    for start,end,label in zip(c.starts[seg].tolist(),c.ends[seg].tolist(),c.labels[seg].tolist()):
+      yield (start, end, symbols[label])
+
+  def __len__(self):
+    return self.end - self.begin
+
+  def __eq__(self,other):
+    return list(self) == list(other)
+
+  def __ne__(self,other):
+    return not self == other
+
+  def __repr__(self):
+    return repr(list(self))
+
+class SegmentCorpus(Mapping):
+  '''
+    Columnar store of the segments of an mlf. All segments are kept in flat
+    arrays, the segments of the i-th utterance being those in
+    offsets[i]:offsets[i+1]:
+
+      starts, ends -- int32 first and last (exclusive) frame of each segment
+      labels       -- int32 index of the label of each segment in symbols
+      offsets      -- int64 (num_utts + 1) first segment of each utterance
+
+    The corpus behaves as the dictionary {utt: [(start, end, label), ...]}
+    returned by mlf2python, where each value is a SegmentList view, so it
+    can be passed to align and the scoring functions as is. Vectorized code
+    can use segments(utt) to get the arrays of an utterance directly.
+  '''
+  def __init__(self,utt_ids,offsets,starts,ends,labels,symbols):
+    self.utt_ids = utt_ids
+    self.utt_index = {u:i for i,u in enumerate(utt_ids)}
+    self.offsets = offsets
+    self.starts = starts
+    self.ends = ends
+    self.labels = labels
+    self.symbols = symbols
+    self.symbol_ids = {sym:i for i,sym in enumerate(symbols)}
+
+  def segments(self,utt):
+    '''
+      Returns the arrays (starts, ends, labels) of the utterance utt.
+    '''
+    i = self.utt_index[utt]
+    seg = slice(self.offsets[i],self.offsets[i+1])
+    return self.starts[seg], self.ends[seg], self.labels[seg]
+
+  def frames(self,utt):
+    '''
+      Returns the int32 label of every frame of the utterance utt, each
+      segment repeated end - start times.
+    '''
+    starts, ends, labels = self.segments(utt)
+    return np.repeat(labels,np.maximum(np.asarray(ends,dtype=np.int64) - starts,0))
+
+  def frame_array(self):
+    '''
+      Returns (frames, frame_offsets), the frames of all utterances as one
+      int32 label array, those of the i-th utterance being
+      frames[frame_offsets[i]:frame_offsets[i+1]].
+    '''
+    lengths = np.maximum(np.asarray(self.ends,dtype=np.int64) - self.starts,0)
+    frame_offsets = np.concatenate(([0],np.cumsum(lengths)))[np.asarray(self.offsets)]
+    return np.repeat(self.labels,lengths), frame_offsets
+
+  def take(self,indices):
+    '''
+      Returns a new SegmentCorpus holding the utterances at the positions
+      indices, in that order. The symbol table is shared.
+    '''
+    indices = np.asarray(indices,dtype=np.int64)
+    begin = np.asarray(self.offsets[indices],dtype=np.int64)
+    counts = np.asarray(self.offsets[indices + 1],dtype=np.int64) - begin
+    offsets = np.concatenate(([0],np.cumsum(counts))).astype(np.int64)
+    segs = np.repeat(begin - offsets[:-1],counts) + np.arange(offsets[-1])
+    return SegmentCorpus([self.utt_ids[i] for i in indices],offsets,self.starts[segs],
+                         self.ends[segs],self.labels[segs],self.symbols)
+
+  def subset(self,utts):
+    '''
+      Returns a new SegmentCorpus with only the utterances utts that are in
+      this one, in file order.
+    '''
+    return self.take(sorted(self.utt_index[u] for u in set(utts) if u in self.utt_index))
+
+  def __getitem__(self,utt):
+    i = self.utt_index[utt]
+    return SegmentList(self,int(self.offsets[i]),int(self.offsets[i+1]))
+
+  def __iter__(self):
+    return iter(self.utt_ids)
+
+  def __len__(self):
+    return len(self.utt_ids)
+
+  def __contains__(self,utt):
+    return utt in self.utt_index
+
+def python2corpus(files):
+  '''
+    Usage: python2corpus(files)
+
+    Builds the SegmentCorpus of the python structure files (see
+    mlf2python), keeping the order of files.keys().
+  '''
+  utt_ids = list(files.keys())
+  counts = [len(files[utt]) for utt in utt_ids]
+  segs = [seg for utt in utt_ids for seg in files[utt]]
+  symbol_ids = {}
+  labels = [symbol_ids.setdefault(seg[2],len(symbol_ids)) for seg in segs]
+  symbols = [None] * len(symbol_ids)
+  for sym,i in symbol_ids.items():
+    symbols[i] = sym
+  offsets = np.concatenate(([0],np.cumsum(counts))).astype(np.int64)
+  return SegmentCorpus(utt_ids,offsets,np.array([seg[0] for seg in segs],dtype=np.int32),
+                       np.array([seg[1] for seg in segs],dtype=np.int32),
+                       np.array(labels,dtype=np.int32),symbols)
+
+def mlf2corpus(filename,keys=None,jobs=1):
+  '''
+    Usage: mlf2corpus(filename,keys=None,jobs=1)
+      filename -- mlf file
+      keys -- if given, only these utterances are read (see load_index)
+      jobs -- number of processes parsing chunks of the file in parallel
+
+    Reads the mlf file into a SegmentCorpus, the columnar version of
+    mlf2python. Times are converted to frames as in mlf2python, and
+    utterances keep the order of the file (a repeated utterance keeps its
+    last segments, as in mlf2python). The corpus is the same for any
+    number of jobs.
+
+    If the binary sidecar of the file (see mlf2bin) is newer than the file,
+    the corpus is memory mapped from the sidecar instead. filename can also
+    be "-" or a compressed file (see fileio.open_file), which is then read
+    serially.
+  '''
+  if filename.endswith(MLFB_EXT) or is_fresh(sidecar(filename),filename):
+    corpus = load_bin(filename if filename.endswith(MLFB_EXT) else sidecar(filename))
+    return corpus if keys is None else corpus.subset(keys)
+
+  # Compressed files and stdin can only be read from start to end
+  plain = is_plain(filename)
+  if jobs > 1 and plain:
+    corpus = merge_mlf_parts(map_chunks(_parse_mlf_chunk,filename,jobs))
+    return corpus if keys is None else corpus.subset(keys)
+  if keys is not None and not plain:
+    return mlf2corpus(filename).subset(keys)
+  with closing(open_file(filename) if keys is None else iter_records(filename,keys)) as lines:
+    return merge_mlf_parts([parse_mlf_lines(lines)])
+
+def parse_mlf_lines(lines):
+  '''
+    Usage: parse_mlf_lines(lines)
+
+    Parses the lines of (part of) an mlf file, where every utterance is
+    complete. Returns (utt_ids, counts, frames, labels, symbols): the
+    utterances and their number of segments, the (num_segs, 2) int32 start
+    and end frames, and the int32 label of each segment as an index into
+    symbols, which lists the labels in order of first appearance.
+  '''
+  utt_ids = []
+  counts = []
+  symbol_ids = {}
+  times, labels = [], []
+  frames, label_arrays = [], []
+
+  # Times go through float exactly as in mlf2python. They are converted in
+  # chunks so that only a bounded number of python strings is alive.
+  def flush():
+    frames.append((np.array(times,dtype=float) / 100000.0).astype(np.int32).reshape(-1,2))
+    label_arrays.append(np.array(labels,dtype=np.int32))
+    del times[:], labels[:]
+
+  num_segs = 0
+  for line in lines:
+    line = line.strip()
+    if line == "#!MLF!#":
+      continue
+    if line == ".":
+      utt_ids.append(utterance)
+      counts.append(num_segs)
+      num_segs = 0
+    elif line.startswith('"'):
+      utterance = line.split(".")[0].split("/")[1]
+    else:
+      [start, stop, label] = line.split(" ")
+      times.append(start)
+      times.append(stop)
+      labels.append(symbol_ids.setdefault(label,len(symbol_ids)))
+      num_segs += 1
+      if len(labels) == 100000:
+        flush()
+  flush()
+
+  symbols = [None] * len(symbol_ids)
+  for sym,i in symbol_ids.items():
+    symbols[i] = sym
+  return utt_ids, counts, np.concatenate(frames), np.concatenate(label_arrays), symbols
+
+def merge_mlf_parts(parts):
+  '''
+    Usage: merge_mlf_parts(parts)
+
+    Builds the SegmentCorpus of consecutive parts of an mlf file, each one
+    parsed by parse_mlf_lines. The labels of every part are mapped to one
+    symbol table, in order of first appearance in the file.
+  '''
+  utt_ids, counts, labels = [], [], []
+  symbol_ids = {}
+  for part_utts,part_counts,_,part_labels,part_symbols in parts:
+    utt_ids.extend(part_utts)
+    counts.extend(part_counts)
+    to_global = np.array([symbol_ids.setdefault(sym,len(symbol_ids)) for sym in part_symbols],dtype=np.int32)
+    labels.append(to_global[part_labels] if len(part_labels) > 0 else part_labels)
+
+  frames = np.concatenate([part[2] for part in parts])
+  offsets = np.concatenate(([0],np.cumsum(counts))).astype(np.int64)
+  symbols = [None] * len(symbol_ids)
+  for sym,i in symbol_ids.items():
+    symbols[i] = sym
+  corpus = SegmentCorpus(utt_ids,offsets,frames[:,0].copy(),frames[:,1].copy(),
+                         np.concatenate(labels),symbols)
+  
+  # Repeated utterances are rare, drop all but their last copy
+  if len(corpus.utt_index) < len(utt_ids):
+    corpus = corpus.take(sorted(corpus.utt_index.values()))
+  return corpus
+
+def _parse_mlf_chunk(chunk):
+  return parse_mlf_lines(read_chunk(*chunk))
+
+def split_chunks(filename,num_chunks):
+  '''
+    Usage: split_chunks(filename,num_chunks)
+
+    Splits the mlf file into about num_chunks byte ranges [(start, end), ...]
+    of whole utterances, each chunk ending before a "*/utt..." header line.
+  '''
+  size = os.path.getsize(filename)
+  bounds = [0]
+  with open(filename,"rb") as fp:
+    for i in range(1,num_chunks):
+      fp.seek(max(size * i // num_chunks,bounds[-1]))
+      # Skip to the start of the next full line
+      fp.readline()
+      while True:
+        pos = fp.tell()
+        line = fp.readline()
+        if not line or line.startswith(b'"'):
+          fp.seek(pos)
+          break
+      bounds.append(fp.tell())
+  bounds.append(size)
+  return [(s,e) for s,e in zip(bounds[:-1],bounds[1:]) if e > s]
+
+def read_chunk(filename,start,end):
+  '''
+    Usage: read_chunk(filename,start,end)
+
+    Returns the lines in bytes start to end of the file, see split_chunks.
+  '''
+  with open(filename,"rb") as fp:
+    fp.seek(start)
+    lines = _decode(fp.read(end - start)).split("\n")
+  if lines[-1] == "":
+    lines.pop()
+  return lines
+
+def map_chunks(func,filename,jobs):
+  '''
+    Usage: map_chunks(func,filename,jobs)
+
+    Applies func to every (filename, start, end) chunk of the file (see
+    split_chunks) in a pool of jobs processes, and returns the results in
+    file order.
+  '''
+  chunks = [(filename,s,e) for s,e in split_chunks(filename,4 * jobs)]
+  pool = multiprocessing.Pool(jobs)
+  try:
+    return pool.map(func,chunks,chunksize=1)
+  finally:
+    pool.close()
+    pool.join()
+
+# Utterance index of an mlf or ali file, stored next to it as FILE.idx with
+# one line per utterance
+#
+#   utt_id byte_offset byte_length
+#
+# covering the line of the utterance in an ali file, and its lines from the
+# "*/utt_id..." header to the closing "." in an mlf file.
+INDEX_EXT = ".idx"
+
+def build_index(filename):
+  '''
+    Usage: build_index(filename)
+
+    Scans the mlf or ali file filename once, writes its utterance index and
+    returns it as {utt_id: (byte_offset, byte_length)}. The index file is
+    only renamed into place once the whole index has been built; if it
+    cannot be written (e.g. a read only directory), the index is only
+    returned.
+  '''
+  index = {}
+  with open(filename,"rb") as fp:
+    is_mlf = fp.readline().strip() == b"#!MLF!#"
+    offset = fp.tell() if is_mlf else 0
+    fp.seek(offset)
+    for line in fp:
+      if not is_mlf:
+        if line.strip():
+          index[line.strip().split(b" ")[0]] = (offset, len(line))
+      elif line.startswith(b'"'):
+        utterance, begin = line.strip().split(b".")[0].split(b"/")[1], offset
+      elif line.strip() == b".":
+        index[utterance] = (begin, offset + len(line) - begin)
+      offset += len(line)
+
+  lines = [u + (" %d %d\n" % (offset,length)).encode("ascii")
+           for u,(offset,length) in sorted(index.items(),key=lambda x:x[1])]
+  index = {_decode(u):v for u,v in index.items()}
+
+  tmp = filename + INDEX_EXT + ".tmp"
+  try:
+    with open(tmp,"wb") as fp:
+      fp.writelines(lines)
+    os.rename(tmp,filename + INDEX_EXT)
+  except (IOError,OSError) as e:
+    if e.errno not in (errno.EACCES,errno.EROFS,errno.EPERM):
+      raise
+    try:
+      os.remove(tmp)
+    except OSError:
+      pass
+  return index
+
+def load_index(filename):
+  '''
+    Usage: load_index(filename)
+
+    Returns the utterance index {utt_id: (byte_offset, byte_length)} of the
+    mlf or ali file filename. The index is read from FILE.idx, and built
+    first if it is missing or older than the file.
+  '''
+  if not is_fresh(filename + INDEX_EXT,filename):
+    return build_index(filename)
+  index = {}
+  with open(filename + INDEX_EXT,"rb") as fp:
+    for line in fp:
+      u,offset,length = line.split()
+      index[_decode(u)] = (int(offset),int(length))
+  return index
+
+def is_indexable(path):
+  '''
+    Usage: is_indexable(path)
+
+    True if path is a plain mlf or text ali file on disk, which load_index
+    can index. Compressed files, stdin, binary sidecars and kaldi archives
+    have to be read whole (see read_utterances).
+  '''
+  return is_plain(path) and not path.endswith(MLFB_EXT) and not is_ark(path)
+
+def iter_records(filename,keys):
+  '''
+    Usage: iter_records(filename,keys)
+
+    Yields the lines of the utterances keys of the mlf or ali file filename
+    (see load_index), reading only those parts of the file. Utterances are
+    read in file order, and keys not in the file are skipped.
+  '''
+  index = load_index(filename)
+  with open(filename,"rb") as fp:
+    for offset,length in sorted(index[u] for u in set(keys) if u in index):
+      fp.seek(offset)
+      for line in _decode(fp.read(length)).splitlines(True):
+        yield line
+
+def read_utterances(path):
+  '''
+    Usage: read_utterances(path)
+
+    Reads all utterances of an ali or mlf file, or kaldi archive, in one
+    pass, as ali2dict or mlf2python would. Unlike load_utterances, path can
+    be "-" or compressed (see fileio.open_file).
+  '''
+  if path.endswith(MLFB_EXT):
+    return {utt:list(segs) for utt,segs in load_bin(path).items()}
+  if is_ark(path):
+    return ali2dict(path)
+  with open_file(path) as fp:
+    first = fp.readline()
+    if first.strip() == "#!MLF!#":
+      corpus = merge_mlf_parts([parse_mlf_lines(chain([first],fp))])
+      return {utt:list(segs) for utt,segs in corpus.items()}
+    ali_dict = {}
+    for l in chain([first],fp):
+      if l.strip():
+        l_vals = l.strip().split(" ")
+        ali_dict[l_vals[0]] = " ".join(l_vals[1:])
+    return ali_dict
+
+def load_utterances(path,keys=None):
+  '''
+    Usage: load_utterances(path,keys=None)
+
+    Reads only the utterances keys (all if None) of an ali or mlf file
+    through its index. Returns them as ali2dict or mlf2python would,
+    restricted to the keys found in the file. Files that cannot be indexed
+    (see is_indexable) are read whole with read_utterances.
+  '''
+  if not is_indexable(path):
+    utterances = read_utterances(path)
+    if keys is None:
+      return utterances
+    return {utt:utterances[utt] for utt in keys if utt in utterances}
+  if keys is None:
+    keys = list(load_index(path).keys())
+
+  with open(path,"rb") as fp:
+    is_mlf = fp.readline().strip() == b"#!MLF!#"
+  if is_mlf:
+    corpus = mlf2corpus(path,keys=keys)
+    return {utt:list(segs) for utt,segs in corpus.items()}
+  
+  ali_dict = {}
+  for l in iter_records(path,keys):
+    l_vals = l.strip().split(" ")
+    ali_dict[l_vals[0]] = " ".join(l_vals[1:])
+  return ali_dict
+
+# Binary sidecar (.mlfb) of an mlf file, version 1. All numbers are little
+# endian. The header is
+#
+#   magic "MLFB", uint32 version,
+#   uint64 num_utts, num_segs, num_symbols, utt_bytes, symbol_bytes
+#
+# followed by the utterance ids and the symbols, utf-8 encoded and separated
+# by newlines (utt_bytes and symbol_bytes long). After padding to a multiple
+# of 8 bytes come the arrays of a SegmentCorpus: int64 offsets
+# (num_utts + 1), then int32 starts, ends and labels (num_segs each).
+MLFB_EXT = ".mlfb"
+MLFB_MAGIC = b"MLFB"
+MLFB_VERSION = 1
+MLFB_HEADER = struct.Struct("<4sI5Q")
+
+def sidecar(filename):
+  '''
+    Usage: sidecar(filename)
+
+    Returns the path of the binary sidecar of the mlf file filename.
+  '''
+  return os.path.splitext(filename)[0] + MLFB_EXT
+
+def is_fresh(mlfb,filename):
+  '''
+    Usage: is_fresh(mlfb,filename)
+
+    True if the sidecar mlfb exists and is newer than the mlf file filename.
+  '''
+  return os.path.exists(mlfb) and os.path.getmtime(mlfb) >= os.path.getmtime(filename)
+
+def _join(strings):
+  return b"\n".join(s if isinstance(s,bytes) else s.encode("utf-8") for s in strings)
+
+def _decode(s):
+  # Keep the native str of python 2
+  return s if bytes is str else s.decode("utf-8")
+
+def _split(blob,num):
+  if num == 0:
+    return []
+  return [_decode(s) for s in blob.split(b"\n")]
+
+def save_bin(corpus,mlfb):
+  '''
+    Usage: save_bin(corpus,mlfb)
+
+    Writes the SegmentCorpus corpus to the binary file mlfb. The file is
+    written under a temporary name and then renamed, so readers never see a
+    partial file.
+  '''
+  utts = _join(corpus.utt_ids)
+  symbols = _join(corpus.symbols)
+  header = MLFB_HEADER.pack(MLFB_MAGIC,MLFB_VERSION,len(corpus.utt_ids),len(corpus.starts),
+                            len(corpus.symbols),len(utts),len(symbols))
+  size = len(header) + len(utts) + len(symbols)
+  tmp = mlfb + ".tmp"
+  with open(tmp,"wb") as fp:
+    fp.write(header)
+    fp.write(utts)
+    fp.write(symbols)
+    fp.write(b"\0" * (-size % 8))
+    fp.write(np.asarray(corpus.offsets,dtype="<i8").tobytes())
+    for x in (corpus.starts,corpus.ends,corpus.labels):
+      fp.write(np.asarray(x,dtype="<i4").tobytes())
+  os.rename(tmp,mlfb)
+
+def load_bin(mlfb):
+  '''
+    Usage: load_bin(mlfb)
+
+    Returns the SegmentCorpus stored in the binary file mlfb. The segment
+    arrays are memory mapped, so only the utterance ids and symbols are
+    read up front.
+  '''
+  with open(mlfb,"rb") as fp:
+    header = fp.read(MLFB_HEADER.size)
+    magic,version,num_utts,num_segs,num_symbols,utt_bytes,symbol_bytes = MLFB_HEADER.unpack(header)
+    if magic != MLFB_MAGIC or version != MLFB_VERSION:
+      raise ValueError("%s is not a version %d mlfb file" % (mlfb,MLFB_VERSION))
+    utt_ids = _split(fp.read(utt_bytes),num_utts)
+    symbols = _split(fp.read(symbol_bytes),num_symbols)
+
+  offset = MLFB_HEADER.size + utt_bytes + symbol_bytes
+  offset += -offset % 8
+  offsets = np.memmap(mlfb,dtype="<i8",mode="r",offset=offset,shape=(num_utts + 1,))
+  offset += 8 * (num_utts + 1)
+  arrays = []
+  for i in range(3):
+    arrays.append(np.memmap(mlfb,dtype="<i4",mode="r",offset=offset + 4 * num_segs * i,shape=(num_segs,)))
+  return SegmentCorpus(utt_ids,offsets,arrays[0],arrays[1],arrays[2],symbols)
+
+def mlf2bin(mlf,mlfb=None):
+  '''
+    Usage: mlf2bin(mlf,mlfb=None)
+
+    Converts the mlf file to its binary sidecar mlfb (by default the mlf
+    path with the extension .mlfb), which mlf2corpus and mlf2python then
+    read instead of the mlf while it is newer.
+  '''
+  if mlfb is None:
+    mlfb = sidecar(mlf)
+  save_bin(mlf2corpus(mlf),mlfb)
+
+def bin2mlf(mlfb,mlf,ext="ALI"):
+  '''
+    Usage: bin2mlf(mlfb,mlf,ext="ALI")
+
+    Converts the binary file mlfb back to an mlf file, as python2mlf does.
+  '''
+  python2mlf(load_bin(mlfb),mlf,ext=ext)
+
+def closest_centers(ref_mu,res_mu,ref_offsets=None,res_offsets=None):
+  '''
+    Usage: closest_centers(ref_mu,res_mu,ref_offsets=None,res_offsets=None)
+
+    Returns for every response segment center res_mu[i] the index of the
+    closest reference segment center in ref_mu, the first one on ties, as
+    ((res_mu[i] - ref_mu)**2).argmin() does. With offsets, the centers of
+    many utterances are matched in one call: the i-th utterance has the
+    centers ref_mu[ref_offsets[i]:ref_offsets[i+1]] and
+    res_mu[res_offsets[i]:res_offsets[i+1]], and response centers are only
+    matched within their utterance. Indices are into the whole ref_mu, and
+    -1 where an utterance has no reference segments.
+
+    The references are sorted once and every response center is located
+    with np.searchsorted, comparing only its two neighbours.
+  '''
+  ref_mu = np.asarray(ref_mu,dtype=float)
+  res_mu = np.asarray(res_mu,dtype=float)
+  if ref_offsets is None:
+    ref_offsets, res_offsets = [0,len(ref_mu)], [0,len(res_mu)]
+  num_utts = len(ref_offsets) - 1
+  ref_utt = np.repeat(np.arange(num_utts),np.diff(ref_offsets))
+  res_utt = np.repeat(np.arange(num_utts),np.diff(res_offsets))
+  if len(ref_mu) == 0 or len(res_mu) == 0:
+    return np.full(len(res_mu),-1,dtype=np.int64)
+
+  # Sort by utterance, then center. Each utterance is shifted past the
+  # centers of the previous one, so a single search stays in its block.
+  lo = min(ref_mu.min(),res_mu.min())
+  span = 2.0 * (max(ref_mu.max(),res_mu.max()) - lo) + 2.0
+  keys = ref_utt * span + (ref_mu - lo)
+  if (np.diff(keys) >= 0).all():
+    order = np.arange(len(keys))
+  else:
+    order = np.lexsort((ref_mu,ref_utt))
+    keys = keys[order]
+  queries = res_utt * span + (res_mu - lo)
+
+  right = np.searchsorted(keys,queries,side="left")
+  left = right - 1
+  has_right = right < len(keys)
+  right_c = np.minimum(right,len(keys) - 1)
+  left_c = np.maximum(left,0)
+  has_right &= ref_utt[order[right_c]] == res_utt
+  has_left = (left >= 0) & (ref_utt[order[left_c]] == res_utt)
+  # Equal centers are matched to the first of them
+  left_c = np.searchsorted(keys,keys[left_c],side="left")
+
+  d_left = res_mu - ref_mu[order[left_c]]
+  d_right = ref_mu[order[right_c]] - res_mu
+  tie = has_left & has_right & (d_left == d_right)
+  use_left = has_left & (~has_right | (d_left < d_right))
+  closest = np.where(use_left,order[left_c],order[right_c])
+  closest[tie] = np.minimum(order[left_c[tie]],order[right_c[tie]])
+  closest[~has_left & ~has_right] = -1
+  return closest
+
+def boundary_partitions(ref_starts,ref_ends,ref_offsets,res_starts,res_ends,res_offsets):
+  '''
+    Usage: boundary_partitions(ref_starts,ref_ends,ref_offsets,
+                               res_starts,res_ends,res_offsets)
+
+    Splits every utterance at the union of the start frames of its
+    reference and response segments (the arrays of segment_arrays). Starts
+    between the ends of the two transcriptions, min(end) to max(end)
+    included, are dropped. Returns (ref_index, res_index, offsets): for
+    every partition the index of the last reference and response segment
+    starting at or before it (the last segment of the utterance if there
+    is none), and the offsets of the partitions of each utterance.
+
+    The starts of all utterances are merged at once as sorted (utterance,
+    start) keys and the segments are found with np.searchsorted. Raises ValueError if an utterance has no reference or
+    no response segments.
+  '''
+  ref_offsets = np.asarray(ref_offsets,dtype=np.int64)
+  res_offsets = np.asarray(res_offsets,dtype=np.int64)
+  num_utts = len(ref_offsets) - 1
+  if (np.diff(ref_offsets) == 0).any() or (np.diff(res_offsets) == 0).any():
+    raise ValueError("Utterance without reference or response segments")
+  if num_utts == 0:
+    empty = np.zeros(0,dtype=np.int64)
+    return empty, empty, np.zeros(1,dtype=np.int64)
+  ref_starts = np.asarray(ref_starts,dtype=np.int64)
+  res_starts = np.asarray(res_starts,dtype=np.int64)
+  ref_last = np.asarray(ref_ends,dtype=np.int64)[ref_offsets[1:] - 1]
+  res_last = np.asarray(res_ends,dtype=np.int64)[res_offsets[1:] - 1]
+
+  # Each utterance is shifted past the frames of the previous one
+  lo = min(ref_starts.min(),res_starts.min())
+  span = max(ref_starts.max(),res_starts.max()) - lo + 1
+  def keys(starts,offsets):
+    return np.repeat(np.arange(num_utts,dtype=np.int64) * span,np.diff(offsets)) + (starts - lo)
+  ref_keys = keys(ref_starts,ref_offsets)
+  res_keys = keys(res_starts,res_offsets)
+
+  # Union of the two sorted key arrays: a stable sort merges the two runs
+  bounds = np.concatenate((ref_keys,res_keys))
+  bounds.sort(kind="mergesort")
+  bounds = bounds[np.concatenate(([True],bounds[1:] != bounds[:-1]))]
+  utt = bounds // span
+  frame = bounds % span + lo
+  keep = (frame < np.minimum(ref_last,res_last)[utt]) | (frame > np.maximum(ref_last,res_last)[utt])
+  bounds, utt = bounds[keep], utt[keep]
+
+  def locate(seg_keys,offsets):
+    if (np.diff(seg_keys) >= 0).all():
+      order = np.arange(len(seg_keys))
+    else:
+      order = np.argsort(seg_keys,kind="mergesort")
+      seg_keys = seg_keys[order]
+    pos = np.searchsorted(seg_keys,bounds,side="right") - 1
+    index = order[np.maximum(pos,0)]
+    before = pos < offsets[utt]
+    index[before] = offsets[utt[before] + 1] - 1
+    return index
+
+  part_offsets = np.concatenate(([0],np.cumsum(np.bincount(utt,minlength=num_utts)))).astype(np.int64)
+  return locate(ref_keys,ref_offsets), locate(res_keys,res_offsets), part_offsets
+
+def partition_segments(ref,res,utts):
+  '''
+    Usage: partition_segments(ref,res,utts)
+
+    Splits the utterances utts of ref and res at the union of their segment
+    boundaries (see boundary_partitions). Returns (ref_labels, res_labels,
+    ref_symbols, res_symbols, offsets): the int64 reference and response
+    label id of every partition, the object arrays of the labels the ids
+    index, and the offsets of the partitions of each utterance.
+  '''
+  ref_starts, ref_ends, ref_labels, ref_symbols, ref_offsets = segment_arrays(ref,utts)
+  res_starts, res_ends, res_labels, res_symbols, res_offsets = segment_arrays(res,utts)
+  ref_index, res_index, offsets = boundary_partitions(ref_starts,ref_ends,ref_offsets,
+                                                      res_starts,res_ends,res_offsets)
+  return ref_labels[ref_index], res_labels[res_index], ref_symbols, res_symbols, offsets
+
+def segment_arrays(files,utts):
+  '''
+    Usage: segment_arrays(files,utts)
+
+    Returns (starts, ends, labels, symbols, offsets) for the utterances utts
+    of files, a python structure (see mlf2python) or SegmentCorpus: the
+    int64 first and last frame and label id of every segment, the object
+    array of the labels the ids index, and the offsets of the segments of
+    each utterance.
+  '''
+  starts, ends, labels, counts = [], [], [], []
+  symbol_ids, tables = {}, {}
+  for utt in utts:
+    segs = files[utt]
+    if isinstance(segs,SegmentList):
+      c, seg = segs.corpus, slice(segs.begin,segs.end)
+      if id(c) not in tables:
+        tables[id(c)] = np.array([symbol_ids.setdefault(s,len(symbol_ids)) for s in c.symbols],dtype=np.int64)
+      starts.append(c.starts[seg])
+      ends.append(c.ends[seg])
+      labels.append(tables[id(c)][c.labels[seg]])
+    else:
+      starts.append(np.array([s[0] for s in segs],dtype=np.int64))
+      ends.append(np.array([s[1] for s in segs],dtype=np.int64))
+      labels.append(np.array([symbol_ids.setdefault(s[2],len(symbol_ids)) for s in segs],dtype=np.int64))
+    counts.append(len(segs))
+
+  symbols = np.empty(len(symbol_ids),dtype=object)
+  for sym,i in symbol_ids.items():
+    symbols[i] = sym
+  offsets = np.concatenate(([0],np.cumsum(counts))).astype(np.int64)
+  if not utts:
+    empty = np.zeros(0,dtype=np.int64)
+    return empty, empty, empty, symbols, offsets
+  return (np.concatenate(starts).astype(np.int64), np.concatenate(ends).astype(np.int64),
+          np.concatenate(labels), symbols, offsets)
+
+def segment_centers(files,utts):
+  '''
+    Usage: segment_centers(files,utts)
+
+    Returns (centers, labels, offsets) of the utterances utts of files (see
+    segment_arrays): the center start + 0.5*(end - start) and the label
+    (object array) of every segment, and the offsets of the segments of
+    each utterance, as closest_centers takes them.
+  '''
+  starts, ends, labels, symbols, offsets = segment_arrays(files,utts)
+  return starts + 0.5*(ends - starts), symbols[labels], offsets
+
+def match_segments(ref,res,utts):
+  '''
+    Usage: match_segments(ref,res,utts)
+
+    Matches every response segment of the utterances utts to the reference
+    segment with the closest center (see closest_centers). Returns
+    (ref_labels, res_labels), object arrays with the label of the matched
+    reference segment and of the response segment, and closest, the index
+    of the matched reference segment. Raises ValueError if an utterance
+    with response segments has no reference segments.
+  '''
+  ref_mu, ref_labels, ref_offsets = segment_centers(ref,utts)
+  res_mu, res_labels, res_offsets = segment_centers(res,utts)
+  closest = closest_centers(ref_mu,res_mu,ref_offsets,res_offsets)
+  if (closest < 0).any():
+    raise ValueError("Response segments in an utterance without reference segments")
+  return ref_labels[closest], res_labels, closest
+
 def align(ref,res):
   '''
     Usage: align(reference_mlf, response_mlf)
@@ -341,31 +1471,10 @@ def align(ref,res):
                  response_mlf  -- the python representation of response mlf
 
   '''
-  
-  ref_labels = []
-  res_labels = []
-
-  for utt in ref.keys():
-    # Only use utterances common to both ref and res
-    try:
-      ref_utt = ref[utt]
-      res_utt = res[utt]
-    except KeyError:
-      continue
-
-    mu_ref = np.asarray([ 0.5*(seg[0] + seg[1]) for seg in ref_utt])
-    
-    new_lbls = []
-    res_lbls = []
-    for seg in res_utt:
-      closest_seg = ((0.5*(seg[0] + seg[1]) - mu_ref)**2).argmin()
-      new_lbls.append(ref_utt[closest_seg][2])
-      res_lbls.append(seg[2])
-          
-    ref_labels.extend(new_lbls)
-    res_labels.extend(res_lbls)
-  
-  return (ref_labels, res_labels)
+  # Only use utterances common to both ref and res
+  utts = [utt for utt in ref.keys() if utt in res]
+  ref_labels, res_labels, _ = match_segments(ref,res,utts)
+  return (ref_labels.tolist(), res_labels.tolist())
 
 def collect_reference_transcriptions(ref,res):
   '''
@@ -381,28 +1490,18 @@ def collect_reference_transcriptions(ref,res):
   
   ref_transcriptions = {}
 
-  for utt in ref.keys():
-    try:
-      res_utt = res[utt]
-      mu_ref = np.asarray([ 0.5*(seg[0] + seg[1]) for seg in ref[utt] ])
-      closest_segs = np.asarray([ ((0.5*(seg[0] + seg[1]) - mu_ref)**2).argmin() for seg in res_utt])
-   
-      previous_seg = None
-      for i,seg in enumerate(closest_segs):
-        if previous_seg != seg:
-          # Add previous segment to the dictionary entry ref_seg
-          try:
-            ref_transcriptions[ref[utt][seg][2]].append([res_utt[i][2]])
-          except KeyError:
-            ref_transcriptions[ref[utt][seg][2]] = [[res_utt[i][2]]]
-          # Start new example of the new ref_seg
-        else:
-          ref_transcriptions[ref[utt][seg][2]][-1] += [res_utt[i][2]]
-        
-        previous_seg = seg
-    
-    except KeyError:
-      continue         
+  utts = [utt for utt in ref.keys() if utt in res]
+  ref_labels, res_labels, closest = match_segments(ref,res,utts)
+  ref_labels, res_labels = ref_labels.tolist(), res_labels.tolist()
+
+  # Consecutive response segments matched to the same reference segment
+  # make one example of its transcription
+  previous_seg = None
+  for i,seg in enumerate(closest.tolist()):
+    if previous_seg != seg:
+      ref_transcriptions.setdefault(ref_labels[i],[]).append([res_labels[i]])
+    else:
+      ref_transcriptions[ref_labels[i]][-1].append(res_labels[i])
+    previous_seg = seg
   
   return ref_transcriptions
-
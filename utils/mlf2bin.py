@@ -0,0 +1,20 @@
+#!/usr/bin/python
+
+import sys
+from mlf import mlf2bin
+
+def main():
+  if len(sys.argv[1:]) < 1:
+    print("Usage: ./mlf2bin.py <rspecifier_mlf> [<wspecifier_mlfb>]")
+    print(" Writes the binary sidecar of an mlf file. Scripts loading the mlf "
+            "through utils/mlf.py read the sidecar instead while it is newer "
+            "than the mlf. The default output is the mlf path with the "
+            "extension .mlfb.")
+    sys.exit(1)
+
+  mlf = sys.argv[1]
+  mlfb = sys.argv[2] if len(sys.argv[1:]) > 1 else None
+  mlf2bin(mlf,mlfb)
+
+if __name__ == "__main__":
+  main()
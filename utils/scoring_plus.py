@@ -6,31 +6,8 @@ import sys
 import os
 import getopt
 import scipy.stats as stats
-
-try:
-    import B3score
-    B3flag=True
-except:
-    print("B-Cubed scoring package B3score is not installed.")
-    print("Try to install with < pip install --user B3score > for B-Cubed scores.")
-    print("Continuing ...")
-    B3flag=False
-
-def mlf2python(filename):
-    files = {}
-    with open(filename,"r") as fp:
-        lines = []
-        for line in fp:
-            if(not line.strip() == "#!MLF!#" and not line.strip() == "."):
-                if (line.strip().startswith('"')):
-                    utterance = line.strip().split(".")[0].split("/")[1]
-                else:
-                    [start, stop, label] = line.strip().split(" ")
-                    lines.append((int(float(start)/100000.0), int(float(stop)/100000.0), label)) 
-            elif(line.strip() == "."):
-                files[utterance] = lines
-                lines = []
-    return files
+from mlf import mlf2corpus, load_index, is_indexable, match_segments, partition_segments
+from contingency import ContingencyTable
 
 # Create frame level labels
 #def make_frame_labels(ref,mlf):
@@ -57,32 +34,11 @@ def mlf2python(filename):
 #    return [label_map,cluster_map, label2int, cluster2int]
     
 def make_segment_labels(ref,mlf):
-    label_map = []
-    cluster_map = []
-         
-    for utt in ref.keys():
-        ref_utt = ref[utt]
-        mlf_utt = mlf[utt]
-       
-        mu_ref = []
-        mode_ref = []
-        for seg in ref_utt:
-            seg_len = seg[1] - seg[0]
-            mu_ref.append(seg[0]+0.5*seg_len)
-        
-        mu_ref = np.asarray(mu_ref)        
-        
-        new_utt = []
-        cluster_utt = []
-        for seg in mlf_utt:
-            seg_len = seg[1] - seg[0]
-            mu_seg = seg[0] + 0.5*seg_len
-            closest_seg = ((mu_seg - mu_ref)**2).argmin()
-            new_utt.append(ref_utt[closest_seg][2])
-            cluster_utt.append(seg[2])
-
-        cluster_map.extend(cluster_utt)
-        label_map.extend(new_utt)
+    # Every segment of the mlf gets the label of the reference segment
+    # with the closest center, all utterances matched in one call
+    [label_map, cluster_map, _] = match_segments(ref, mlf, list(ref.keys()))
+    label_map = label_map.tolist()
+    cluster_map = cluster_map.tolist()
 
     label2int = {v:i for i,v in enumerate(set(label_map))}
     cluster2int = {v:i for i,v in enumerate(set(cluster_map))}
@@ -119,119 +75,71 @@ def make_segment_labels(ref,mlf):
    
 # Create Partitions
 def make_partitions(ref,mlf):
-    utt_partitions = {}
-    utterances_ref = ref.keys()
-    for utt in utterances_ref:
-        # Grab all the left side boundaries
-        mlf_boundaries = set([seg[0] for seg in mlf[utt]])
-        ref_boundaries = set([seg[0] for seg in ref[utt]])
-        
-        # The last boundary label must be < right side boundary of min(mlf[utt][-1], ref[utt][-1])
-        min_max_boundary = min([mlf[utt][-1][1],ref[utt][-1][1]])
-        max_boundary = max([ mlf[utt][-1][1], ref[utt][-1][1] ])
-        segment_boundaries = mlf_boundaries.union(ref_boundaries)
-        segment_boundaries = segment_boundaries.difference(range(min_max_boundary,max_boundary+1))
-        utt_partitions[utt] = sorted(list(segment_boundaries))
-    return utt_partitions
+    # Each utterance is split at the union of the left side boundaries of
+    # ref and mlf, minus those between the two right side boundaries. The
+    # partitions of all utterances are computed at once, see
+    # mlf.boundary_partitions
+    utterances_ref = list(ref.keys())
+    [label_ids, cluster_ids, label_symbols, cluster_symbols, offsets] = partition_segments(ref, mlf, utterances_ref)
+    return [utterances_ref, label_ids, cluster_ids, label_symbols, cluster_symbols, offsets]
+
+# Renumber label ids to 0 ... num_labels-1
+def compact_labels(ids, symbols):
+    used = np.flatnonzero(np.bincount(ids, minlength=len(symbols)))
+    new_ids = np.zeros(len(symbols), dtype=np.int64)
+    new_ids[used] = np.arange(len(used))
+    return new_ids[ids], {symbols[v]:i for i,v in enumerate(used)}
 
 # Map Partitions
 def map_partitions(ref,mlf,partitions):
-    label_map   = []
-    cluster_map = []
-    for utt in partitions.keys():
-        label_seg = 0
-        cluster_seg = 0
-        for seg in partitions[utt]:
-            while ( ( label_seg < len(ref[utt]) ) and (ref[utt][label_seg][0] <= seg)):
-                label_seg += 1
-            while ( ( cluster_seg < len(mlf[utt]) ) and   (mlf[utt][cluster_seg][0] <= seg) ):
-                cluster_seg += 1
-            
-            label_map += [ref[utt][label_seg - 1][2]]
-            cluster_map += [mlf[utt][cluster_seg - 1][2]]
-    
-    label2int = {v:i for i,v in enumerate(set(label_map))}
-    cluster2int = {v:i for i,v in enumerate(set(cluster_map))}
-    
-    label_map = [label2int[i] for i in label_map]
-    cluster_map = [cluster2int[i] for i in cluster_map]
+    [_, label_ids, cluster_ids, label_symbols, cluster_symbols, _] = partitions
+    label_map, label2int = compact_labels(label_ids, label_symbols)
+    cluster_map, cluster2int = compact_labels(cluster_ids, cluster_symbols)
     return [label_map,cluster_map, label2int, cluster2int]
 
 # Map Partitions
 def map_partitions_utt(ref,mlf,partitions):
+    [utterances, label_ids, cluster_ids, label_symbols, cluster_symbols, offsets] = partitions
     label_map   = {}
     cluster_map = {}
-    for utt in partitions.keys():
-        label_seg = 0
-        cluster_seg = 0
-        label_map[utt] = []
-        cluster_map[utt] = []
-        for seg in partitions[utt]:
-            while ( ( label_seg < len(ref[utt]) ) and (ref[utt][label_seg][0] <= seg)):
-                label_seg += 1
-            while ( ( cluster_seg < len(mlf[utt]) ) and   (mlf[utt][cluster_seg][0] <= seg) ):
-                cluster_seg += 1
-            
-            label_map[utt] += [ref[utt][label_seg - 1][2]]
-            cluster_map[utt] += [mlf[utt][cluster_seg - 1][2]]
+    for i,utt in enumerate(utterances):
+        label_map[utt] = label_symbols[label_ids[offsets[i]:offsets[i+1]]].tolist()
+        cluster_map[utt] = cluster_symbols[cluster_ids[offsets[i]:offsets[i+1]]].tolist()
     
     return [label_map,cluster_map]
 
+# Invert a label2int or cluster2int map
+def int2symbols(x2int):
+    symbols = [None]*len(x2int)
+    for k,v in x2int.items():
+        symbols[v] = k
+    return symbols
+
+# Count the labels of each cluster, from which all metrics are computed.
+# Tables given label2int and cluster2int can be merged (see ScoringStats)
+def make_contingency_table(label_map, cluster_map, label2int=None, cluster2int=None):
+    if label2int is None or cluster2int is None:
+        return ContingencyTable.from_maps(label_map, cluster_map)
+    return ContingencyTable.from_maps(label_map, cluster_map, label_symbols=int2symbols(label2int),
+                                      cluster_symbols=int2symbols(cluster2int))
+
 # Calculate Information Theoretic Quantities
-def calculate_information_metrics(label_map, cluster_map):
-    num_labels = len(set(label_map))
-    num_clusters = len(set(cluster_map))
-    
-    # Compute marginal distribution
-    p_k = np.histogram(cluster_map, bins=range(0,num_clusters+1))[0] / float(len(cluster_map))
-
-    cluster_map = np.array(cluster_map)
-    label_map = np.array(label_map)
-
-    # Compute conditional and joint distributions
-    p_l_given_k = np.zeros((num_clusters,num_labels))
-    for k in range(num_clusters):
-        idx = np.where(cluster_map == k)
-        if(len(idx[0]) > 0):
-            p_l_given_k[k] = np.histogram(label_map[idx], bins=range(0,num_labels+1))[0] / float(len(idx[0]))
-        
-    p_l = np.dot(p_l_given_k.T , p_k)
-    p_lk = p_l_given_k * p_k[:,np.newaxis]
+def calculate_information_metrics(label_map, cluster_map, table=None):
+    if table is None:
+        table = make_contingency_table(label_map, cluster_map)
+    return table.information_metrics()
 
-    # Add a small value to prevent divide by zero errors
-    p_k += np.finfo(float).eps
-    p_l += np.finfo(float).eps
-    p_lk += np.finfo(float).eps
-    
-    # Compute entropies
-    H_k  = -(p_k*np.log2(p_k)).sum()
-    H_l  = -(p_l*np.log2(p_l)).sum()
-    H_lk = -(p_lk*np.log2(p_lk)).sum()
-    H_l_given_k = H_lk - H_k
-    Information = H_l - H_l_given_k
-    Perplexity = 2**H_l_given_k
-    NMI_1 = 2*Information / ( H_l + H_k )
-    NMI_2 = Information / H_l
-    return [Perplexity, Information, NMI_1, NMI_2, H_l, H_k]
+# Calculate B-Cubed F-score, precision and recall
+def calculate_bcubed(label_map, cluster_map, table=None):
+    if table is None:
+        table = make_contingency_table(label_map, cluster_map)
+    return table.bcubed()
 
 # Map Clusters to Labels
-def clusters2labels(label_map, cluster_map, N=1):
-    num_labels = len(set(label_map))
-    num_clusters = len(set(cluster_map))
-    
-    cluster_map = np.array(cluster_map)
-    label_map = np.array(label_map)
-
-    # Compute conditional and joint distributions
-    p_l_given_k = np.zeros((num_clusters,num_labels))
-    for k in range(num_clusters):
-        idx = np.where(cluster_map == k)
-        if(len(idx[0]) > 0):
-            p_l_given_k[k] = np.histogram(label_map[idx], bins=range(0,num_labels+1))[0] / float(len(idx[0]))
-    
-    clust2lbl = { k:l.argsort()[-N:] for k,l in enumerate(p_l_given_k)}
-
-    return clust2lbl
+def clusters2labels(label_map, cluster_map, N=1, table=None):
+    if table is None:
+        table = make_contingency_table(label_map, cluster_map)
+    return table.n_best(N=N)
 
 # Transcribe Sequence
 def transcribe_sequence(clust2lbl, cluster_sequence):
@@ -258,38 +166,166 @@ def write_sequences_to_file(labels, estimated_labels, label2int, output):
             fp.write("\n")
             
 # Calculate Phone Error Rate
-def calculate_PER(label_map, cluster_map, N=1):
-    clust2lbl = clusters2labels(label_map, cluster_map, N=N)
-    
-    # Convert everything to numpy for convenience
-    label_map = np.array(label_map)
-    cluster_map = np.array(cluster_map)
+def calculate_PER(label_map, cluster_map, N=1, table=None):
+    if table is None:
+        table = make_contingency_table(label_map, cluster_map)
+    return table.accuracy(table.n_best(N=N))
     
-    matches = np.zeros((cluster_map.size,))
-    for seg_i,seg in enumerate(cluster_map):
-        matches[seg_i] = (label_map[seg_i] in clust2lbl[seg])
-    
-    return matches.sum()/float(matches.size)
+# Keys of an mlf file. Plain files are indexed, so that only the matching
+# utterances are read later; compressed files and stdin are read whole, once
+def read_keys(filename, jobs):
+    if is_indexable(filename):
+        return [list(load_index(filename).keys()), None]
+    corpus = mlf2corpus(filename, jobs=jobs)
+    return [corpus.utt_ids, corpus]
+
+# Read the matching utterances of an mlf file, see read_keys
+def read_matching(filename, corpus, matching_keys, jobs):
+    if corpus is None:
+        return mlf2corpus(filename, keys=matching_keys, jobs=jobs)
+    return corpus.subset(matching_keys)
+
+# Sufficient statistics of a scoring run
+class ScoringStats(object):
+    def __init__(self, ref_keys, mlf_keys, utterances, table, table_segs):
+        '''
+            Everything the report of main() is computed from: the keys of
+            the reference and of the mlf, the scored utterances (those in
+            both) and the boundary union and closest center contingency
+            tables, with their symbols. The stats of shards of a test set,
+            e.g. the outputs of parallel decoding jobs, can be saved,
+            merged and reported as if the shards had been scored together.
+        '''
+        self.ref_keys = ref_keys
+        self.mlf_keys = mlf_keys
+        self.utterances = utterances
+        self.table = table
+        self.table_segs = table_segs
+
+    def merge(self, other):
+        '''
+            Returns the stats of both shards. An utterance can only be
+            scored in one of them.
+        '''
+        utterances = set(self.utterances)
+        for utt in other.utterances:
+            if utt in utterances:
+                raise ValueError("Utterance %s is scored in more than one shard" % utt)
+        def union(a, b):
+            keys = set(a)
+            return list(a) + [k for k in b if k not in keys]
+        return ScoringStats(union(self.ref_keys, other.ref_keys), union(self.mlf_keys, other.mlf_keys),
+                            list(self.utterances) + list(other.utterances),
+                            self.table.merge(other.table), self.table_segs.merge(other.table_segs))
+
+    def save(self, path):
+        arrays = {"ref_keys": np.array(self.ref_keys, dtype=str),
+                  "mlf_keys": np.array(self.mlf_keys, dtype=str),
+                  "utterances": np.array(self.utterances, dtype=str)}
+        arrays.update(self.table.to_arrays("boundary_"))
+        arrays.update(self.table_segs.to_arrays("closest_"))
+        with open(path, "wb") as fp:
+            np.savez(fp, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        arrays = np.load(path)
+        try:
+            return cls(arrays["ref_keys"].tolist(), arrays["mlf_keys"].tolist(), arrays["utterances"].tolist(),
+                       ContingencyTable.from_arrays(arrays, "boundary_"),
+                       ContingencyTable.from_arrays(arrays, "closest_"))
+        finally:
+            arrays.close()
+
+    def print_removed_keys(self):
+        print("%d keys were removed from reference." % (len(self.ref_keys) - len(self.utterances)))
+        print("%d keys were removed from mlf." % (len(self.mlf_keys) - len(self.utterances)))
+
+    def print_metrics(self):
+        table = self.table
+        table_segs = self.table_segs
+
+        num_ref_units = table.num_labels
+        num_proposed_units = table.num_clusters
     
+        print("# reference units: %d" % num_ref_units)
+        print("# proposed units: %d" % num_proposed_units)
+
+        [P,I,NMI_1,NMI_2,H_l,H_k] = table.information_metrics()
+        [Pc,Ic,NMI_1c,NMI_2c,H_lc,H_kc] = table_segs.information_metrics()
+
+        [FB3,_,_] = table.bcubed()
+        [FB3c,_,_] = table_segs.bcubed()
+
+        print("2*I(X;Y)/(H(X) + H(Y)) Boundary union: %.4f" % NMI_1)
+        print("* 2*I(X;Y)/(H(X) + H(Y)) Closest center: %.4f" % NMI_1c)
+        print("")
+        print("I(X;Y)/(H(X)) Boundary union: %.4f" % NMI_2)
+        print("* I(X;Y)/(H(X)) Closest center: %.4f" % NMI_2c)
+        print("")
+        print("Perplexity Boundary union: %.4f" % P)
+        print("* Perplexity Closest center: %.4f" % Pc)
+        print("")
+        print("I(X;Y) Boundary union: %.4f" % I)
+        print("* I(X;Y) Closest center: %.4f" % Ic) 
+        print("")
+        print("H(X) Boundary union: %.4f" % H_l)
+        print("* H(X) Closest center: %.4f" % H_lc)
+        print("")
+        print("H(Y) Boundary union: %.4f" % H_k)
+        print("* H(Y) Closest center: %.4f" % H_kc)
+
+        print("")
+        print("F-bcubed Boundary union: %.4f" % FB3)
+        print("* F-bcubed Closest center: %.4f" % FB3c)
+
+# Report the merged stats of scoring runs saved with -s
+def merge_stats(stats_files):
+    stats = ScoringStats.load(stats_files[0])
+    for stats_file in stats_files[1:]:
+        stats = stats.merge(ScoringStats.load(stats_file))
+    stats.print_removed_keys()
+    stats.print_metrics()
+
 # Calculate all metrics
 def main():
-    opts,args = getopt.getopt(sys.argv[1:],"hp:t:","[]")
+    opts,args = getopt.getopt(sys.argv[1:],"hp:t:j:s:",["help","merge"])
   
     output_map_file = None
     output_dir = None 
+    stats_file = None
+    merge = False
+    jobs = 1
     for o,a in opts:
         if(o in ("-h", "--help")):
             print("Usage: python scoring_plus.py [opts ] <ref.mlf> <lab.mlf>")
+            print("       python scoring_plus.py --merge <stats1> <stats2> ...")
             print(" opts:")
             print("     -h -- help")
             print("     -p <output_map_file> -- create .map file for plotting using plotData.py")
             print("     -t <output_dir> -- transcribe all utterances and place them in output_dir")
+            print("     -j <jobs> -- number of processes used to parse the mlf files")
+            print("     -s <stats_file> -- save the statistics of the scores, to be merged with --merge")
+            print("     --merge -- print the scores of all the stats files together")
             sys.exit()
 
         if(o == "-t"):
             output_dir = a
         if(o == "-p"):
             output_map_file = a
+        if(o == "-j"):
+            jobs = int(a)
+        if(o == "-s"):
+            stats_file = a
+        if(o == "--merge"):
+            merge = True
+
+    if(merge):
+        if (len(args) < 1):
+            print("Usage: python scoring_plus.py --merge <stats1> <stats2> ...")
+            sys.exit(1)
+        merge_stats(args)
+        return
        
     if (len(args) < 2):
         print("Usage: python scoring_plus.py [opts ] <ref.mlf> <lab.mlf>")
@@ -299,17 +335,16 @@ def main():
     ref_file = args[0]
     mlf_file = args[1]
      
-    ref = mlf2python(ref_file)
-    mlf = mlf2python(mlf_file)
-
-    # Remove keys in references with no match in the mlf
-    matching_keys = set(ref.keys()) & set(mlf.keys())
-    number_keys_removed = len(ref.keys()) - len(matching_keys)
-    number_keys_removed_mlf = len(mlf.keys()) - len(matching_keys)
+    # Only read the utterances of the references with a match in the mlf
+    [ref_keys, ref] = read_keys(ref_file, jobs)
+    [mlf_keys, mlf] = read_keys(mlf_file, jobs)
+    matching_keys = set(ref_keys) & set(mlf_keys)
+    ref = read_matching(ref_file, ref, matching_keys, jobs)
+    mlf = read_matching(mlf_file, mlf, matching_keys, jobs)
     ref = {k : ref[k] for k in matching_keys}
     mlf = {k: mlf[k] for k in matching_keys}
-    print("%d keys were removed from reference." % number_keys_removed)
-    print("%d keys were removed from mlf." % number_keys_removed_mlf)
+    stats = ScoringStats(list(ref_keys), list(mlf_keys), list(ref.keys()), None, None)
+    stats.print_removed_keys()
     
     partitions = make_partitions(ref,mlf)
     print("Making response partitions")
@@ -320,51 +355,11 @@ def main():
     [label_map_segs, cluster_map_segs, c_label2int, c_cluster2int] = make_segment_labels(ref,mlf)
 
  
-    num_ref_units = len(label2int.keys()) 
-    num_proposed_units = len(cluster2int.keys())
-    
-    print("# reference units: %d" % num_ref_units)
-    print("# proposed units: %d" % num_proposed_units)
-
-    [P,I,NMI_1,NMI_2,H_l,H_k] = calculate_information_metrics(label_map, cluster_map) 
-    #[Pf,If,NMI_1f,NMI_2f,H_lf, H_kf] = calculate_information_metrics(label_map_frames, cluster_map_frames) 
-    [Pc,Ic,NMI_1c,NMI_2c,H_lc,H_kc] = calculate_information_metrics(label_map_segs, cluster_map_segs)
-
-    if(B3flag):
-        [FB3,_,_] = B3score.calc_b3(label_map,cluster_map)
-        #[FB3f,_,_] = B3score.calc_b3(label_map_frames, cluster_map_frames)
-        [FB3c,_,_] = B3score.calc_b3(label_map_segs, cluster_map_segs)
-
-
-    print("2*I(X;Y)/(H(X) + H(Y)) Boundary union: %.4f" % NMI_1)
-    #print("2*I(X;Y)/(H(X) + H(Y)) Frame level: %.4f" % NMI_1f)
-    print("* 2*I(X;Y)/(H(X) + H(Y)) Closest center: %.4f" % NMI_1c)
-    print("")
-    print("I(X;Y)/(H(X)) Boundary union: %.4f" % NMI_2)
-    #print("I(X;Y)/(H(X)) Frame level: %.4f" % NMI_2f)
-    print("* I(X;Y)/(H(X)) Closest center: %.4f" % NMI_2c)
-    print("")
-    print("Perplexity Boundary union: %.4f" % P)
-    #print("Perplexity Frame level: %.4f" % Pf)
-    print("* Perplexity Closest center: %.4f" % Pc)
-    print("")
-    print("I(X;Y) Boundary union: %.4f" % I)
-    #print("I(X;Y) Frame level: %.4f" % If)
-    print("* I(X;Y) Closest center: %.4f" % Ic) 
-    print("")
-    print("H(X) Boundary union: %.4f" % H_l)
-    #print("H(X) Frame level: %.4f" % H_lf)
-    print("* H(X) Closest center: %.4f" % H_lc)
-    print("")
-    print("H(Y) Boundary union: %.4f" % H_k)
-    #print("H(Y) Frame level: %.4f" % H_kf)
-    print("* H(Y) Closest center: %.4f" % H_kc)
-
-    if(B3flag):
-      print("")
-      print("F-bcubed Boundary union: %.4f" % FB3)
-      #print("F-bcubed Frame level: %.4f" % FB3f)
-      print("* F-bcubed Closest center: %.4f" % FB3c)
+    stats.table = make_contingency_table(label_map, cluster_map, label2int, cluster2int)
+    stats.table_segs = make_contingency_table(label_map_segs, cluster_map_segs, c_label2int, c_cluster2int)
+    if(stats_file):
+        stats.save(stats_file)
+    stats.print_metrics()
     
     # ------------------- Plot Confusion Matrix ------------------------
     # Map 61 phone label integers to Timit phones
@@ -393,7 +388,7 @@ def main():
     # Define mapping of clusters to labels
     if(output_dir):
         [label_map_utt, cluster_map_utt] = map_partitions_utt(ref,mlf,partitions)
-        clust2lbl = clusters2labels(label_map, cluster_map, N=lattice_size)
+        clust2lbl = clusters2labels(label_map, cluster_map, N=lattice_size, table=stats.table)
     
         # For each utterance write a new file
         for utt in cluster_map_utt.keys():
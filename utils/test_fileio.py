@@ -0,0 +1,45 @@
+import os
+import shutil
+import tempfile
+import unittest
+import fileio
+from fileio import open_file
+
+# Run from utils with python -m unittest test_fileio, on python 2 and 3
+
+
+def has_zstd():
+    paths = os.environ.get("PATH", "").split(os.pathsep)
+    return fileio.zstandard is not None or any(os.access(os.path.join(d, "zstd"), os.X_OK) for d in paths)
+
+
+class OpenFileTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check_round_trip(self, name):
+        path = os.path.join(self.dir, name)
+        with open_file(path, "w") as fp:
+            fp.write("#!MLF!#\n")
+            fp.write("\"utt1.rec\"\n%d %d %s\n.\n" % (0, 100000, "a"))
+        with open_file(path) as fp:
+            lines = list(fp)
+        self.assertEqual(lines, ["#!MLF!#\n", "\"utt1.rec\"\n", "0 100000 a\n", ".\n"])
+        self.assertTrue(all(isinstance(l, str) for l in lines))
+
+    def test_plain(self):
+        self.check_round_trip("a.mlf")
+
+    def test_gzip(self):
+        self.check_round_trip("a.mlf.gz")
+
+    @unittest.skipUnless(has_zstd(), "needs the zstandard package or the zstd command")
+    def test_zstd(self):
+        self.check_round_trip("a.mlf.zst")
+
+
+if __name__ == "__main__":
+    unittest.main()
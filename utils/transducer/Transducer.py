@@ -3,9 +3,174 @@
 import math
 import sys
 import os
+import numpy as np
+import trellis
 
-class Grapheme:
-    def __init__(self,name,emissions,lam=0.01):
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:
+    from collections import Mapping, MutableMapping
+
+# Arcs of each grapheme HMM, and the subset of those that emit a symbol
+ARCS = ('a11', 'a12', 'q12')
+EMITTING_ARCS = ('a11', 'a12')
+
+class ArcView(MutableMapping):
+    '''
+        Dictionary style view {arc: value} over one row of a parameter or
+        counter array of a GraphemeSet. Reads and writes go to the array.
+    '''
+    def __init__(self,row,arcs):
+        self.row = row
+        self.arcs = arcs
+
+    def __getitem__(self,arc):
+        return self.row[self.arcs.index(arc)].item()
+
+    def __setitem__(self,arc,val):
+        self.row[self.arcs.index(arc)] = val
+
+    def __delitem__(self,arc):
+        raise TypeError("Arcs of a grapheme HMM cannot be removed.")
+
+    def __iter__(self):
+        return iter(self.arcs)
+
+    def __len__(self):
+        return len(self.arcs)
+
+
+class EmissionView(Mapping):
+    '''
+        Dictionary style view {emission: {arc: value}} over the emission
+        axis of a (num_emissions, 2) slice of a GraphemeSet array.
+    '''
+    def __init__(self,table,emission_ids):
+        self.table = table
+        self.emission_ids = emission_ids
+
+    def __getitem__(self,e):
+        return ArcView(self.table[self.emission_ids[e]], EMITTING_ARCS)
+
+    def __iter__(self):
+        return iter(self.emission_ids)
+
+    def __len__(self):
+        return len(self.emission_ids)
+
+
+class GraphemeSet(Mapping):
+    def __init__(self,emissions_dict,lam=0.01):
+        '''
+            Constructor for the parameters of a set of Grapheme HMMs stored as
+            arrays. Graphemes and emissions are interned into integer ids so
+            that the trellis recursions can index the parameters directly.
+
+            Inputs:
+                emissions_dict -- {grapheme: {emission: initial value}}, such
+                                  as the output of estimate_emissions.py
+                lam            -- add-1 smoothing weight for arc counters
+
+            The set behaves as the dictionary {name: Grapheme} used before,
+            where each Grapheme is a view onto one row of the arrays:
+
+                A    -- (num_graphemes, 3) transition probabilities (ARCS)
+                B    -- (num_graphemes, num_emissions, 2) emission
+                        probabilities per emitting arc (EMITTING_ARCS)
+                c_t  -- arc counters, same shape as A
+                c_ty -- observation arc counters, same shape as B
+        '''
+        self.graphemes = sorted(emissions_dict.keys())
+        self.grapheme_ids = {g:i for i,g in enumerate(self.graphemes)}
+        self.emissions = sorted(set(e for ems in emissions_dict.values() for e in ems))
+        self.emission_ids = {e:i for i,e in enumerate(self.emissions)}
+        self.lam = lam
+
+        self.A = np.tile([0.1, 0.8, 0.1], (len(self.graphemes), 1))
+        self.B = np.zeros((len(self.graphemes), len(self.emissions), len(EMITTING_ARCS)))
+        for g,ems in emissions_dict.items():
+            for e,val in ems.items():
+                self.B[self.grapheme_ids[g], self.emission_ids[e]] = val
+
+        self.reset_counters()
+        
+        # Running statistics of stepwise (online) EM, see step()
+        self.num_steps = 0
+        self.s_t = None
+        self.s_ty = None
+
+    def reset_counters(self,value=None):
+        '''
+            Sets all counters to value, which defaults to the smoothing
+            weight lam.
+        '''
+        if value is None:
+            value = self.lam
+        self.c_t = np.full(self.A.shape, float(value))
+        self.c_ty = np.full(self.B.shape, float(value))
+
+    def update(self):
+        '''
+            M-step for every grapheme at once. The counters are reset after.
+        '''
+        self.estimate(self.c_t, self.c_ty)
+        self.reset_counters()
+
+    def estimate(self,c_t,c_ty):
+        '''
+            Sets the parameters to their maximum likelihood estimates given
+            the arc counts c_t and observation arc counts c_ty.
+        '''
+        # Get the total count of outgoing arcs for each state. In this case there
+        # is only 1 starting state though.
+        self.A = c_t / c_t.sum(axis=1, keepdims=True)
+        self.B = c_ty / (c_t[:,np.newaxis,:len(EMITTING_ARCS)] + (self.lam * (len(self.emissions) - 1)))
+
+    def step(self,decay=0.7):
+        '''
+            Stepwise (online) EM update from the counters of one mini-batch.
+            The running statistics are interpolated towards the counters with
+            step size (k + 2)^-decay, where k is the number of steps taken so
+            far, and the parameters are re-estimated from them. The first step
+            takes the counters as they are. decay must be in (0.5, 1] for the
+            updates to converge. The counters are reset after.
+        '''
+        if self.s_t is None:
+            self.s_t, self.s_ty = self.c_t, self.c_ty
+        else:
+            eta = (self.num_steps + 2) ** -decay
+            self.s_t = (1.0 - eta) * self.s_t + eta * self.c_t
+            self.s_ty = (1.0 - eta) * self.s_ty + eta * self.c_ty
+        self.num_steps += 1
+        self.estimate(self.s_t, self.s_ty)
+        self.reset_counters()
+
+    def __getstate__(self):
+        # The counters only hold the smoothing value between iterations, so
+        # they are not stored with the model
+        state = self.__dict__.copy()
+        del state['c_t'], state['c_ty']
+        return state
+
+    def __setstate__(self,state):
+        state.setdefault('num_steps', 0)
+        state.setdefault('s_t', None)
+        state.setdefault('s_ty', None)
+        self.__dict__.update(state)
+        self.reset_counters()
+
+    def __getitem__(self,name):
+        return Grapheme(name, store=self)
+
+    def __iter__(self):
+        return iter(self.graphemes)
+
+    def __len__(self):
+        return len(self.graphemes)
+
+
+class Grapheme(object):
+    def __init__(self,name,emissions=None,lam=0.01,store=None):
         ''' 
             Constructor for a Grapheme HMM. Specify the set of possible emissions, and 
             an add-1 smoothing weight lam for the counters.
@@ -13,43 +178,79 @@ class Grapheme:
             Inputs:
                 emissions -- dictionary of emissions
                 lam       -- add-1 smoothing weight for arc counters
+                store     -- GraphemeSet holding the parameters of this
+                             grapheme. A grapheme created on its own gets a
+                             GraphemeSet of its own.
                 
         '''
-        # A is the transition matrix.
-        # There are 3 arcs:
-        # a11, a12, q12
+        if store is None:
+            store = GraphemeSet({name: emissions}, lam=lam)
         self.name = name
-        self.A = {'a11':0.1, 'a12':0.8, 'q12':0.1}
-        
-        # B is the observation matrix.
-        # There are O possible observations per emitting arc.
-        # b11, b12
-        self.B = {e:{'a11':val, 'a12':val} for e,val in emissions.iteritems()}
-        
-        # c_t is are the arc counters
-        self.c_t = {'a11':lam, 'a12':lam, 'q12':lam}
-        
-        # c_ty is the observation arc counters
-        self.c_ty = {e:{'a11':lam, 'a12':lam} for e in emissions.iterkeys()}
-        self.emissions = emissions
-        self.lam = lam
-        
+        self.store = store
+        self.index = store.grapheme_ids[name]
+
+    # A is the transition matrix.
+    # There are 3 arcs:
+    # a11, a12, q12
+    @property
+    def A(self):
+        return ArcView(self.store.A[self.index], ARCS)
+
+    @A.setter
+    def A(self,arcs):
+        self.A.update(arcs)
+
+    # B is the observation matrix.
+    # There are O possible observations per emitting arc.
+    # b11, b12
+    @property
+    def B(self):
+        return EmissionView(self.store.B[self.index], self.store.emission_ids)
+
+    @B.setter
+    def B(self,ems):
+        B = self.B
+        for e,arcs in ems.items():
+            B[e].update(arcs)
+
+    # c_t is are the arc counters
+    @property
+    def c_t(self):
+        return ArcView(self.store.c_t[self.index], ARCS)
+
+    @c_t.setter
+    def c_t(self,arcs):
+        self.c_t.update(arcs)
+
+    # c_ty is the observation arc counters
+    @property
+    def c_ty(self):
+        return EmissionView(self.store.c_ty[self.index], self.store.emission_ids)
+
+    @c_ty.setter
+    def c_ty(self,ems):
+        c_ty = self.c_ty
+        for e,arcs in ems.items():
+            c_ty[e].update(arcs)
+
+    @property
+    def emissions(self):
+        return self.store.emission_ids
+
+    @property
+    def lam(self):
+        return self.store.lam
+
     def reset_counters(self):
-        self.c_t ={'a11':self.lam, 'a12':self.lam, 'q12':self.lam}
-        self.c_ty = {e:{'a11':self.lam, 'a12':self.lam} for e in self.emissions.iterkeys()}
+        self.store.c_t[self.index] = self.lam
+        self.store.c_ty[self.index] = self.lam
 
     def update(self):
         # Get the total count of outgoing arcs for each state. In this case there
         # is only 1 starting state though.
-        total_count = sum(self.c_t.itervalues())
-        
-        self.A = {arc: count/total_count for arc,count in self.c_t.iteritems()}
-        self.B = { e : 
-                      { arc : count/(self.c_t[arc] + (self.lam * (len(self.emissions.keys()) - 1))) 
-                           for arc,count in arcs.iteritems() 
-                      } for e,arcs in self.c_ty.iteritems()    
-                 }
-        
+        store, i = self.store, self.index
+        store.A[i] = store.c_t[i] / store.c_t[i].sum()
+        store.B[i] = store.c_ty[i] / (store.c_t[i,np.newaxis,:len(EMITTING_ARCS)] + (self.lam * (len(self.emissions) - 1)))
         self.reset_counters()
            
 
@@ -59,117 +260,365 @@ class Utterance:
             Constructure for utterance HMM. It defines the way that individual
             Grapheme objects (HMMs) can be concatenated together to perform
             utterance level training.
+
+            graphemes is the GraphemeSet holding the parameters of all
+            graphemes. The chain is stored as an array of grapheme ids.
+            utterance is either the reference string or, when it was already
+            compiled (see utterance_cache.py), that array of grapheme ids.
         '''
         self.utterance_id = utterance_id
-        self.model = utterance.split(" ")
         self.G = graphemes
-        for u in self.model:
-            try:
-                if(self.G[u]):
-                    pass
-            except KeyError:
-                print("Utterace contains graphemes that are not in the grapheme list provided.")
-                sys.exit(1)
+        if isinstance(utterance, np.ndarray):
+            self.chain = utterance
+            return
+        self.model = utterance.split(" ")
+        try:
+            self.chain = np.array([self.G.grapheme_ids[u] for u in self.model], dtype=np.intp)
+        except KeyError:
+            print("Utterace contains graphemes that are not in the grapheme list provided.")
+            sys.exit(1)
     
-    def do_forward(self,seq):
-        # Initialize a few things
-        trellis_stages = len(seq) + 1
-        number_of_states = len(self.model) + 1
-        alpha = [[0.0 for i in range(number_of_states)] for t in range(trellis_stages)]
-        alpha[0][0] = 1.0
-        
-        Q = [0.0 for t in range(trellis_stages)]
-        Q[0] = 1.0
-        
-        # This makes life easier
-        seq = ['0'] + seq
+    def observations(self,seq):
+        '''
+            Maps the observation sequence seq to an array of emission ids.
+            An array is taken to already hold emission ids.
+        '''
+        if isinstance(seq, np.ndarray):
+            return seq
+        return np.array([self.G.emission_ids[o] for o in seq], dtype=np.intp)
+
+    def compile(self,obs):
+        '''
+            Compiles the grapheme chain of this utterance and the emission ids
+            obs into the dense log arc weights used by the trellis recursions
+            (see trellis.py):
+
+                e11 -- (T, N) log(a11 * b11(o_t)) for each chain position
+                e12 -- (T, N) log(a12 * b12(o_t))
+                q12 -- (N,) log(q12)
+        '''
+        with np.errstate(divide='ignore'):
+            logA = np.log(self.G.A[self.chain])
+            logB = np.log(self.G.B[self.chain[np.newaxis,:],obs[:,np.newaxis]])
         
-        # Start sweeping through the trellis and accumulating forward probabilities
-        for t in range(1,trellis_stages):
-            o = seq[t]
-            
-            # Sweep through each state
-            for s in range(number_of_states):
-                if s == 0:
-                    alpha[t][s] = alpha[t-1][s] * self.G[self.model[s]].A['a11'] * self.G[self.model[s]].B[o]['a11']
-                elif s == number_of_states - 1:
-                    alpha[t][s] = alpha[t-1][s-1] * self.G[self.model[s-1]].A['a12'] * self.G[self.model[s-1]].B[o]['a12']
-                    if t != (trellis_stages-1):
-                        alpha[t][s] += alpha[t-1][s-1] * self.G[self.model[s-1]].A['q12']
-                else:
-                    alpha[t][s] = alpha[t-1][s] * self.G[self.model[s]].A['a11'] * self.G[self.model[s]].B[o]['a11'] \
-                                + alpha[t-1][s-1] * self.G[self.model[s-1]].A['a12'] * self.G[self.model[s-1]].B[o]['a12']
-                    if t != (trellis_stages-1):
-                        alpha[t][s] += alpha[t][s-1] * self.G[self.model[s-1]].A['q12']
-                            
-            Q[t] = sum(alpha[t])
-            alpha[t][:] = [v/Q[t] for v in alpha[t]]
+        return logA[:,0] + logB[...,0], logA[:,1] + logB[...,1], logA[:,2]
+
+    def compile_band(self,obs,lo,W):
+        '''
+            Banded version of compile, see trellis.band. Returns the (N, W)
+            log arc weights E11 and E12, indexed by the stage each arc
+            enters, and q12.
+        '''
+        t = lo[:-1,np.newaxis] + np.arange(W)[np.newaxis,:] - 1
+        outside = (t < 0) | (t >= len(obs))
+        with np.errstate(divide='ignore'):
+            logA = np.log(self.G.A[self.chain])
+            logB = np.log(self.G.B[self.chain[:,np.newaxis],obs[np.clip(t, 0, len(obs) - 1)]])
+        logB[outside] = trellis.NEG_INF
         
-        return alpha,Q,sum([math.log(i) for i in Q])
+        return logA[:,0,np.newaxis] + logB[...,0], logA[:,1,np.newaxis] + logB[...,1], logA[:,2]
+
+    def do_forward(self,seq):
+        '''
+            Scaled forward pass. Returns the per-stage normalized forward
+            probabilities, the scaling factors Q and the log-likelihood.
+        '''
+        alpha = trellis.forward(*self.compile(self.observations(seq)))
+        C = trellis.logsumexp(alpha, axis=1)
+        Q = np.exp(np.diff(C, prepend=0.0))
+        return np.exp(alpha - C[:,np.newaxis]),Q,C[-1]
     
     def do_backward(self,seq,Q=None,alpha=None):
-        trellis_stages = len(seq) + 1
-        number_of_states = len(self.model) + 1
-        beta = [[0.0 for i in range(number_of_states)] for t in range(trellis_stages)]
-        beta[-1] = [ 1.0 for i in beta[-1]]
-        
-        if not Q:
-            Q = [0.0 for t in range(trellis_stages)]
-            Q[-1] = 1.0
+        '''
+            Scaled backward pass. If the scaling factors Q of the forward pass
+            are given they are used to scale beta, otherwise each stage is
+            normalized on its own. If the forward probabilities alpha are also
+            given the arc counters of the graphemes are updated.
+        '''
+        obs = self.observations(seq)
+        e11, e12, q12 = self.compile(obs)
+        beta = trellis.backward(e11, e12, q12)
+        if Q is None:
+            D = trellis.logsumexp(beta, axis=1)
+            D[-1] = 0.0
+            Q = np.exp(D - np.append(D[1:], 0.0))
+        else:
+            C = np.cumsum(np.log(Q))
+            D = C[-2] - np.append(0.0, C[:-2])
+            D = np.append(D, 0.0)
         
-        # This makes life easier
-        seq = ['0'] + seq
-        
-        # Start sweeping through the trellis and accumulating backward probabilities
-        for t in range(trellis_stages-2,-1,-1):
-            o = seq[t+1]
-            
-            # Sweep through each state
-            for s in range(number_of_states-1,-1,-1):
-                if s == number_of_states-1:
-                    beta[t][s] = 0.0
-                else:
-                    beta[t][s] = beta[t+1][s]*self.G[self.model[s]].A['a11']*self.G[self.model[s]].B[o]['a11'] \
-                                + beta[t+1][s+1]*self.G[self.model[s]].A['a12']*self.G[self.model[s]].B[o]['a12']
-                    if t != 0:
-                        beta[t][s] += beta[t][s+1]*self.G[self.model[s]].A['q12']
-            
-            if Q[-1] == 1.0:
-                Q[t] = sum(beta[t])
-
-            beta[t][:] = [v/Q[t] for v in beta[t]]
-            
-            if alpha:
-                self.update_arc_counts(alpha[t], beta[t+1], o, beta[t], Q[t])
+        if alpha is not None:
+            with np.errstate(divide='ignore'):
+                log_alpha = np.log(alpha) + np.cumsum(np.log(Q))[:,np.newaxis]
+            self.update_arc_counts(obs, trellis.arc_posteriors(log_alpha, beta, e11, e12, q12))
         
         # The Q, and LL terms are only useful for debugging when Q does not come from 
         # the forward pass
-        return beta,Q,(sum([math.log(i) for i in Q]) + math.log(beta[0][0]))
+        beta_hat = np.exp(beta - D[:,np.newaxis])
+        return beta_hat,Q,(np.log(Q).sum() + np.log(beta_hat[0][0]))
     
-    def update_arc_counts(self, alpha_t, beta_t_plus_1, o, beta_t, Q):
-     
-        # Update all possible arc counts
-        number_of_states = len(alpha_t)
+    def update_arc_counts(self, obs, posteriors, lo=None):
+        '''
+            Adds the (T, N) arc occupancies (see trellis.arc_posteriors) to
+            the arc counters of the GraphemeSet. Occupancies are first summed
+            over all chain positions and observations that share the same
+            grapheme and emission. If the first stages lo of a band are given
+            the occupancies are the banded (N, W) ones instead.
+        '''
+        p11, p12, p_q12 = posteriors
+        num_graphemes, num_emissions, _ = self.G.c_ty.shape
+        if lo is None:
+            graphs = self.chain[np.newaxis,:]
+            ems = obs[:,np.newaxis]
+        else:
+            graphs = self.chain[:,np.newaxis]
+            ems = obs[np.clip(lo[:-1,np.newaxis] + np.arange(p11.shape[1])[np.newaxis,:], 0, len(obs) - 1)]
+        key = (graphs * num_emissions + ems).ravel()
         
-        for s1 in range(number_of_states-1):
-            # Self arc
-            p_t = alpha_t[s1] * self.G[self.model[s1]].A['a11'] \
-                * self.G[self.model[s1]].B[o]['a11'] * beta_t_plus_1[s1]
-                
-            self.G[self.model[s1]].c_ty[o]['a11'] += p_t
-            self.G[self.model[s1]].c_t['a11'] += p_t
-            
-            # Transition arc
-            p_t = alpha_t[s1] * self.G[self.model[s1]].A['a12'] \
-                * self.G[self.model[s1]].B[o]['a12'] * beta_t_plus_1[s1+1]
-            
-            self.G[self.model[s1]].c_ty[o]['a12'] += p_t
-            self.G[self.model[s1]].c_t['a12'] += p_t
-    
-            # Null arc
-            self.G[self.model[s1]].c_t['q12'] += alpha_t[s1] * self.G[self.model[s1]].A['q12'] * beta_t[s1+1] * Q
+        for i,p in enumerate((p11, p12)):
+            c = np.bincount(key, weights=p.ravel(), minlength=num_graphemes * num_emissions)
+            c = c.reshape(num_graphemes, num_emissions)
+            self.G.c_ty[...,i] += c
+            self.G.c_t[:,i] += c.sum(axis=1)
+        graphs = np.broadcast_to(graphs, p_q12.shape).ravel()
+        self.G.c_t[:,2] += np.bincount(graphs, weights=p_q12.ravel(), minlength=num_graphemes)
     
-    def train_sequence(self,seq):
-        alpha,Q,LL = self.do_forward(seq)
-        beta,_,_ = self.do_backward(seq, Q=Q, alpha=alpha)
+    def train_sequence(self,seq,band=None,beam=None,checkpoint=False,measure_band=False,scaled=False):
+        '''
+            Accumulates the arc counts of the observation sequence seq and
+            returns its log-likelihood.
+
+            The trellis can be pruned for long utterances. With band set, each
+            grapheme is only allowed within band frames of its share of the
+            diagonal (see trellis.band). With beam set, the backward pass and
+            the arc counts skip the cells whose forward probability is more
+            than beam (log) below the forward mass of their stage. The fraction
+            of the posterior mass lost to the beam, relative to the banded
+            trellis, is kept in pruned_mass. The band changes the
+            log-likelihood itself: with measure_band set, the full trellis is
+            also summed (one more forward pass, without the savings of the
+            band) and the fraction of the total mass outside the band,
+            1 - exp(LL_band - LL_full), is kept in band_mass. It is None
+            otherwise.
+
+            With checkpoint set, the full trellis is never held in memory (see
+            train_checkpointed). It cannot be combined with band or beam.
+
+            With scaled set, the full trellis is computed with the faster
+            scaled recursions (see trellis.forward_backward_scaled). They
+            lose precision on small arc weights, so the log-space recursions
+            are used instead when some arc weight is too small (see
+            trellis.well_scaled) or when the frames of the result do not all
+            carry the same posterior mass (see trellis.mass_error). Neither
+            check is a proof of exactness, which is why scaled is off by
+            default.
+        '''
+        obs = self.observations(seq)
+        if checkpoint:
+            if band is not None or beam is not None:
+                raise ValueError("checkpoint cannot be combined with band or beam")
+            self.pruned_mass = 0.0
+            self.band_mass = None
+            return self.train_checkpointed(obs)
+        
+        if band is None and beam is None:
+            e11, e12, q12 = self.compile(obs)
+            scaled = scaled and trellis.well_scaled(e11, e12, q12)
+            if scaled:
+                alpha, beta = trellis.forward_backward_scaled(e11, e12, q12)
+                posteriors = trellis.arc_posteriors(alpha, beta, e11, e12, q12)
+                scaled = trellis.mass_error(alpha, posteriors) <= trellis.MASS_TOL
+            if not scaled:
+                alpha = trellis.forward(e11, e12, q12)
+                beta = trellis.backward(e11, e12, q12)
+                posteriors = trellis.arc_posteriors(alpha, beta, e11, e12, q12)
+            self.update_arc_counts(obs, posteriors)
+            self.pruned_mass = 0.0
+            self.band_mass = None
+            return trellis.logsumexp(alpha[-1])
+
+        T = len(obs)
+        lo, W = trellis.band(T, len(self.chain), band)
+        E11, E12, q12 = self.compile_band(obs, lo, W)
+        alpha = trellis.forward_band(E11, E12, q12, lo, T)
+        LL = trellis.logsumexp(trellis.stage_cells(alpha, lo, T))
+        norm = trellis.logsumexp(trellis.stage_cells(alpha, lo, T - 1))
+        
+        # Move everything to the narrower band of the cells within the beam
+        keep = None
+        if beam is not None:
+            spans = trellis.beam_spans(alpha, lo, T, beam)
+            lo, W, keep = trellis.narrow_band(lo, spans)
+            alpha = trellis.shift(alpha, spans[:,0])[:,:W]
+            alpha[np.arange(W)[np.newaxis,:] > keep[:,1,np.newaxis]] = trellis.NEG_INF
+            E11 = trellis.shift(E11, spans[:-1,0])[:,:W]
+            E12 = trellis.shift(E12, spans[:-1,0])[:,:W]
+        
+        beta = trellis.backward_band(E11, E12, q12, lo, T, keep=keep)
+        posteriors = trellis.arc_posteriors_band(alpha, beta, E11, E12, q12, lo, T, norm=norm)
+        self.update_arc_counts(obs, posteriors, lo=lo)
+        self.pruned_mass = min(1.0, max(0.0, 1.0 - np.exp(beta[0,0] - LL)))
+        self.band_mass = None
+        if measure_band and band is not None:
+            LL_full = trellis.logsumexp(trellis.forward(*self.compile(obs))[-1])
+            self.band_mass = min(1.0, max(0.0, 1.0 - np.exp(LL - LL_full)))
         return LL
+
+    def train_checkpointed(self,obs,segment=None):
+        '''
+            Accumulates the arc counts of the emission ids obs and returns the
+            log-likelihood, keeping only O(sqrt(T) * N) of the trellis in
+            memory. The forward pass stores alpha at the first stage of each
+            segment of segment frames (sqrt(T) by default). The backward pass
+            then visits the segments from last to first, recomputing the
+            forward probabilities of each one from its checkpoint. This costs
+            one more forward pass.
+        '''
+        T = len(obs)
+        if segment is None:
+            segment = int(np.ceil(np.sqrt(T)))
+        starts = list(range(0, T, max(segment, 1)))
+        ends = starts[1:] + [T]
+        
+        checkpoints = []
+        alpha = None
+        for t0,t1 in zip(starts, ends):
+            e11, e12, q12 = self.compile(obs[t0:t1])
+            alpha = trellis.forward(e11, e12, q12, alpha0=None if alpha is None else alpha[-1], last=(t1 == T))
+            checkpoints.append(alpha[0])
+        LL = trellis.logsumexp(alpha[-1])
+        norm = trellis.logsumexp(alpha[-2])
+        
+        beta = None
+        for t0,t1,alpha0 in reversed(list(zip(starts, ends, checkpoints))):
+            e11, e12, q12 = self.compile(obs[t0:t1])
+            alpha = trellis.forward(e11, e12, q12, alpha0=alpha0, last=(t1 == T))
+            beta = trellis.backward(e11, e12, q12, beta_end=None if beta is None else beta[0], first=(t0 == 0))
+            self.update_arc_counts(obs[t0:t1], trellis.arc_posteriors(alpha, beta, e11, e12, q12, norm=norm))
+        return LL
+
+    def viterbi(self,seq):
+        '''
+            Returns the log score of the best path through the trellis and
+            the (K, 3) array of its arcs (t, s, arc), see trellis.traceback.
+        '''
+        e11, e12, q12 = self.compile(self.observations(seq))
+        delta = trellis.viterbi(e11, e12, q12)
+        path = np.array(trellis.traceback(delta, e11, e12, q12), dtype=np.intp).reshape(-1,3)
+        return delta[-1].max(), path
+
+    def align(self,seq):
+        '''
+            Best path segmentation of the observation sequence seq into the
+            graphemes of this utterance, in the format of mlf.mlf2python:
+
+                [(start_frame, end_frame, grapheme), ...]
+
+            Graphemes left by a null arc cover no frames and are left out.
+        '''
+        _, path = self.viterbi(seq)
+        consumed = path[(path[:,2] < 2) | (path[:,1] == len(self.chain) - 1)]
+        segments = []
+        for s in np.unique(consumed[:,1]):
+            frames = consumed[consumed[:,1] == s,0]
+            segments.append((int(frames[0]), int(frames[-1]) + 1, self.G.graphemes[self.chain[s]]))
+        return segments
+
+    def viterbi_sequence(self,seq):
+        '''
+            Viterbi (hard EM) counterpart of train_sequence. Adds one count
+            for every arc on the best path to the counters of the GraphemeSet
+            and returns the log score of the path.
+        '''
+        obs = self.observations(seq)
+        score, path = self.viterbi(seq)
+        t, s, arc = path.T
+        np.add.at(self.G.c_t, (self.chain[s], arc), 1.0)
+        emitting = arc < 2
+        np.add.at(self.G.c_ty, (self.chain[s[emitting]], obs[t[emitting]], arc[emitting]), 1.0)
+        return score
+
+
+class UtteranceBatch:
+    def __init__(self,utterances,seqs):
+        '''
+            Constructor for a batch of utterance HMMs that are trained
+            together. The grapheme chains and observation sequences are padded
+            to the longest in the batch, so that the trellis recursions run
+            over the whole batch at once (see make_batches).
+
+            Inputs:
+                utterances -- list of Utterance sharing one GraphemeSet
+                seqs       -- observation sequence of each utterance
+        '''
+        self.utterances = utterances
+        self.G = utterances[0].G
+        self.T = np.array([len(seq) for seq in seqs], dtype=np.intp)
+        self.N = np.array([len(u.chain) for u in utterances], dtype=np.intp)
+        
+        B, Tm, Nm = len(utterances), self.T.max(), self.N.max()
+        self.chain = np.zeros((B, Nm), dtype=np.intp)
+        self.obs = np.zeros((B, Tm), dtype=np.intp)
+        for i,(u,seq) in enumerate(zip(utterances, seqs)):
+            self.chain[i,:self.N[i]] = u.chain
+            self.obs[i,:self.T[i]] = u.observations(seq)
+
+    def compile(self):
+        '''
+            Left aligned batched version of Utterance.compile. Arc weights
+            outside of each utterance are -inf.
+        '''
+        B, Tm, Nm = self.obs.shape[0], self.obs.shape[1], self.chain.shape[1]
+        e11 = np.full((B, Tm, Nm), trellis.NEG_INF)
+        e12 = np.full((B, Tm, Nm), trellis.NEG_INF)
+        q12 = np.full((B, Nm), trellis.NEG_INF)
+        for i,u in enumerate(self.utterances):
+            T, N = self.T[i], self.N[i]
+            e11[i,:T,:N], e12[i,:T,:N], q12[i,:N] = u.compile(self.obs[i,:T])
+        return e11, e12, q12
+
+    def train_sequences(self):
+        '''
+            Batched Utterance.train_sequence. Returns the log-likelihood of
+            each utterance in the batch.
+        '''
+        T, N = self.T, self.N
+        e11, e12, q12 = self.compile()
+        Tm, Nm = e11.shape[1:]
+        
+        alpha = trellis.forward_batch(e11, e12, q12, T, N)
+        dt, ds = Tm - T, Nm - N
+        beta = trellis.backward_batch(trellis.realign(e11, dt, ds), trellis.realign(e12, dt, ds),
+                                      trellis.realign(q12[:,np.newaxis,:], 0 * ds, ds)[:,0], T, N)
+        beta = trellis.realign(beta, -dt, -ds)
+        p11, p12, p_q12 = trellis.arc_posteriors_batch(alpha, beta, e11, e12, q12, T, N)
+        
+        num_graphemes, num_emissions, _ = self.G.c_ty.shape
+        key = (self.chain[:,np.newaxis,:] * num_emissions + self.obs[:,:,np.newaxis]).ravel()
+        for i,p in enumerate((p11, p12)):
+            c = np.bincount(key, weights=p.ravel(), minlength=num_graphemes * num_emissions)
+            c = c.reshape(num_graphemes, num_emissions)
+            self.G.c_ty[...,i] += c
+            self.G.c_t[:,i] += c.sum(axis=1)
+        self.G.c_t[:,2] += np.bincount(self.chain.ravel(), weights=p_q12.sum(axis=1).ravel(), minlength=num_graphemes)
+        
+        return trellis.logsumexp(alpha[np.arange(len(T)),T], axis=1)
+
+
+def make_batches(utterances,seqs,batch_size=64):
+    '''
+        Usage: make_batches(utterances, seqs, batch_size=64)
+
+        Sorts the utterances by number of observations and graphemes and
+        groups them into buckets of at most batch_size utterances of similar
+        length, so that little of each UtteranceBatch is padding.
+
+        Returns a list of (indices, UtteranceBatch), where indices are the
+        positions of the batched utterances in the input lists.
+    '''
+    order = sorted(range(len(utterances)), key=lambda i: (len(seqs[i]), len(utterances[i].chain)))
+    batches = []
+    for start in range(0, len(order), batch_size):
+        idx = order[start:start + batch_size]
+        batches.append((idx, UtteranceBatch([utterances[i] for i in idx], [seqs[i] for i in idx])))
+    return batches
@@ -53,6 +53,8 @@ def main():
     parser.add_argument("-E","--emissions", help="The inventory of possible "
                                             "emissions.", action="store",
                                             default=None)
+    parser.add_argument("-J","--jobs", help="Number of processes used to "
+                        "parse the MLFs.", action="store", type=int, default=1)
     args = parser.parse_args()
 
     # Initialize emissions distribution for transducer
@@ -70,8 +72,8 @@ def main():
             for l in f_inv:
                 label_inventory.append(l.strip())
 
-    ref = mlf.mlf2python(REF_FILE)
-    res = mlf.mlf2python(RES_FILE)
+    ref = mlf.mlf2corpus(REF_FILE, jobs=args.jobs)
+    res = mlf.mlf2corpus(RES_FILE, keys=ref.keys(), jobs=args.jobs)
     (ref_labels, res_labels) = mlf.align(ref,res)
     (ref_ints, int2ref) = tokenize(ref_labels)
     (res_ints, int2res) = tokenize(res_labels, label_inventory=label_inventory)
@@ -0,0 +1,119 @@
+import math
+import random
+import unittest
+import numpy as np
+import Transducer
+
+# Run from utils/transducer with PYTHONPATH=.. python -m unittest test_transducer,
+# on python 2 and 3
+
+
+def reference(G, chain, obs):
+    '''
+        The original pure python forward-backward, on the parameters of the
+        GraphemeSet G. Returns the log-likelihood and the arc counts c_t and
+        c_ty accumulated on top of the smoothing value.
+    '''
+    A, B = G.A, G.B
+    c_t, c_ty = G.c_t.copy(), G.c_ty.copy()
+    stages = len(obs) + 1
+    states = len(chain) + 1
+    obs = [None] + list(obs)
+
+    alpha = [[0.0] * states for t in range(stages)]
+    alpha[0][0] = 1.0
+    Q = [1.0] * stages
+    for t in range(1, stages):
+        o = obs[t]
+        for s in range(states):
+            if s == 0:
+                alpha[t][s] = alpha[t-1][s] * A[chain[s],0] * B[chain[s],o,0]
+            elif s == states - 1:
+                alpha[t][s] = alpha[t-1][s-1] * A[chain[s-1],1] * B[chain[s-1],o,1]
+                if t != stages - 1:
+                    alpha[t][s] += alpha[t-1][s-1] * A[chain[s-1],2]
+            else:
+                alpha[t][s] = alpha[t-1][s] * A[chain[s],0] * B[chain[s],o,0] \
+                            + alpha[t-1][s-1] * A[chain[s-1],1] * B[chain[s-1],o,1]
+                if t != stages - 1:
+                    alpha[t][s] += alpha[t][s-1] * A[chain[s-1],2]
+        Q[t] = sum(alpha[t])
+        alpha[t] = [v / Q[t] for v in alpha[t]]
+
+    beta = [[0.0] * states for t in range(stages)]
+    beta[-1] = [1.0] * states
+    for t in range(stages - 2, -1, -1):
+        o = obs[t+1]
+        for s in range(states - 2, -1, -1):
+            beta[t][s] = beta[t+1][s] * A[chain[s],0] * B[chain[s],o,0] \
+                       + beta[t+1][s+1] * A[chain[s],1] * B[chain[s],o,1]
+            if t != 0:
+                beta[t][s] += beta[t][s+1] * A[chain[s],2]
+        beta[t] = [v / Q[t] for v in beta[t]]
+        for s in range(states - 1):
+            g = chain[s]
+            p = alpha[t][s] * A[g,0] * B[g,o,0] * beta[t+1][s]
+            c_ty[g,o,0] += p
+            c_t[g,0] += p
+            p = alpha[t][s] * A[g,1] * B[g,o,1] * beta[t+1][s+1]
+            c_ty[g,o,1] += p
+            c_t[g,1] += p
+            c_t[g,2] += alpha[t][s] * A[g,2] * beta[t][s+1] * Q[t]
+    return sum(math.log(q) for q in Q), c_t, c_ty
+
+
+def random_model(rng, scale, graphemes=4, emissions=6):
+    '''
+        Random emission distributions, 40% of which are multiplied by scale.
+    '''
+    return {'g%d' % g: {'e%d' % e: rng.random() * (scale if rng.random() < 0.4 else 1.0)
+                        for e in range(emissions)} for g in range(graphemes)}
+
+
+class TrainSequenceTest(unittest.TestCase):
+    def check(self, scale, trials=30, seed=0, **kwargs):
+        rng = random.Random(seed)
+        for i in range(trials):
+            em = random_model(rng, scale)
+            N = rng.randint(1, 8)
+            chain = ' '.join(rng.choice(sorted(em)) for n in range(N))
+            seq = [rng.choice(sorted(em['g0'])) for t in range(rng.randint(N, 60))]
+            G = Transducer.GraphemeSet(em)
+            utt = Transducer.Utterance('u', chain, G)
+            LL, c_t, c_ty = reference(G, utt.chain, utt.observations(seq))
+            self.assertAlmostEqual(utt.train_sequence(seq, **kwargs), LL, delta=1e-9 * abs(LL))
+            np.testing.assert_allclose(G.c_t, c_t, rtol=1e-8)
+            np.testing.assert_allclose(G.c_ty, c_ty, rtol=1e-8, atol=1e-10)
+
+    def test_log_space(self):
+        self.check(1.0)
+
+    def test_scaled(self):
+        self.check(1.0, scaled=True)
+
+    def test_small_emissions(self):
+        for scale in (1e-6, 1e-12, 1e-14, 1e-16, 1e-30):
+            self.check(scale)
+            self.check(scale, scaled=True)
+
+    def test_no_pruning(self):
+        # A beam that prunes nothing gives the counts of the full trellis
+        rng = random.Random(0)
+        em = random_model(rng, 1.0)
+        for T in range(1, 7):
+            for N in range(1, 7):
+                for band in (None, 1):
+                    chain = ' '.join(rng.choice(sorted(em)) for n in range(N))
+                    seq = [rng.choice(sorted(em['g0'])) for t in range(T)]
+                    G = Transducer.GraphemeSet(em)
+                    utt = Transducer.Utterance('u', chain, G)
+                    LL = utt.train_sequence(seq, band=band)
+                    c_t, c_ty = G.c_t, G.c_ty
+                    G.reset_counters()
+                    self.assertAlmostEqual(utt.train_sequence(seq, band=band, beam=1e9), LL, places=9)
+                    np.testing.assert_allclose(G.c_t, c_t, rtol=1e-9)
+                    np.testing.assert_allclose(G.c_ty, c_ty, rtol=1e-9)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,18 +4,300 @@ from __future__ import print_function
 import pickle
 import sys
 import os
-from Transducer import Grapheme, Utterance
+import copy
+import itertools
+import multiprocessing
+import zlib
+from Transducer import GraphemeSet, Utterance, make_batches
+import utterance_cache
 import argparse
 import json
 import mlf
+from fileio import is_stdio
+from kaldi_ark import parse_rspecifier
 
 DEF_MIN_LL = -999.0
 
+# With --band, the mass outside the band is measured on one in BAND_SAMPLE
+# utterances, which also run a forward pass over the full trellis
+BAND_SAMPLE = 10
+
+# State of an E-step worker, set by init_worker
+_worker = {}
+
 def usage():
     print(" Usage: ./make_transducer.py [opts] <REF_ALI> <AUD_ALI> <OUTPUT> <EMISSIONS>")
     print("     --iter : specify the number of training iterations. Default = 8")
     print("     --train_size : specify what fraction of input data to train on. Default = 1.0")
     print("     --add_1_smooth: specify the add val parameter for smoothing HMM arc counts. Default = 0.01")
+    print("     --jobs : specify the number of processes used in the E-step. Default = 1")
+    print("     --block_size : specify the number of utterances per block of statistics. Default = 256")
+    print("     --batch_size : specify the number of utterances per padded batch. Default = 0 (no batching)")
+    print("     --viterbi : train with Viterbi (hard EM) instead of Baum-Welch")
+    print("     --band : only consider alignments within this many frames of the diagonal. Default = None (no band)")
+    print("     --beam : prune the backward pass to within this log-probability of the best forward score of each frame. Default = None (no pruning)")
+    print("     --band_sample : measure the posterior mass outside the band on one in this many utterances, 0 for none. Default = 10")
+    print("     --checkpoint : keep only sqrt(T) frames of each trellis in memory at the cost of a second forward pass")
+    print("     --resume : continue training from the state saved after the last finished iteration")
+    print("     --tol : stop once the relative improvement of the per frame LL is below this value. Default = 0 (run all iterations)")
+    print("     --online : stepwise EM that streams the utterances and updates the model after every mini-batch")
+    print("     --minibatch_size : specify the number of utterances per online update. Default = 1000")
+    print("     --decay : specify the step size decay of online EM, in (0.5, 1]. Default = 0.7")
+    print("     --cache_dir : keep the training data compiled to integer arrays in this directory, to be reused by later runs")
+    print("     --alignments : write best path grapheme alignments of the training data to this MLF")
+
+def init_worker(graphemes, data, batch_size=0, viterbi=False, band=None, beam=None,
+                checkpoint=False, band_sample=BAND_SAMPLE):
+    _worker['graphemes'] = graphemes
+    _worker['data'] = data
+    _worker['batch_size'] = batch_size
+    _worker['viterbi'] = viterbi
+    _worker['band'] = band
+    _worker['beam'] = beam
+    _worker['checkpoint'] = checkpoint
+    _worker['band_sample'] = band_sample
+
+def is_band_sample(u, band_sample):
+    '''
+        True if the mass outside the band is measured on the utterance u,
+        one in band_sample utterances picked by their id, whatever the
+        blocks, jobs and mini-batches.
+    '''
+    if band_sample <= 0:
+        return False
+    key = u if isinstance(u, bytes) else u.encode("utf-8")
+    return (zlib.crc32(key) & 0xffffffff) % band_sample == 0
+
+def accumulate_block(block):
+    '''
+        E-step over the utterances data[start:end] of the worker, where block
+        is (start, end). Returns the arc counts without smoothing, the
+        log-likelihood, the number of frames and the posterior mass removed
+        by the beam, summed over the utterances of the block, then the mass
+        outside the band summed over the sampled utterances (see
+        is_band_sample) and their number.
+    '''
+    graphemes = _worker['graphemes']
+    graphemes.reset_counters(0.0)
+    data = _worker['data'][block[0]:block[1]]
+    num_frames = sum(len(seq) for _,_,seq in data)
+    pruned_mass = 0.0
+    band_mass = 0.0
+    band_samples = 0
+    if _worker['viterbi']:
+        LL = 0.0
+        for u,ref,seq in data:
+            LL += Utterance(u,ref,graphemes).viterbi_sequence(seq)
+    elif _worker['batch_size'] > 0:
+        utts = [Utterance(u,ref,graphemes) for u,ref,_ in data]
+        batches = make_batches(utts, [seq for _,_,seq in data], batch_size=_worker['batch_size'])
+        LL = sum(batch.train_sequences().sum() for _,batch in batches)
+    else:
+        LL = 0.0
+        for u,ref,seq in data:
+            utt = Utterance(u,ref,graphemes)
+            measure_band = _worker['band'] is not None and is_band_sample(u, _worker['band_sample'])
+            LL += utt.train_sequence(seq, band=_worker['band'], beam=_worker['beam'],
+                                     checkpoint=_worker['checkpoint'], measure_band=measure_band)
+            pruned_mass += utt.pruned_mass
+            if utt.band_mass is not None:
+                band_mass += utt.band_mass
+                band_samples += 1
+    return graphemes.c_t, graphemes.c_ty, LL, num_frames, pruned_mass, band_mass, band_samples
+
+def accumulate_task(task):
+    '''
+        E-step over the utterances of a task (A, B, data) sent to a worker of
+        a pool that outlives the model and the data (see make_pool): the
+        parameters A and B of the model are set first, and data is the list
+        of utterances of the block.
+    '''
+    A, B, data = task
+    _worker['graphemes'].A = A
+    _worker['graphemes'].B = B
+    _worker['data'] = data
+    return accumulate_block((0, len(data)))
+
+def make_pool(graphemes, jobs, data=None, batch_size=0, viterbi=False, band=None, beam=None,
+              checkpoint=False, band_sample=BAND_SAMPLE, **kwargs):
+    '''
+        Returns a pool of jobs E-step workers, each with a copy of graphemes
+        and data. A pool made without data can be passed to expectation()
+        for any number of calls, e.g. once per mini-batch, the current
+        parameters and utterances being sent with each block.
+    '''
+    return multiprocessing.Pool(jobs, initializer=init_worker,
+                                initargs=(graphemes, data, batch_size, viterbi, band, beam,
+                                          checkpoint, band_sample))
+
+def expectation(graphemes, data, jobs=1, block_size=256, batch_size=0, viterbi=False,
+                band=None, beam=None, checkpoint=False, band_sample=BAND_SAMPLE, pool=None):
+    '''
+        Accumulates the arc counts of all utterances in data, a list of
+        (utterance_id, reference, observation sequence), into the counters
+        of graphemes. Returns the total log-likelihood and number of frames.
+
+        The utterances are split into blocks of block_size whose statistics
+        are computed independently and then summed in block order, so the
+        result is bit-for-bit the same for any number of jobs. If batch_size
+        is set, the utterances of each block are trained in length sorted,
+        padded batches of that size (see Transducer.make_batches). If viterbi
+        is set, only the arcs of the best path of each utterance are counted
+        and the returned log-likelihood is that of the best paths. The band,
+        beam and checkpoint are passed on to Utterance.train_sequence. Also
+        returns the mean posterior mass per utterance removed by the beam,
+        and with band, the mean mass outside the band over the sampled
+        utterances (see is_band_sample) and their number.
+
+        With jobs > 1 the blocks are shared out to a pool of workers, made
+        for this call unless a pool from make_pool() is given, which is
+        left open.
+    '''
+    blocks = [(i, min(i + block_size, len(data))) for i in range(0, len(data), block_size)]
+    own_pool = None
+    if pool is not None:
+        tasks = ((graphemes.A, graphemes.B, data[start:end]) for start,end in blocks)
+        results = pool.imap(accumulate_task, tasks)
+    elif jobs > 1:
+        own_pool = make_pool(graphemes, jobs, data, batch_size, viterbi, band, beam, checkpoint,
+                             band_sample)
+        results = own_pool.imap(accumulate_block, blocks)
+    else:
+        init_worker(copy.deepcopy(graphemes), data, batch_size, viterbi, band, beam, checkpoint,
+                    band_sample)
+        results = (accumulate_block(b) for b in blocks)
+
+    try:
+        graphemes.reset_counters()
+        LL = 0.0
+        num_frames = 0
+        pruned_mass = 0.0
+        band_mass = 0.0
+        band_samples = 0
+        for (start,end),(c_t,c_ty,LL_block,frames_block,pruned_block,band_block,samples_block) in zip(blocks, results):
+            sys.stdout.write("Trained utterance %d of %d\r" % (end,len(data)) )
+            sys.stdout.flush()
+            graphemes.c_t += c_t
+            graphemes.c_ty += c_ty
+            LL += LL_block
+            num_frames += frames_block
+            pruned_mass += pruned_block
+            band_mass += band_block
+            band_samples += samples_block
+    finally:
+        if own_pool is not None:
+            own_pool.close()
+            own_pool.join()
+
+    return LL, num_frames, pruned_mass / max(len(data), 1), band_mass / max(band_samples, 1), band_samples
+
+def read_pairs(ref_ali, aud_ali, train_size=1.0):
+    '''
+        Returns the list of (utterance_id, reference, observation sequence)
+        of the first train_size fraction of the utterances of ref_ali, sorted
+        by utterance id. Only those utterances are read from either file
+        (see mlf.load_utterances), unless a file is compressed or stdin,
+        which is then read whole.
+    '''
+    if mlf.is_indexable(ref_ali):
+        keys = sorted(mlf.load_index(ref_ali).keys())
+        keys = keys[0:int(len(keys)*train_size)]
+        ref_utterances = mlf.load_utterances(ref_ali, keys)
+    else:
+        ref_utterances = mlf.read_utterances(ref_ali)
+        keys = sorted(ref_utterances.keys())
+        keys = keys[0:int(len(keys)*train_size)]
+    train_utterances = mlf.load_utterances(aud_ali, keys)
+    return [(u,ref_utterances[u],train_utterances[u].split(" ")) for u in keys]
+
+def is_stdin(rspec):
+    '''
+        True if the input rspec, a path or kaldi rspecifier, is read from
+        stdin and can therefore only be read once.
+    '''
+    return is_stdio(parse_rspecifier(rspec)[1])
+
+def stream_pairs(ref_ali, aud_ali):
+    '''
+        Yields (utterance_id, reference, observation sequence) for every
+        utterance of ref_ali that is also in aud_ali, reading both files one
+        line at a time. As for the kaldi tools, both files must be sorted by
+        utterance id.
+    '''
+    aud = mlf.iter_ali(aud_ali)
+    u_aud, seq = next(aud, (None, None))
+    u_prev = None
+    for u,ref in mlf.iter_ali(ref_ali):
+        if u_prev is not None and u < u_prev:
+            sys.exit("ERROR: %s is not sorted by utterance id" % ref_ali)
+        u_prev = u
+        while u_aud is not None and u_aud < u:
+            u_last = u_aud
+            u_aud, seq = next(aud, (None, None))
+            if u_aud is not None and u_aud < u_last:
+                sys.exit("ERROR: %s is not sorted by utterance id" % aud_ali)
+        if u_aud is None:
+            return
+        if u_aud == u:
+            yield u, ref, seq.split(" ")
+
+def online_pass(graphemes, pairs, minibatch_size=1000, decay=0.7, **kwargs):
+    '''
+        One pass of stepwise EM over the stream of (utterance_id, reference,
+        observation sequence) pairs. The arc counts of each mini-batch of
+        minibatch_size utterances are accumulated with expectation(), to
+        which kwargs are passed, and the model is then updated with
+        GraphemeSet.step(decay). Only one mini-batch is held in memory.
+        Returns the total log-likelihood, number of frames, mean pruned
+        posterior mass and band statistics, as expectation() does. With
+        jobs > 1, one pool of
+        workers serves all the mini-batches of the pass.
+    '''
+    LL = 0.0
+    num_frames = 0
+    pruned_mass = 0.0
+    band_mass = 0.0
+    band_samples = 0
+    num_utts = 0
+    pool = make_pool(graphemes, **kwargs) if kwargs.get('jobs', 1) > 1 else None
+    try:
+        while True:
+            data = list(itertools.islice(pairs, minibatch_size))
+            if len(data) == 0:
+                break
+            LL_batch, frames_batch, pruned_batch, band_batch, samples_batch = expectation(graphemes, data,
+                                                                                          pool=pool, **kwargs)
+            graphemes.step(decay)
+            LL += LL_batch
+            num_frames += frames_batch
+            pruned_mass += pruned_batch * len(data)
+            band_mass += band_batch * samples_batch
+            band_samples += samples_batch
+            num_utts += len(data)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return LL, num_frames, pruned_mass / max(num_utts, 1), band_mass / max(band_samples, 1), band_samples
+
+def save_state(graphemes, LL_history, fname):
+    '''
+        Pickles the model and the per frame log-likelihoods of the finished
+        iterations to fname. The file is written under a temporary name and
+        then renamed, so a killed job never leaves a truncated state behind.
+    '''
+    tmp = fname + ".tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump({'graphemes': graphemes, 'LL': LL_history}, f)
+    os.rename(tmp, fname)
+
+def load_state(fname):
+    '''
+        Returns the model and log-likelihood history saved by save_state.
+    '''
+    with open(fname, "rb") as f:
+        state = pickle.load(f)
+    return state['graphemes'], state['LL']
 
 def main():
     if len(sys.argv[1:]) == 0:
@@ -38,8 +320,65 @@ def main():
                         "input files over which to train.", type=float, default=1.0)
     parser.add_argument("-L","--add_1_smooth", action="store", help="Smoothing "
                                         "value for HMM arcs", type=float, default = 0.01)
+    parser.add_argument("-J","--jobs", action="store", help="Number of processes "
+                        "used to accumulate statistics.", type=int, default=1)
+    parser.add_argument("-B","--block_size", action="store", help="Number of "
+                        "utterances whose statistics are accumulated together. "
+                        "Results depend on this, but not on the number of jobs.",
+                        type=int, default=256)
+    parser.add_argument("-b","--batch_size", action="store", help="Number of "
+                        "utterances of similar length trained together as one "
+                        "padded batch. 0 trains one utterance at a time.",
+                        type=int, default=0)
+    parser.add_argument("-V","--viterbi", action="store_true", help="Train with "
+                        "Viterbi (hard EM) counts of the best path only.")
+    parser.add_argument("--band", action="store", help="Only consider "
+                        "alignments that stay within this many frames of the "
+                        "diagonal of the trellis.", type=int, default=None)
+    parser.add_argument("--beam", action="store", help="Skip the backward pass "
+                        "and arc counts of trellis cells whose forward score is "
+                        "more than this far (in log-probability) below the "
+                        "total of their frame.", type=float, default=None)
+    parser.add_argument("--band_sample", action="store", help="With --band, "
+                        "measure the posterior mass outside the band on one "
+                        "in this many utterances (picked by id), at the cost "
+                        "of a forward pass over their full trellis. 0 turns "
+                        "the measure off.", type=int, default=BAND_SAMPLE)
+    parser.add_argument("--checkpoint", action="store_true", help="Store the "
+                        "forward probabilities only every sqrt(T) frames and "
+                        "recompute the rest during the backward pass, so that "
+                        "long utterances use O(sqrt(T) * N) memory.")
+    parser.add_argument("-R","--resume", action="store_true", help="Continue "
+                        "from the training state (OUTPUT.state) saved after "
+                        "each iteration, if there is one.")
+    parser.add_argument("--tol", action="store", help="Stop early once the "
+                        "relative improvement of the per frame log-likelihood "
+                        "drops below this value.", type=float, default=0.0)
+    parser.add_argument("-O","--online", action="store_true", help="Train with "
+                        "stepwise EM, streaming the input files and updating "
+                        "the model after every mini-batch. Each iteration is "
+                        "then one pass over the data.")
+    parser.add_argument("--minibatch_size", action="store", help="Number of "
+                        "utterances per online EM update.", type=int, default=1000)
+    parser.add_argument("--decay", action="store", help="Online EM step size "
+                        "decay, the k-th update has step size (k + 2)^-decay.",
+                        type=float, default=0.7)
+    parser.add_argument("-C","--cache_dir", action="store", help="Directory "
+                        "of compiled training data. The grapheme and emission "
+                        "ids of all utterances are stored there on the first "
+                        "run, keyed on the contents of the input files, and "
+                        "memory mapped by later runs.", default=None)
+    parser.add_argument("-A","--alignments", action="store", help="wspecifier MLF "
+                        "of the best path grapheme segmentation of the training "
+                        "data under the trained model.", default=None)
     
     args = parser.parse_args()
+    if (args.band is not None or args.beam is not None) and (args.batch_size > 0 or args.viterbi):
+        parser.error("--band and --beam cannot be used with --batch_size or --viterbi")
+    if args.checkpoint and (args.band is not None or args.beam is not None or args.batch_size > 0 or args.viterbi):
+        parser.error("--checkpoint cannot be used with --band, --beam, --batch_size or --viterbi")
+    if args.online and args.train_size != 1.0:
+        parser.error("--train_size cannot be used with --online")
     
     EMISSIONS = args.emissions
     REF_ALI  = args.input1
@@ -48,32 +387,69 @@ def main():
     ITERS    = args.iters
     TRAINING_SIZE = args.train_size
     LAM = args.add_1_smooth
+    JOBS = args.jobs
+    BLOCK_SIZE = args.block_size
+    BATCH_SIZE = args.batch_size
+    VITERBI = args.viterbi
+    BAND = args.band
+    BEAM = args.beam
+    BAND_SAMPLING = args.band_sample
+    CHECKPOINT = args.checkpoint
+    RESUME = args.resume
+    TOL = args.tol
+    ONLINE = args.online
+    MINIBATCH_SIZE = args.minibatch_size
+    DECAY = args.decay
+    CACHE_DIR = args.cache_dir
+    ALIGNMENTS = args.alignments
+    STATE = OUTFILE + ".state"
     
     # Get training and tesing test
-    ref_utterances = mlf.ali2dict(REF_ALI)
-    train_utterances = mlf.ali2dict(RES_ALI)
-    train_utterances = {u:train_utterances[u] for u in ref_utterances.iterkeys()}
     emissions_dict = json.load(open(EMISSIONS,"rb"))
+    graphemes = GraphemeSet(emissions_dict,lam=LAM)
+    if ONLINE:
+        pairs = lambda: stream_pairs(REF_ALI, RES_ALI)
+    else:
+        pairs = lambda: read_pairs(REF_ALI, RES_ALI)
+    if CACHE_DIR:
+        # The cache is keyed on the contents of the input files
+        try:
+            for rspec in (REF_ALI, RES_ALI):
+                utterance_cache.input_files(rspec)
+        except ValueError as e:
+            sys.exit("ERROR: --cache_dir: %s" % e)
+        cache = utterance_cache.load_or_build(CACHE_DIR, [REF_ALI, RES_ALI, EMISSIONS], pairs, graphemes)
+        pairs = lambda: iter(cache)
+    if not ONLINE:
+        if CACHE_DIR:
+            data = cache[0:int(len(cache)*TRAINING_SIZE)]
+        else:
+            data = read_pairs(REF_ALI, RES_ALI, TRAINING_SIZE)
+
+    LL_history = []
+    if RESUME and os.path.exists(STATE):
+        graphemes, LL_history = load_state(STATE)
+        print("Resuming after iteration %d" % (len(LL_history) - 1))
     
-    graphemes = {name: Grapheme(name,emissions,lam=LAM) for name,emissions in emissions_dict.iteritems()}    
-    num_utts = len(ref_utterances.keys())
-    train_keys = sorted(train_utterances.keys())[0:int(num_utts*TRAINING_SIZE)]
-    num_train = len(train_keys)
+    # Every online pass reads the alignments again, unless they are cached
+    if ONLINE and not CACHE_DIR and ITERS - len(LL_history) > 1 and any(is_stdin(r) for r in (REF_ALI, RES_ALI)):
+        sys.exit("ERROR: --online reads the alignments once per iteration, so input from stdin only allows one iteration")
 
-    LL_old = DEF_MIN_LL
-    for i in range(ITERS):
+    LL_old = LL_history[-1] if LL_history else DEF_MIN_LL
+    for i in range(len(LL_history), ITERS):
         print("Iteration ", i )
-        LL = 0.0
-        num_frames = 0.0
-        for i_u,u in enumerate(train_keys,start=1):
-            sys.stdout.write("Created utterance %d of %d\r" % (i_u,num_train) )
-            sys.stdout.flush()
-            utt = Utterance(u,ref_utterances[u],graphemes)
-            seq = train_utterances[u].split(" ")
-            num_frames += len(seq)
-            LL += utt.train_sequence(seq)
-
-        LL /= num_frames   
+        options = dict(jobs=JOBS, block_size=BLOCK_SIZE, batch_size=BATCH_SIZE, viterbi=VITERBI,
+                       band=BAND, beam=BEAM, checkpoint=CHECKPOINT, band_sample=BAND_SAMPLING)
+        if ONLINE:
+            LL, num_frames, pruned_mass, band_mass, band_samples = online_pass(graphemes, pairs(), minibatch_size=MINIBATCH_SIZE,
+                                                      decay=DECAY, **options)
+        else:
+            LL, num_frames, pruned_mass, band_mass, band_samples = expectation(graphemes, data, **options)
+            graphemes.update()
+        if num_frames == 0:
+            sys.exit("ERROR: no frames of training data were read from %s and %s" % (REF_ALI, RES_ALI))
+        LL /= float(num_frames)
+        converged = TOL > 0 and len(LL_history) > 0 and LL - LL_history[-1] < TOL * abs(LL_history[-1])
         if LL >= LL_old:
             LL_old = LL
         else:
@@ -82,11 +458,29 @@ def main():
 
         print(" ") 
         print("LL: %f" % LL )
-        for g in graphemes.itervalues():
-            g.update()
+        if BEAM is not None:
+            print("Pruned posterior mass: %e" % pruned_mass )
+        if BAND is not None and band_samples > 0:
+            print("Posterior mass outside the band: %e (%d utterances)" % (band_mass, band_samples) )
+        LL_history.append(LL)
+        save_state(graphemes, LL_history, STATE)
+        if converged:
+            print("Converged, relative LL improvement below %g" % TOL)
+            break
 
     pickle.dump(graphemes, open( OUTFILE, "wb" ) )
 
+    if ALIGNMENTS:
+        if ONLINE:
+            data = list(pairs())
+        files = {}
+        for i_u,(u,ref,seq) in enumerate(data,start=1):
+            sys.stdout.write("Aligned utterance %d of %d\r" % (i_u,len(data)) )
+            sys.stdout.flush()
+            files[u] = Utterance(u,ref,graphemes).align(seq)
+        print(" ")
+        mlf.python2mlf(files, ALIGNMENTS)
+
 # Initialize inputs from unigram distribution of grapheme level alignments
 if __name__ == "__main__":
     main()
@@ -0,0 +1,646 @@
+#!/usr/bin/python
+
+import numpy as np
+
+# Vectorized log-space recursions over the left-to-right grapheme chain used by
+# Transducer.Utterance. Every function works on the compiled form of an
+# utterance:
+#
+#   e11 -- (T, N) log( a11 * b11(o_t) ) of the grapheme in each chain position
+#   e12 -- (T, N) log( a12 * b12(o_t) )
+#   q12 -- (N,)   log( q12 )
+#
+# where T is the number of observations and N the number of graphemes in the
+# reference. Each trellis is computed with O(N) array operations of length T,
+# so the python overhead no longer grows with the number of frames.
+#
+# The trellis has T+1 stages and N+1 states, exactly as in the original pure
+# python recursions, and every quirk of those recursions (no null arcs in the
+# last stage of the forward pass or the first stage of the backward pass, the
+# final state only being fed from the previous stage) is kept so that
+# likelihoods and arc counts are unchanged.
+
+NEG_INF = -np.inf
+
+# Log of the smallest positive double. Zero-probability self loops are floored
+# to it inside scan() so that the running sums stay finite.
+LOG_TINY = np.log(np.finfo(float).tiny)
+
+
+def scan(a, b, op=np.logaddexp):
+    '''
+        Usage: scan(a, b, op=np.logaddexp)
+
+        Solves the first order linear recurrence (log domain)
+
+            x[t] = a[t] * x[t-1] + b[t],  x[-1] = 0
+
+        for all t at once. With L the running sum of a, the solution is
+        x[t] = L[t] + log sum_{j<=t} exp(b[j] - L[j]), which is a single
+        logaddexp accumulation. a[0] is ignored. The recurrence runs along
+        the last axis, so a batch of recurrences can be solved in one call.
+
+        With op=np.maximum the same recurrence is solved in the max-product
+        semiring, x[t] = max(a[t] * x[t-1], b[t]).
+    '''
+    L = np.maximum(a, LOG_TINY)
+    L[...,0] = 0.0
+    np.cumsum(L, axis=-1, out=L)
+    return L + op.accumulate(b - L, axis=-1)
+
+
+def forward(e11, e12, q12, op=np.logaddexp, alpha0=None, last=True):
+    '''
+        Usage: forward(e11, e12, q12, op=np.logaddexp, alpha0=None, last=True)
+
+        Returns the (T+1, N+1) matrix of log forward probabilities. The
+        trellis is swept one state at a time: the input to a state from its
+        predecessor is known for all stages once the predecessor is done, and
+        the self loop then makes each state a linear recurrence over time that
+        scan() solves in one call.
+
+        With op=np.maximum it returns the Viterbi scores instead.
+
+        A segment of a longer trellis is computed by passing the arc weights
+        of the segment and the forward probabilities alpha0 of its first
+        stage. last tells whether the segment ends with the final stage of
+        the trellis, which has no null arcs.
+    '''
+    T, N = e11.shape
+    end = T if last else T + 1
+    alpha = np.full((T + 1, N + 1), NEG_INF)
+    if alpha0 is None:
+        alpha[0, 0] = 0.0
+    else:
+        alpha[0] = alpha0
+    a = np.zeros(T + 1)
+    b = np.full(T + 1, NEG_INF)
+    for s in range(N):
+        a[1:] = e11[:, s]
+        b[0] = alpha[0, s]
+        if s > 0:
+            b[1:] = alpha[:-1, s - 1] + e12[:, s - 1]
+            op(b[1:end], alpha[1:end, s - 1] + q12[s - 1], out=b[1:end])
+        alpha[:, s] = scan(a, b, op=op)
+
+    # The final state has no self loop, and its null arc comes from the
+    # previous stage
+    alpha[1:, N] = alpha[:-1, N - 1] + e12[:, N - 1]
+    op(alpha[1:end, N], alpha[:end - 1, N - 1] + q12[N - 1], out=alpha[1:end, N])
+    return alpha
+
+
+def viterbi(e11, e12, q12):
+    '''
+        Usage: viterbi(e11, e12, q12)
+
+        Returns the (T+1, N+1) matrix of best partial path log scores.
+    '''
+    return forward(e11, e12, q12, op=np.maximum)
+
+
+def traceback(delta, e11, e12, q12):
+    '''
+        Usage: traceback(delta, e11, e12, q12)
+
+        Follows the best path back from the best cell of the last stage of
+        the Viterbi scores delta. Backpointers are not stored, the best
+        predecessor of each cell is recomputed instead. Returns the arcs of
+        the path in time order as a list of (t, s, arc), where arc indexes
+        Transducer.ARCS and leaves state s. Emitting arcs consume observation
+        t (0-based), null arcs stay in stage t. The only exception is the
+        null arc leaving state N-1, which comes from the previous stage and
+        so consumes observation t without emitting it.
+    '''
+    T, N = e11.shape
+    t, s = T, int(np.argmax(delta[T]))
+    path = []
+    while t > 0:
+        # (score, previous stage, previous state, arc)
+        cands = []
+        if s == N:
+            cands.append((delta[t - 1, N - 1] + e12[t - 1, N - 1], t - 1, N - 1, 1))
+            if t != T:
+                cands.append((delta[t - 1, N - 1] + q12[N - 1], t - 1, N - 1, 2))
+        else:
+            cands.append((delta[t - 1, s] + e11[t - 1, s], t - 1, s, 0))
+            if s > 0:
+                cands.append((delta[t - 1, s - 1] + e12[t - 1, s - 1], t - 1, s - 1, 1))
+                if t != T:
+                    cands.append((delta[t, s - 1] + q12[s - 1], t, s - 1, 2))
+        _, t_prev, s_prev, arc = max(cands, key=lambda c: c[0])
+        path.append((t_prev, s_prev, arc))
+        t, s = t_prev, s_prev
+    path.reverse()
+    return path
+
+
+def backward(e11, e12, q12, beta_end=None, first=True):
+    '''
+        Usage: backward(e11, e12, q12, beta_end=None, first=True)
+
+        Returns the (T+1, N+1) matrix of log backward probabilities. This is
+        the mirror image of forward(), sweeping the states from last to first.
+
+        A segment of a longer trellis is computed by passing the arc weights
+        of the segment and the backward probabilities beta_end of its last
+        stage. first tells whether the segment starts with the first stage of
+        the trellis, which has no null arcs.
+    '''
+    T, N = e11.shape
+    start = 1 if first else 0
+    beta = np.full((T + 1, N + 1), NEG_INF)
+    beta[T] = 0.0 if beta_end is None else beta_end
+    a = np.zeros(T + 1)
+    b = np.zeros(T + 1)
+    for s in range(N - 1, -1, -1):
+        a[:T] = e11[:, s]
+        b[T] = beta[T, s]
+        b[:T] = beta[1:, s + 1] + e12[:, s]
+        np.logaddexp(b[start:T], beta[start:T, s + 1] + q12[s], out=b[start:T])
+        beta[:, s] = scan(a[::-1], b[::-1])[::-1]
+    return beta
+
+
+def logsumexp(x, axis=None):
+    m = np.max(x, axis=axis, keepdims=True)
+    m = np.where(np.isfinite(m), m, 0.0)
+    with np.errstate(divide='ignore'):
+        s = np.log(np.sum(np.exp(x - m), axis=axis, keepdims=True)) + m
+    if axis is None:
+        return s.item()
+    return np.squeeze(s, axis=axis)
+
+
+def arc_posteriors(alpha, beta, e11, e12, q12, norm=None):
+    '''
+        Usage: arc_posteriors(alpha, beta, e11, e12, q12, norm=None)
+
+        Returns the (T, N) arc occupancies (self, transition, null) for every
+        position in the chain and every observation. Occupancies are
+        normalized by the forward mass of the penultimate stage, which is the
+        normalization implied by the scaled recursions this engine replaces.
+        For a segment of a longer trellis that normalization must be given
+        as norm.
+    '''
+    T = e11.shape[0]
+    if norm is None:
+        norm = logsumexp(alpha[T - 1])
+    a = alpha[:T, :-1] - norm
+    p11 = np.exp(a + e11 + beta[1:, :-1])
+    p12 = np.exp(a + e12 + beta[1:, 1:])
+    p_q12 = np.exp(a + q12 + beta[:T, 1:])
+    return p11, p12, p_q12
+
+
+# Scaled recursions. The log-space sweep above spends most of its time in
+# logaddexp. forward_backward_scaled() computes the same alpha and beta with
+# products and sums of probabilities instead, as the original recursions did.
+# The forward pass and the backward pass, mirrored in time and states, are the
+# same sweep and run side by side in the same array operations.
+#
+# The recurrence of each state is solved in blocks of BLOCK stages, stored as
+# (2, M, BLOCK) arrays whose cell [p, i, k] is stage i*BLOCK + k of pass p.
+# Each block holds probabilities divided by the one of its last stage, whose
+# log is kept apart, and only the carries from one block to the next go
+# through the log domain, M of them per state.
+#
+# This is only exact while the probabilities of a state stay within the range
+# of a double across each block. Small emission probabilities (below ~1e-12)
+# break that, and alpha and beta then come out wrong without any overflow.
+# well_scaled() rejects the arc weights that are too small beforehand and
+# mass_error() checks the result, see Utterance.train_sequence.
+
+BLOCK = 16
+
+# Self loops are floored to this in the scaled recursions, so that the scaled
+# probabilities divided by the product of the self loops of a block, at most
+# 1 / TINY_LOOP**(BLOCK+1), stay finite. It is ~1e-17.
+TINY_LOOP = np.finfo(float).tiny ** (1.0 / (BLOCK + 2))
+
+# Log scale of the blocks that hold no probability
+EMPTY = -1e300
+
+# Smallest nonzero arc weight accepted by well_scaled()
+LOG_MIN_WEIGHT = np.log(1e-10)
+
+# Largest relative error of mass_error() accepted from the scaled recursions
+MASS_TOL = 1e-9
+
+
+def sweep_scaled(a, c, q, init, prev):
+    '''
+        Usage: sweep_scaled(a, c, q, init, prev)
+
+        Solves R consecutive states of P trellises, state r being the linear
+        recurrence over the stages
+
+            x_r[t] = a_r[t] * x_r[t-1] + c_r[t] * x_{r-1}[t-1] + q_r[t] * x_{r-1}[t]
+
+        with x_r[0] = exp(init[r]). a, c and q are the (R, P, M, BLOCK)
+        blocked weights (see above) and init is (R, P). prev holds the
+        (P, M, BLOCK) probabilities of the state before the first, which must
+        be 0 in the last stage of every block. Returns the scaled
+        probabilities and the (R, P, M) log scales of all R states.
+    '''
+    R, P, M, K = a.shape
+    # Within each block, x = loops * cumsum(inputs / loops) from a zero start,
+    # and the log of the loops of all the blocks up to each block end, after
+    # a zero for the initial value
+    loops = np.cumprod(np.maximum(a, TINY_LOOP), axis=-1)
+    c = c / loops
+    q = q / loops
+    carry_loops = np.zeros((R, P, M + 1))
+    np.cumsum(np.log(loops[...,-1]), axis=-1, out=carry_loops[:,:,1:])
+    cumsum = np.triu(np.ones((K, K)))
+
+    cells = np.empty((R, P, M, K))
+    exps = np.empty((R, P, M))
+    shifted = np.zeros((P, M, K))
+    x = np.empty((P, M, K))
+    carry = np.empty((P, M + 1))
+    prev_exp = np.zeros((P, M))
+    # Last stage of the previous block of the previous state, scaled as the
+    # current block
+    boundary = np.zeros((P, M))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for r in range(R):
+            # Inputs from the previous state
+            shifted[...,1:] = prev[...,:-1]
+            shifted[:,1:,0] = boundary[:,1:]
+            np.multiply(shifted, c[r], out=x)
+            x += prev * q[r]
+            np.dot(x.reshape(P * M, K), cumsum, out=x.reshape(P * M, K))
+            x *= loops[r]
+
+            # Log of the last stage of every block, each one carried over to
+            # the next block
+            carry[:,0] = init[r]
+            np.log(x[...,-1], out=carry[:,1:])
+            carry[:,1:] += prev_exp
+            carry -= carry_loops[r]
+            np.logaddexp.accumulate(carry, axis=-1, out=carry)
+            carry += carry_loops[r]
+            first, last = carry[:,:-1], np.maximum(carry[:,1:], EMPTY)
+
+            np.log(x, out=x)
+            x += (prev_exp - last)[...,np.newaxis]
+            np.exp(x, out=cells[r])
+            np.exp(first - last, out=boundary)
+            cells[r] += loops[r] * boundary[...,np.newaxis]
+            exps[r] = last
+            prev, prev_exp = cells[r], exps[r]
+    return cells, exps
+
+
+def forward_backward_scaled(e11, e12, q12):
+    '''
+        Usage: forward_backward_scaled(e11, e12, q12)
+
+        Returns the log forward and backward probabilities of forward() and
+        backward(), computed with the scaled recursions. Self loops below
+        TINY_LOOP are floored, and the result is only exact when the
+        probabilities of each state do not span too many orders of magnitude
+        within a block (see above). Check the weights with well_scaled() and
+        the result with mass_error().
+    '''
+    T, N = e11.shape
+    K = BLOCK
+    M = -(-(T + 1) // K)
+
+    # Weights of each state by the stage they enter, pass 1 being the backward
+    # pass with time and states reversed. Stages past T have no inputs.
+    a = np.ones((N, 2, M * K))
+    c = np.zeros((N, 2, M * K))
+    q = np.zeros((N, 2, M * K))
+    np.exp(e11.T, out=a[:,0,1:T + 1])
+    a[:,1,1:T + 1] = a[::-1,0,T:0:-1]
+    np.exp(e12.T[::-1,::-1], out=c[:,1,1:T + 1])
+    c[1:,0,1:T + 1] = c[:0:-1,1,T:0:-1]
+    q[1:,0,1:T] = np.exp(q12[:-1,np.newaxis])
+    q[:,1,1:T] = np.exp(q12[::-1,np.newaxis])
+
+    # The forward pass starts in state 0, the backward pass in every state of
+    # the last stage, after the final state
+    init = np.zeros((N, 2))
+    init[1:,0] = NEG_INF
+    prev = np.zeros((2, M, K))
+    prev[1,0,0] = 1.0
+    cells, exps = sweep_scaled(a.reshape(N, 2, M, K), c.reshape(N, 2, M, K), q.reshape(N, 2, M, K), init, prev)
+
+    with np.errstate(divide='ignore'):
+        x = np.log(cells) + exps[...,np.newaxis]
+    x = x.reshape(N, 2, M * K)
+
+    alpha = np.full((T + 1, N + 1), NEG_INF)
+    alpha[:,:N] = x[:,0,:T + 1].T
+    null = np.full(T, q12[N - 1])
+    null[-1] = NEG_INF
+    alpha[1:,N] = alpha[:-1,N - 1] + np.logaddexp(e12[:,N - 1], null)
+    beta = np.full((T + 1, N + 1), NEG_INF)
+    beta[:,:N] = x[::-1,1,T::-1].T
+    beta[T,N] = 0.0
+    return alpha, beta
+
+
+def well_scaled(e11, e12, q12):
+    '''
+        Usage: well_scaled(e11, e12, q12)
+
+        True if no arc weight is below LOG_MIN_WEIGHT, other than the zero
+        ones. The scaled recursions were only found to be exact on such
+        weights.
+    '''
+    return not any(((e < LOG_MIN_WEIGHT) & (e > NEG_INF)).any() for e in (e11, e12, q12))
+
+
+def mass_error(alpha, posteriors):
+    '''
+        Usage: mass_error(alpha, posteriors)
+
+        Every path takes exactly one emitting arc per observation, so the
+        occupancies of the emitting arcs of each frame add up to the total
+        mass of the trellis (normalized as in arc_posteriors()). Returns the
+        largest relative deviation from it over the frames, which is only
+        rounding error for exact alpha and beta, and nan if the trellis has
+        no mass.
+    '''
+    p11, p12, _ = posteriors
+    T = p11.shape[0]
+    with np.errstate(invalid='ignore', over='ignore'):
+        mass = np.exp(logsumexp(alpha[-1]) - logsumexp(alpha[T - 1]))
+        return np.abs((p11.sum(axis=1) + p12.sum(axis=1)) / mass - 1).max()
+
+
+# Batched recursions. A batch of B utterances is padded to Tmax observations
+# and Nmax graphemes, the padding holding -inf arc weights:
+#
+#   e11, e12 -- (B, Tmax, Nmax)
+#   q12      -- (B, Nmax)
+#   T, N     -- (B,) number of observations and graphemes of each utterance
+#
+# The forward pass takes the arrays left aligned, so that every utterance
+# starts in the same trellis cell. The backward pass takes them right aligned
+# (see realign), so that every utterance ends in the same trellis cell. Only
+# the quirks at the far end of each recursion then depend on the utterance.
+
+def realign(x, dt, ds, fill=NEG_INF):
+    '''
+        Usage: realign(x, dt, ds)
+
+        Shifts each (T, S) slice of the (B, T, S) array x by dt[b] stages and
+        ds[b] states: out[b, t, s] = x[b, t - dt[b], s - ds[b]]. Cells shifted
+        in from outside of x are set to fill.
+    '''
+    B, Tx, Sx = x.shape
+    t = np.arange(Tx)[np.newaxis,:] - dt[:,np.newaxis]
+    s = np.arange(Sx)[np.newaxis,:] - ds[:,np.newaxis]
+    valid = ((t >= 0) & (t < Tx))[:,:,np.newaxis] & ((s >= 0) & (s < Sx))[:,np.newaxis,:]
+    out = x[np.arange(B)[:,np.newaxis,np.newaxis],
+            np.clip(t, 0, Tx - 1)[:,:,np.newaxis],
+            np.clip(s, 0, Sx - 1)[:,np.newaxis,:]]
+    out[~valid] = fill
+    return out
+
+
+def forward_batch(e11, e12, q12, T, N):
+    '''
+        Usage: forward_batch(e11, e12, q12, T, N)
+
+        Batched forward(). Takes left aligned arc weights and returns the left
+        aligned (B, Tmax+1, Nmax+1) log forward probabilities.
+    '''
+    B, Tm, Nm = e11.shape
+    alpha = np.full((B, Tm + 1, Nm + 1), NEG_INF)
+    a = np.zeros((B, Tm + 1))
+    b = np.full((B, Tm + 1), NEG_INF)
+    b[:,0] = 0.0
+
+    # Null arcs are not taken in the last stage of each utterance
+    null_mask = np.where(np.arange(1, Tm + 1)[np.newaxis,:] < T[:,np.newaxis], 0.0, NEG_INF)
+    for s in range(Nm):
+        a[:,1:] = e11[:,:,s]
+        if s > 0:
+            b[:,0] = NEG_INF
+            b[:,1:] = alpha[:,:-1,s - 1] + e12[:,:,s - 1]
+            np.logaddexp(b[:,1:], alpha[:,1:,s - 1] + q12[:,s - 1,np.newaxis] + null_mask, out=b[:,1:])
+        alpha[:,:,s] = scan(a, b)
+
+    # The final state of each utterance has no self loop, and its null arc
+    # comes from the previous stage
+    utts = np.arange(B)
+    prev = alpha[utts,:-1,N - 1]
+    final = np.full((B, Tm + 1), NEG_INF)
+    final[:,1:] = np.logaddexp(prev + e12[utts,:,N - 1], prev + q12[utts,N - 1,np.newaxis] + null_mask)
+    alpha[utts,:,N] = final
+    return alpha
+
+
+def backward_batch(e11, e12, q12, T, N):
+    '''
+        Usage: backward_batch(e11, e12, q12, T, N)
+
+        Batched backward(). Takes right aligned arc weights and returns the
+        right aligned (B, Tmax+1, Nmax+1) log backward probabilities.
+    '''
+    B, Tm, Nm = e11.shape
+    beta = np.full((B, Tm + 1, Nm + 1), NEG_INF)
+    beta[:,Tm] = 0.0
+    a = np.zeros((B, Tm + 1))
+    b = np.zeros((B, Tm + 1))
+
+    # Null arcs are not taken in the first stage of each utterance
+    null_mask = np.where(np.arange(1, Tm)[np.newaxis,:] > (Tm - T)[:,np.newaxis], 0.0, NEG_INF)
+    for s in range(Nm - 1, -1, -1):
+        a[:,:Tm] = e11[:,:,s]
+        b[:,:Tm] = beta[:,1:,s + 1] + e12[:,:,s]
+        np.logaddexp(b[:,1:Tm], beta[:,1:Tm,s + 1] + q12[:,s,np.newaxis] + null_mask, out=b[:,1:Tm])
+        beta[:,:,s] = scan(a[:,::-1], b[:,::-1])[:,::-1]
+    return beta
+
+
+def arc_posteriors_batch(alpha, beta, e11, e12, q12, T, N):
+    '''
+        Usage: arc_posteriors_batch(alpha, beta, e11, e12, q12, T, N)
+
+        Batched arc_posteriors(). All inputs are left aligned, and the
+        (B, Tmax, Nmax) occupancies are zero outside of each utterance.
+    '''
+    B, Tm, Nm = e11.shape
+    norm = logsumexp(alpha[np.arange(B),T - 1], axis=1)
+    a = alpha[:,:Tm,:-1] - norm[:,np.newaxis,np.newaxis]
+    valid = (np.arange(Tm)[np.newaxis,:] < T[:,np.newaxis])[:,:,np.newaxis] \
+          & (np.arange(Nm)[np.newaxis,:] < N[:,np.newaxis])[:,np.newaxis,:]
+    p11 = np.where(valid, np.exp(a + e11 + beta[:,1:,:-1]), 0.0)
+    p12 = np.where(valid, np.exp(a + e12 + beta[:,1:,1:]), 0.0)
+    p_q12 = np.where(valid, np.exp(a + q12[:,np.newaxis,:] + beta[:,:Tm,1:]), 0.0)
+    return p11, p12, p_q12
+
+
+# Banded recursions. State s is only allowed in the W stages starting at lo[s]
+# (see band), and the trellis is stored as (N+1, W) arrays whose cell [s, j]
+# is stage lo[s] + j of state s. Time and memory then grow with N*W instead
+# of T*N. The arc weights are stored the same way, indexed by the stage an
+# arc enters:
+#
+#   E11, E12 -- (N, W) with E11[s, j] = e11[lo[s] + j - 1, s]
+#
+# Cells outside of the trellis or the band are -inf.
+
+def band(T, N, width=None):
+    '''
+        Usage: band(T, N, width=None)
+
+        Returns the first stage lo (N+1,) of the band of each state and the
+        number of stages W in each band. The band of grapheme s covers its
+        share of the diagonal, stages s*T/N to (s+1)*T/N, widened by width
+        stages on each side. With width=None every band is the whole trellis.
+        The final state is fed from the previous stage, so its band starts
+        one stage after that of the last grapheme.
+    '''
+    if width is None:
+        lo, W = np.zeros(N, dtype=np.intp), T + 1
+    else:
+        lo = np.clip(np.arange(N) * T // N - width, 0, T)
+        W = min(T + 1, -(-T // N) + 2 * width + 1)
+    return np.append(lo, lo[-1] + 1), W
+
+
+def shift(x, k, fill=NEG_INF):
+    '''
+        Usage: shift(x, k)
+
+        out[s, j] = x[s, j + k[s]] for the (S, W) array x, where k is a scalar
+        or one offset per row. Cells shifted in from outside are set to fill.
+    '''
+    S, W = x.shape
+    j = np.arange(W)[np.newaxis,:] + np.broadcast_to(k, (S,))[:,np.newaxis]
+    out = x[np.arange(S)[:,np.newaxis], np.clip(j, 0, W - 1)]
+    out[(j < 0) | (j >= W)] = fill
+    return out
+
+
+def stage_cells(x, lo, t):
+    '''
+        Usage: stage_cells(x, lo, t)
+
+        Returns the cells of stage t of the banded array x, for the states
+        whose band holds that stage.
+    '''
+    j = t - lo
+    inside = (j >= 0) & (j < x.shape[1])
+    return x[np.arange(len(lo))[inside], j[inside]]
+
+
+def forward_band(E11, E12, q12, lo, T):
+    '''
+        Usage: forward_band(E11, E12, q12, lo, T)
+
+        Banded forward(). Returns the (N+1, W) log forward probabilities.
+    '''
+    N, W = E11.shape
+    alpha = np.full((N + 1, W), NEG_INF)
+    stages = lo[:,np.newaxis] + np.arange(W)[np.newaxis,:]
+    null_mask = np.where((stages >= 1) & (stages < T), 0.0, NEG_INF)
+    b = np.full(W, NEG_INF)
+    b[0] = 0.0
+    for s in range(N):
+        if s > 0:
+            d = lo[s] - lo[s - 1]
+            prev = shift(alpha[s - 1:s], d)[0]
+            b = np.logaddexp(shift(alpha[s - 1:s], d - 1)[0] + shift(E12[s - 1:s], d)[0],
+                             prev + q12[s - 1] + null_mask[s])
+        alpha[s] = scan(E11[s], b)
+
+    # The final state has no self loop, and its null arc comes from the
+    # previous stage
+    alpha[N] = np.logaddexp(alpha[N - 1] + shift(E12[N - 1:N], 1)[0],
+                            alpha[N - 1] + q12[N - 1] + null_mask[N])
+    alpha[stages > T] = NEG_INF
+    return alpha
+
+
+def backward_band(E11, E12, q12, lo, T, keep=None):
+    '''
+        Usage: backward_band(E11, E12, q12, lo, T, keep=None)
+
+        Banded backward(). Returns the (N+1, W) log backward probabilities.
+        If keep is given, only the span [keep[s,0], keep[s,1]] of the band of
+        each state s is computed and the rest of the band is pruned.
+    '''
+    N, W = E11.shape
+    beta = np.full((N + 1, W), NEG_INF)
+    stages = lo[:,np.newaxis] + np.arange(W)[np.newaxis,:]
+    null_mask = np.where((stages >= 1) & (stages < T), 0.0, NEG_INF)
+    beta[N, stages[N] == T] = 0.0
+    a = shift(E11, 1)
+    e12 = shift(E12, 1)
+    for s in range(N - 1, -1, -1):
+        d = lo[s + 1] - lo[s]
+        b = np.logaddexp(shift(beta[s + 1:s + 2], 1 - d)[0] + e12[s],
+                         shift(beta[s + 1:s + 2], -d)[0] + q12[s] + null_mask[s])
+        b[stages[s] == T] = 0.0
+        j0, j1 = (0, W - 1) if keep is None else keep[s]
+        if j1 < j0:
+            continue
+        beta[s, j0:j1 + 1] = scan(a[s, j0:j1 + 1][::-1], b[j0:j1 + 1][::-1])[::-1]
+    return beta
+
+
+def beam_spans(alpha, lo, T, beam):
+    '''
+        Usage: beam_spans(alpha, lo, T, beam)
+
+        Returns the (N+1, 2) span of the band of each state that holds cells
+        within beam (log) of the forward mass of their stage. States with no
+        such cell get an empty span.
+    '''
+    stages = lo[:,np.newaxis] + np.arange(alpha.shape[1])[np.newaxis,:]
+    valid = stages <= T
+    C = np.full(T + 1, NEG_INF)
+    np.logaddexp.at(C, stages[valid], alpha[valid])
+    # Stage 0 is always kept, as the arc counts of the scaled recursions
+    # include null arcs out of stage 0 that the forward pass does not take.
+    # Their backward probabilities are fed from stage 1, which for a single
+    # frame is the final stage, where the forward pass takes no null arcs
+    # either. Nothing is pruned then.
+    kept = valid & ((alpha >= C[np.clip(stages, 0, T)] - beam) | (stages == 0) | (T == 1))
+    any_kept = kept.any(axis=1)
+    first = np.where(any_kept, kept.argmax(axis=1), 1)
+    last = np.where(any_kept, kept.shape[1] - 1 - kept[:,::-1].argmax(axis=1), 0)
+    return np.stack((first, last), axis=1)
+
+
+def narrow_band(lo, spans):
+    '''
+        Usage: narrow_band(lo, spans)
+
+        Returns the narrower band (lo, W) that only covers the spans of each
+        state (see beam_spans), and the spans in that band. Arrays of the old
+        band are moved to the new one with shift(x, spans[:,0])[:,:W].
+    '''
+    length = np.maximum(spans[:,1] - spans[:,0] + 1, 0)
+    W = max(1, int(length.max()))
+    keep = np.stack((np.zeros_like(length), length - 1), axis=1)
+    return lo + spans[:,0], W, keep
+
+
+def arc_posteriors_band(alpha, beta, E11, E12, q12, lo, T, norm=None):
+    '''
+        Usage: arc_posteriors_band(alpha, beta, E11, E12, q12, lo, T, norm=None)
+
+        Banded arc_posteriors(). Returns the (N, W) occupancies of the arcs
+        leaving each cell, normalized as in arc_posteriors(). If alpha has
+        been pruned, the normalization of the unpruned alpha should be given
+        as norm.
+    '''
+    N, W = E11.shape
+    stages = lo[:N,np.newaxis] + np.arange(W)[np.newaxis,:]
+    if norm is None:
+        norm = logsumexp(stage_cells(alpha, lo, T - 1))
+    a = np.where(stages < T, alpha[:N] - norm, NEG_INF)
+    d = lo[1:] - lo[:-1]
+    p11 = np.exp(a + shift(E11, 1) + shift(beta[:N], 1))
+    p12 = np.exp(a + shift(E12, 1) + shift(beta[1:], 1 - d))
+    p_q12 = np.exp(a + q12[:,np.newaxis] + shift(beta[1:], -d))
+    return p11, p12, p_q12
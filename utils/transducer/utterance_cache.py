@@ -0,0 +1,155 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+from Transducer import Utterance
+from fileio import is_stdio
+from kaldi_ark import parse_rspecifier, read_scp
+
+# Compiled training data of train_transducer.py. The grapheme chains and
+# observation sequences of all utterances are stored as integer ids in flat
+# arrays, utterance i covering
+#
+#   chains[chain_offsets[i]:chain_offsets[i+1]]
+#   obs[obs_offsets[i]:obs_offsets[i+1]]
+#
+# Each array is saved as its own .npy file so that the cache can be memory
+# mapped instead of read.
+
+ARRAYS = ('chains', 'chain_offsets', 'obs', 'obs_offsets')
+
+
+def input_files(rspec):
+    '''
+        Usage: input_files(rspec)
+
+        Returns the files on disk that hold the data of the input rspec, a
+        path or a kaldi rspecifier as accepted by mlf.read_utterances: the
+        archive of "ark:path", the scp file of "scp:path" and the archives
+        it lists. Raises ValueError for stdin, which cannot be cached.
+    '''
+    kind, path = parse_rspecifier(rspec)
+    if is_stdio(path):
+        raise ValueError("%s is read from stdin and cannot be cached" % rspec)
+    if kind == "scp":
+        return [path] + sorted(set(ark for u,ark,offset in read_scp(path)))
+    return [path]
+
+
+def file_hash(*rspecs):
+    '''
+        Usage: file_hash(rspec1, rspec2, ...)
+
+        Returns the sha1 hex digest of the contents of all inputs (see
+        input_files).
+    '''
+    h = hashlib.sha1()
+    for rspec in rspecs:
+        for path in input_files(rspec):
+            with open(path, "rb") as fp:
+                for block in iter(lambda: fp.read(1 << 20), b""):
+                    h.update(block)
+    return h.hexdigest()
+
+
+class UtteranceCache(object):
+    def __init__(self, utt_ids, chains, chain_offsets, obs, obs_offsets):
+        '''
+            Constructor for a set of compiled utterances. Indexing the cache
+            returns (utterance_id, chain, obs), where chain and obs are the
+            arrays of grapheme and emission ids that Utterance and
+            Utterance.train_sequence accept in place of strings.
+        '''
+        self.utt_ids = utt_ids
+        self.chains = chains
+        self.chain_offsets = chain_offsets
+        self.obs = obs
+        self.obs_offsets = obs_offsets
+
+    @classmethod
+    def build(cls, pairs, graphemes):
+        '''
+            Compiles the (utterance_id, reference, observation sequence)
+            pairs against the grapheme and emission ids of graphemes.
+        '''
+        utt_ids, chains, obs = [], [], []
+        for u,ref,seq in pairs:
+            utt = Utterance(u, ref, graphemes)
+            utt_ids.append(u)
+            chains.append(utt.chain.astype(np.int32))
+            obs.append(utt.observations(seq).astype(np.int32))
+
+        def offsets(arrays):
+            return np.cumsum([0] + [len(a) for a in arrays]).astype(np.int64)
+
+        def concat(arrays):
+            return np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.int32)
+
+        return cls(utt_ids, concat(chains), offsets(chains), concat(obs), offsets(obs))
+
+    def save(self, dirname):
+        '''
+            Writes the cache to the directory dirname. The files are written
+            to a temporary directory that is then renamed, so that an
+            interrupted job never leaves a partial cache behind.
+        '''
+        parent = os.path.dirname(os.path.abspath(dirname))
+        tmp = tempfile.mkdtemp(dir=parent)
+        for name in ARRAYS:
+            np.save(os.path.join(tmp, name + ".npy"), getattr(self, name))
+        with open(os.path.join(tmp, "utt_ids"), "w") as fp:
+            for u in self.utt_ids:
+                fp.write("%s\n" % u)
+        try:
+            os.rename(tmp, dirname)
+        except OSError:
+            # Another job wrote the same cache first
+            shutil.rmtree(tmp)
+
+    @classmethod
+    def load(cls, dirname, mmap_mode='r'):
+        '''
+            Reads a cache written by save(). The arrays are memory mapped
+            unless mmap_mode is None.
+        '''
+        arrays = [np.load(os.path.join(dirname, name + ".npy"), mmap_mode=mmap_mode) for name in ARRAYS]
+        with open(os.path.join(dirname, "utt_ids")) as fp:
+            utt_ids = [l.rstrip("\n") for l in fp]
+        return cls(utt_ids, *arrays)
+
+    def __len__(self):
+        return len(self.utt_ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        c = self.chain_offsets
+        o = self.obs_offsets
+        return self.utt_ids[i], self.chains[c[i]:c[i+1]], self.obs[o[i]:o[i+1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def load_or_build(cache_dir, input_files, pairs, graphemes):
+    '''
+        Usage: load_or_build(cache_dir, input_files, pairs, graphemes)
+
+        Returns the UtteranceCache of the input files, memory mapped from
+        cache_dir. The cache is keyed on the hash of the contents of
+        input_files (the alignments and the emissions that define the
+        grapheme and emission ids). If it does not exist yet it is built
+        from pairs, a function returning the (utterance_id, reference,
+        observation sequence) pairs, and saved. Inputs read from stdin
+        raise ValueError before anything is read.
+    '''
+    dirname = os.path.join(cache_dir, file_hash(*input_files))
+    if not os.path.isdir(dirname):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        UtteranceCache.build(pairs(), graphemes).save(dirname)
+    return UtteranceCache.load(dirname)